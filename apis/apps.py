@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ApisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apis'
+
+    def ready(self):
+        from apis import signals  # noqa: F401
@@ -0,0 +1,292 @@
+"""
+Type-ahead suggestions for book titles and author names, served from memory.
+
+Each process keeps two ``common.prefix_index.PrefixIndex``es. Books are ranked
+by how many users favourited them, authors by ``fans_count``. They are loaded
+from the snapshot written by ``build_autocomplete`` when it exists, otherwise
+built from the database, on first use (or at startup with
+``AUTOCOMPLETE['WARM_UP']``). After that the signal handlers in
+``apis.signals`` apply every book, author and favourite saved through the ORM
+in this process, once its transaction commits.
+
+Writes reach the other processes through the Django cache named by
+``AUTOCOMPLETE['SHARED_ALIAS']``. Once a write's transaction commits, its
+``(op, kind, id, label, score)`` tuples are stored under the next value of a
+shared counter, and the entry ``LOG_SIZE`` values back is dropped. Each
+request compares the counter with the value the local index includes and
+applies the missing entries through ``PrefixIndex.add``/``remove``; only a
+process that has fallen further behind than the log reaches rebuilds from
+the database, in a background thread while the old index keeps answering.
+Snapshots record the counter too, so a loaded snapshot catches up the same
+way.
+
+Every entry holds absolute values, so applying one twice (say, on top of a
+rebuild that already read it from the database) is harmless. Favourite
+counts change far more often than titles and only move the ranking, so
+each process collects the books whose favourites changed and, at most once
+every ``FAVORITES_INTERVAL`` seconds, logs their current counts in one
+entry. Bulk imports bypass signals, so rebuild the snapshot after one.
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Count
+
+from apis.models import Author, Book, Favorite
+from common.prefix_index import PrefixIndex
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+CHANGES_KEY = 'autocomplete:changes'
+ENTRY_KEY = 'autocomplete:change:{}'
+
+
+class Autocomplete:
+    def __init__(self, books, authors, changes=None):
+        self.books = books
+        self.authors = authors
+        # Value of the shared write counter this index includes every write up to
+        self.changes = changes
+
+    @classmethod
+    def from_database(cls, top_k=10):
+        changes = shared_changes()  # read first: writes during the build bump it past this value
+        books = (
+            Book.objects.filter(is_active=True)
+            .annotate(favorites=Count('favorited_by'))
+            .values_list('id', 'title', 'favorites')
+        )
+        authors = Author.objects.filter(is_active=True).values_list('id', 'name', 'fans_count')
+        return cls(
+            PrefixIndex.build(books.iterator(chunk_size=10000), top_k=top_k),
+            PrefixIndex.build(authors.iterator(chunk_size=10000), top_k=top_k),
+            changes,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot written by ``save``. Snapshots are pickles: only load files this application wrote."""
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is an autocomplete snapshot of version {state.get('version')}, "
+                             f"expected {SNAPSHOT_VERSION}")
+        return cls(state['books'], state['authors'], state.get('changes'))
+
+    def save(self, path):
+        """Write a snapshot to ``path`` atomically."""
+        state = {'version': SNAPSHOT_VERSION, 'books': self.books, 'authors': self.authors, 'changes': self.changes}
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def suggest(self, text, limit=5):
+        return {
+            'books': [{'id': book_id, 'title': title} for book_id, title in self.books.search(text, limit)],
+            'authors': [{'id': author_id, 'name': name} for author_id, name in self.authors.search(text, limit)],
+        }
+
+    def apply(self, ops, pending=()):
+        """
+        Apply ``(op, kind, id, label, score)`` writes to the ``kind`` index.
+
+        ``add`` only takes a book's score when the book is new here; ``favorites``
+        sets the score of a book that is indexed, unless it is in ``pending``:
+        favourites changed here since, and a newer count will be logged.
+        """
+        for op, kind, item_id, label, score in ops:
+            index = getattr(self, kind)
+            if op == 'remove':
+                index.remove(item_id)
+            elif op == 'favorites':
+                entry = index.get(item_id)
+                if entry and item_id not in pending:
+                    index.add(item_id, entry[0], score)
+            else:
+                entry = index.get(item_id) if kind == 'books' else None
+                index.add(item_id, label, entry[1] if entry else score)
+
+    def favorites_changed(self, book_id, delta):
+        entry = self.books.get(book_id)
+        if entry:
+            self.books.add(book_id, entry[0], entry[1] + delta)
+
+
+def book_op(book, created=False):
+    """The write for a saved book."""
+    if not book.is_active:
+        return 'remove', 'books', book.pk, None, None
+    # The score only counts where the book is not indexed yet
+    entry = _autocomplete.books.get(book.pk) if _autocomplete is not None else None
+    favorites = 0 if created else entry[1] if entry else book.favorited_by.count()
+    return 'add', 'books', book.pk, book.title, favorites
+
+
+def author_op(author):
+    """The write for a saved author."""
+    if not author.is_active:
+        return 'remove', 'authors', author.pk, None, None
+    return 'add', 'authors', author.pk, author.name, author.fans_count
+
+
+_autocomplete = None
+_autocomplete_lock = threading.Lock()
+_rebuild_thread = None
+_sync_lock = threading.Lock()
+# Books whose favourites changed here since their counts were last logged
+_pending_favorites = set()
+_favorites_lock = threading.Lock()
+_favorites_published_at = 0.0
+
+
+def _shared_cache():
+    alias = settings.AUTOCOMPLETE.get('SHARED_ALIAS')
+    return caches[alias] if alias else None
+
+
+def shared_changes():
+    """The shared write counter, or None without a shared cache (or before the first write)."""
+    shared = _shared_cache()
+    return shared.get(CHANGES_KEY) if shared is not None else None
+
+
+def get_autocomplete():
+    """Return the process-wide suggestions index, loading or building it on first call."""
+    global _autocomplete
+    if _autocomplete is None:
+        with _autocomplete_lock:
+            if _autocomplete is None:
+                config = settings.AUTOCOMPLETE
+                path = config.get('SNAPSHOT_PATH')
+                if path and os.path.exists(path):
+                    _autocomplete = Autocomplete.load(path)
+                else:
+                    logger.info("No autocomplete snapshot at %s; building from the database", path)
+                    _autocomplete = Autocomplete.from_database(config.get('TOP_K', 10))
+    if _shared_cache() is not None:
+        _publish_favorites()
+        _catch_up()
+    return _autocomplete
+
+
+def _catch_up():
+    """Apply the log entries the local index is missing, or rebuild it if they are gone."""
+    changes = shared_changes()
+    if changes == _autocomplete.changes or not _sync_lock.acquire(blocking=False):
+        return  # up to date, or another thread is applying them
+    try:
+        autocomplete = _autocomplete
+        start = autocomplete.changes or 0
+        if changes is None or not 0 < changes - start <= settings.AUTOCOMPLETE.get('LOG_SIZE', 1000):
+            # Behind the start of the log, or the counter was evicted
+            _start_rebuild()
+            return
+        keys = [ENTRY_KEY.format(number) for number in range(start + 1, changes + 1)]
+        entries = _shared_cache().get_many(keys)
+        with _favorites_lock:
+            pending = set(_pending_favorites)
+        for number, key in enumerate(keys, start + 1):
+            if key not in entries:
+                # The newest entry may still be on its way; an older gap was evicted
+                if number < changes:
+                    _start_rebuild()
+                return
+            autocomplete.apply(entries[key], pending)
+            autocomplete.changes = number
+    finally:
+        _sync_lock.release()
+
+
+def _start_rebuild():
+    global _rebuild_thread
+    with _autocomplete_lock:
+        if _rebuild_thread is None or not _rebuild_thread.is_alive():
+            _rebuild_thread = threading.Thread(target=_rebuild, name='autocomplete-rebuild', daemon=True)
+            _rebuild_thread.start()
+
+
+def _rebuild():
+    global _autocomplete
+    try:
+        _autocomplete = Autocomplete.from_database(settings.AUTOCOMPLETE.get('TOP_K', 10))
+    except Exception:
+        logger.exception("Rebuilding the autocomplete index failed; serving the previous one")
+    finally:
+        connection.close()  # this thread's own connection
+
+
+def loaded_autocomplete():
+    """The suggestions index if this process has loaded it, else None; writes never trigger a load."""
+    return _autocomplete
+
+
+def record_write(ops):
+    """Apply ``ops`` to this process's index, if loaded, and log them for the others, once the transaction commits."""
+    transaction.on_commit(lambda: _committed(ops))
+
+
+def _committed(ops):
+    if _shared_cache() is None:
+        if _autocomplete is not None:
+            _autocomplete.apply(ops)
+        return
+    _append(ops)
+    # Applied in log order, with whatever other processes wrote before
+    if _autocomplete is not None:
+        _catch_up()
+
+
+def record_favorite(book_id, delta):
+    """Move a book's favourite count here once the transaction commits, and log it with the next batch."""
+    def committed():
+        if _autocomplete is not None:
+            _autocomplete.favorites_changed(book_id, delta)
+        if _shared_cache() is not None:
+            with _favorites_lock:
+                _pending_favorites.add(book_id)
+            _publish_favorites()
+
+    transaction.on_commit(committed)
+
+
+def _publish_favorites():
+    global _favorites_published_at
+    with _favorites_lock:
+        now = time.monotonic()
+        if not _pending_favorites or now - _favorites_published_at < settings.AUTOCOMPLETE.get('FAVORITES_INTERVAL', 5):
+            return
+        book_ids = list(_pending_favorites)
+        _pending_favorites.clear()
+        _favorites_published_at = now
+    counts = dict.fromkeys(book_ids, 0)
+    counts.update(
+        # order_by() keeps Favorite's default ordering out of the GROUP BY
+        Favorite.objects.filter(book_id__in=book_ids).order_by().values('book_id').annotate(count=Count('id'))
+        .values_list('book_id', 'count')
+    )
+    _append([('favorites', 'books', book_id, None, count) for book_id, count in counts.items()])
+
+
+def _append(ops):
+    """Store ``ops`` as the next log entry and drop the one that falls out of the log."""
+    shared = _shared_cache()
+    try:
+        number = shared.incr(CHANGES_KEY)
+    except ValueError:  # not set yet, or evicted
+        number = 1 if shared.add(CHANGES_KEY, 1, timeout=None) else shared.incr(CHANGES_KEY)
+    shared.set(ENTRY_KEY.format(number), ops, timeout=None)
+    shared.delete(ENTRY_KEY.format(number - settings.AUTOCOMPLETE.get('LOG_SIZE', 1000)))
+    return number
+
+
+def warm_up_if_configured():
+    """Warm-up hook for WSGI/ASGI entry points, driven by ``AUTOCOMPLETE['WARM_UP']``."""
+    if settings.AUTOCOMPLETE.get('WARM_UP'):
+        get_autocomplete()
@@ -0,0 +1,88 @@
+"""
+Positions in the ``BookChange`` log, as read by ``run_indexer``.
+
+Change ids come from a sequence when the row is written, but transactions
+commit in any order, so a change can become visible after changes with
+higher ids. A position is therefore the highest id read (``cursor``) plus
+the ids below it that were not visible yet (``gaps``). Readers keep asking
+for the gaps until they show up, or until they are old enough to be given
+up on: a transaction that rolled back never fills its id.
+
+Index builds record the position of the log when they start reading books
+in a ``<index>.changes.json`` file next to the index, and the indexer
+starts from it. Applying a change twice is harmless, so starting early is
+always safe; starting late would lose changes.
+"""
+import json
+import os
+
+from django.db.models import Q
+
+from apis.models import BookChange
+
+# Ids this far below the end of the log are assumed to have committed or been rolled back.
+GAP_LOOKBACK = 10000
+
+START = {'cursor': 0, 'gaps': []}
+
+
+def current_position(lookback=GAP_LOOKBACK):
+    """The position of the log as this transaction sees it."""
+    cursor = BookChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    seen = set(BookChange.objects.filter(id__gt=cursor - lookback).values_list('id', flat=True))
+    return {'cursor': cursor, 'gaps': [i for i in range(max(cursor - lookback, 0) + 1, cursor) if i not in seen]}
+
+
+def pending_changes(position, limit):
+    """Up to ``limit`` changes after ``position``, in id order: filled gaps first, then new entries."""
+    condition = Q(id__gt=position['cursor'])
+    if position['gaps']:
+        condition |= Q(id__in=position['gaps'])
+    return list(BookChange.objects.filter(condition).order_by('id')[:limit])
+
+
+def advance(position, changes, lookback=GAP_LOOKBACK):
+    """The position after ``changes`` (as returned by ``pending_changes``) have been applied."""
+    seen = {change.id for change in changes}
+    cursor = max([position['cursor'], *seen])
+    gaps = set(position['gaps']) | set(range(position['cursor'] + 1, cursor))
+    return {'cursor': cursor, 'gaps': sorted(i for i in gaps - seen if i > cursor - lookback)}
+
+
+def earliest(positions):
+    """The earliest of several positions, e.g. one per build shard; None if any is unknown."""
+    positions = list(positions)
+    if not positions or any(position is None for position in positions):
+        return None
+    return min(positions, key=lambda position: position['cursor'])
+
+
+def position_path(index_path):
+    return f"{index_path}.changes.json"
+
+
+def build_position_path(build_dir):
+    return os.path.join(build_dir, 'changes.json')
+
+
+def save_position(path, position):
+    """Write (or with ``position`` None, remove) a position file atomically."""
+    if position is None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(position, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def load_position(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,256 @@
+"""
+PostgreSQL fast path for the importers.
+
+Each batch of parsed records is streamed with ``COPY ... FROM STDIN`` into a
+temporary staging table and merged into the real tables with one set-based
+``INSERT ... SELECT ... ON CONFLICT DO NOTHING`` per table, so no model
+instances are built and no per-row parameters are bound. Only one batch is
+held in memory at a time, however large the input file is.
+
+With ``upsert`` the merge is ``ON CONFLICT (id) DO UPDATE`` instead, limited
+to rows whose ``content_hash`` differs, so unchanged rows are not rewritten
+(no new row version, no WAL, ``updated_at`` kept).
+
+Upserted books are recorded in the ``BookChange`` log, so ``run_indexer``
+re-embeds them.
+
+An author's ``work_ids`` and ``book_ids`` are also written to the
+``AuthorWork`` and ``AuthorBookRef`` tables. A listed book is linked to its
+author through ``Book.authors`` by whichever import runs second.
+"""
+import io
+import json
+import time
+
+from django.db import connection, transaction
+
+from apis.models import Author, AuthorBookRef, AuthorWork, Book, BookChange
+from common.utils import invalidate_recommendations
+
+BOOK_COLUMNS = ('id', 'title', 'published_date', 'isbn', 'description', 'content_hash')
+AUTHOR_COLUMNS = (
+    'id', 'name', 'gender', 'image_url', 'about', 'ratings_count', 'average_rating',
+    'text_reviews_count', 'work_ids', 'book_ids', 'works_count', 'fans_count', 'content_hash',
+)
+
+_STAGING_TABLES = {
+    'import_book': """
+        CREATE TEMPORARY TABLE IF NOT EXISTS import_book (
+            id text, title text, published_date date, isbn text, description text, content_hash text,
+            seq bigserial  -- file order, so the first of several rows for one book wins
+        ) ON COMMIT DELETE ROWS
+    """,
+    'import_book_author': """
+        CREATE TEMPORARY TABLE IF NOT EXISTS import_book_author (
+            book_id text, author_id text
+        ) ON COMMIT DELETE ROWS
+    """,
+    'import_author': """
+        CREATE TEMPORARY TABLE IF NOT EXISTS import_author (
+            id text, name text, gender text, image_url text, about text, ratings_count integer,
+            average_rating double precision, text_reviews_count integer, work_ids jsonb, book_ids jsonb,
+            works_count integer, fans_count integer, content_hash text,
+            seq bigserial
+        ) ON COMMIT DELETE ROWS
+    """,
+}
+
+
+def is_available():
+    return connection.vendor == 'postgresql'
+
+
+def _csv_field(value):
+    """
+    One CSV field: None is an unquoted empty field (NULL), everything else is quoted.
+
+    Quoting every value keeps an empty string distinct from NULL.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    else:
+        value = str(value).replace('\x00', '')  # COPY rejects NUL bytes in text
+    return '"' + value.replace('"', '""') + '"'
+
+
+def copy_rows(cursor, table, columns, rows):
+    """``COPY`` ``rows`` into ``table`` from an in-memory CSV buffer."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(map(_csv_field, row)))
+        buffer.write('\n')
+    buffer.seek(0)
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    started_at = time.monotonic()
+    cursor.copy_expert(sql, buffer)
+    # copy_expert goes around Django's cursor wrapper, so log it the way the wrapper logs execute()
+    if connection.queries_logged:
+        connection.queries_log.append({'sql': sql, 'time': f"{time.monotonic() - started_at:.3f}"})
+
+
+def _staging(cursor, *tables):
+    """Create the staging tables once per connection and empty them."""
+    for table in tables:
+        cursor.execute(_STAGING_TABLES[table])
+    cursor.execute(f"TRUNCATE {', '.join(tables)}")
+
+
+def _upsert(table, columns, source, returning=''):
+    """
+    ``INSERT ... ON CONFLICT (id) DO UPDATE`` of ``source`` into ``table``, skipping rows whose hash matches.
+
+    ``source`` selects ``columns`` with at most one row per id. Returns the
+    statement text; it yields one ``(inserted, updated, merged, updated_ids)``
+    row, where ``merged`` counts the source rows. ``returning`` adds
+    data-modifying CTEs that can use ``upserted(id, inserted)``.
+    """
+    updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column != 'id')
+    return f"""
+        WITH source AS ({source}), upserted AS (
+            INSERT INTO {table} AS target ({', '.join(columns)}, created_at, updated_at, is_active)
+            SELECT {', '.join(columns)}, now(), now(), true FROM source
+            ON CONFLICT (id) DO UPDATE SET {updates}, updated_at = EXCLUDED.updated_at
+            WHERE target.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+            RETURNING target.id, (target.xmax = 0) AS inserted
+        ){returning}
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted), (SELECT count(*) FROM source),
+               coalesce(array_agg(id) FILTER (WHERE NOT inserted), '{{}}')
+        FROM upserted
+    """
+
+
+def load_books(books, book_authors, upsert=False):
+    """
+    Merge a batch of book rows (in ``BOOK_COLUMNS`` order) and ``(book_id, author_id)`` links.
+
+    Must run inside a transaction; the staging rows are dropped on commit.
+    Books whose id or ISBN already exists are skipped, and links are only
+    written for books and authors that exist. Authors whose record lists a
+    book (``AuthorBookRef``) are linked to it as well.
+
+    With ``upsert``, existing books whose hash changed are updated and their
+    author links replaced, and ``{'inserted', 'updated', 'unchanged',
+    'skipped'}`` counts are returned. Inserted and updated books get a
+    ``BookChange`` entry, as saves through the model do, and the cached
+    recommendations of updated books are dropped once the batch commits. ``ON CONFLICT (id)`` does not cover the
+    unique ISBN, so books whose ISBN belongs to another book, or to an
+    earlier book of the same batch, are skipped.
+    """
+    book_table = Book._meta.db_table
+    through = Book.authors.through._meta.db_table
+    counts = None
+    with connection.cursor() as cursor:
+        _staging(cursor, 'import_book', 'import_book_author')
+        copy_rows(cursor.cursor, 'import_book', BOOK_COLUMNS, books)
+        copy_rows(cursor.cursor, 'import_book_author', ('book_id', 'author_id'), book_authors)
+        if upsert:
+            cursor.execute("SELECT count(DISTINCT id) FROM import_book")
+            staged, = cursor.fetchone()
+            # One row per id, then one per ISBN (the first in file order), minus ISBNs other books own
+            cursor.execute(_upsert(book_table, BOOK_COLUMNS, f"""
+                SELECT DISTINCT ON (isbn) {', '.join(BOOK_COLUMNS)}
+                FROM (
+                    SELECT DISTINCT ON (id) * FROM import_book ORDER BY id, seq
+                ) staged
+                WHERE NOT EXISTS (SELECT 1 FROM {book_table} other WHERE other.isbn = staged.isbn AND other.id <> staged.id)
+                ORDER BY isbn, seq
+            """, returning=f""", unlinked AS (
+                DELETE FROM {through} link USING upserted
+                WHERE link.book_id = upserted.id AND NOT upserted.inserted
+            ), logged AS (
+                INSERT INTO {BookChange._meta.db_table} (book_id, operation, created_at)
+                SELECT id, CASE WHEN inserted THEN '{BookChange.CREATED}' ELSE '{BookChange.UPDATED}' END, now()
+                FROM upserted
+            )"""))
+            inserted, updated, merged, updated_ids = cursor.fetchone()
+            counts = {'inserted': inserted, 'updated': updated,
+                      'unchanged': merged - inserted - updated, 'skipped': staged - merged}
+            transaction.on_commit(lambda: invalidate_recommendations(updated_ids))
+        else:
+            cursor.execute(f"""
+                INSERT INTO {book_table} ({', '.join(BOOK_COLUMNS)}, created_at, updated_at, is_active)
+                SELECT DISTINCT ON (id) {', '.join(BOOK_COLUMNS)}, now(), now(), true
+                FROM import_book
+                ORDER BY id, seq
+                ON CONFLICT DO NOTHING
+            """)
+        cursor.execute(f"""
+            INSERT INTO {through} (book_id, author_id)
+            SELECT link.book_id, link.author_id
+            FROM import_book_author link
+            JOIN {book_table} book ON book.id = link.book_id
+            JOIN {Author._meta.db_table} author ON author.id = link.author_id
+            UNION
+            SELECT ref.book_id, ref.author_id
+            FROM import_book staged
+            JOIN {AuthorBookRef._meta.db_table} ref ON ref.book_id = staged.id
+            JOIN {book_table} book ON book.id = staged.id
+            ON CONFLICT DO NOTHING
+        """)
+    return counts
+
+
+def _listed(column):
+    """The elements of a staged jsonb list column as text; anything but an array yields no rows."""
+    return (f"CROSS JOIN LATERAL jsonb_array_elements_text("
+            f"CASE WHEN jsonb_typeof(staged.{column}) = 'array' THEN staged.{column} END) AS listed(id)")
+
+
+def load_authors(authors, upsert=False):
+    """
+    Merge a batch of author rows (in ``AUTHOR_COLUMNS`` order); existing authors are skipped.
+
+    The listed work and book ids are added to ``AuthorWork`` and
+    ``AuthorBookRef``, and listed books that exist are linked.
+
+    With ``upsert``, existing authors whose hash changed are updated (their
+    listed ids replaced) and ``{'inserted', 'updated', 'unchanged'}`` counts
+    are returned.
+    """
+    author_table = Author._meta.db_table
+    work_table = AuthorWork._meta.db_table
+    ref_table = AuthorBookRef._meta.db_table
+    source = f"SELECT DISTINCT ON (id) {', '.join(AUTHOR_COLUMNS)} FROM import_author ORDER BY id, seq"
+    counts = None
+    with connection.cursor() as cursor:
+        _staging(cursor, 'import_author')
+        copy_rows(cursor.cursor, 'import_author', AUTHOR_COLUMNS, authors)
+        if upsert:
+            cursor.execute(_upsert(author_table, AUTHOR_COLUMNS, source, returning=f""", unlisted_works AS (
+                DELETE FROM {work_table} work USING upserted
+                WHERE work.author_id = upserted.id AND NOT upserted.inserted
+            ), unlisted_books AS (
+                DELETE FROM {ref_table} ref USING upserted
+                WHERE ref.author_id = upserted.id AND NOT upserted.inserted
+            )"""))
+            inserted, updated, merged, _ = cursor.fetchone()
+            counts = {'inserted': inserted, 'updated': updated, 'unchanged': merged - inserted - updated}
+        else:
+            cursor.execute(f"""
+                INSERT INTO {author_table} ({', '.join(AUTHOR_COLUMNS)}, created_at, updated_at, is_active)
+                SELECT {', '.join(AUTHOR_COLUMNS)}, now(), now(), true FROM ({source}) source
+                ON CONFLICT DO NOTHING
+            """)
+        # Unchanged rows only cost an index probe here; nothing is written for them
+        cursor.execute(f"""
+            INSERT INTO {work_table} (author_id, work_id)
+            SELECT DISTINCT staged.id, listed.id FROM import_author staged {_listed('work_ids')}
+            ON CONFLICT DO NOTHING
+        """)
+        cursor.execute(f"""
+            INSERT INTO {ref_table} (author_id, book_id)
+            SELECT DISTINCT staged.id, listed.id FROM import_author staged {_listed('book_ids')}
+            ON CONFLICT DO NOTHING
+        """)
+        cursor.execute(f"""
+            INSERT INTO {Book.authors.through._meta.db_table} (book_id, author_id)
+            SELECT DISTINCT book.id, staged.id
+            FROM import_author staged {_listed('book_ids')}
+            JOIN {Book._meta.db_table} book ON book.id = listed.id
+            ON CONFLICT DO NOTHING
+        """)
+    return counts
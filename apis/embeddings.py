@@ -0,0 +1,124 @@
+"""
+Stored book embeddings, keyed by a hash of the text and model that produced them.
+
+Index builds look up the stored hash for each book and only send books
+whose description (or the model) changed since the last build to the
+encoder; every other vector is read back from ``BookEmbedding``.
+"""
+import hashlib
+
+import numpy as np
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apis.models import BookEmbedding
+
+
+def content_hash(text, model_name):
+    """sha256 of the model name and the exact text handed to the encoder."""
+    return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+
+def split_stale(book_ids, texts, model_name):
+    """
+    Sort a batch into vectors that can be reused and books that need encoding.
+
+    Returns ``(reused, stale)``: ``reused`` maps book id to its stored float32
+    vector, ``stale`` maps book id to the hash of its current text.
+    """
+    hashes = {book_id: content_hash(text, model_name) for book_id, text in zip(book_ids, texts)}
+    stored = BookEmbedding.objects.filter(book_id__in=book_ids).values_list('book_id', 'content_hash', 'vector')
+    reused = {
+        book_id: np.frombuffer(vector, dtype=np.float32)
+        for book_id, stored_hash, vector in stored
+        if hashes.get(book_id) == stored_hash
+    }
+    stale = {book_id: book_hash for book_id, book_hash in hashes.items() if book_id not in reused}
+    return reused, stale
+
+
+def save_embeddings(book_ids, hashes, vectors, model_name, page_size=1000):
+    """
+    Store (or replace) the vectors for ``book_ids``; ``hashes`` maps id to content hash.
+
+    On PostgreSQL this is a multi-row ``INSERT ... ON CONFLICT DO UPDATE``,
+    ``page_size`` rows per statement.
+    """
+    if not len(book_ids):
+        return
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if connection.vendor != 'postgresql':
+        rows = [
+            BookEmbedding(book_id=book_id, model_name=model_name, content_hash=hashes[book_id], vector=vector.tobytes())
+            for book_id, vector in zip(book_ids, vectors)
+        ]
+        with transaction.atomic():
+            BookEmbedding.objects.filter(book_id__in=book_ids).delete()
+            BookEmbedding.objects.bulk_create(rows)
+        return
+
+    from psycopg2.extras import execute_values
+    now = timezone.now()
+    rows = [
+        (book_id, model_name, hashes[book_id], vector.tobytes(), now)
+        for book_id, vector in zip(book_ids, vectors)
+    ]
+    sql = f"""
+        INSERT INTO {BookEmbedding._meta.db_table} (book_id, model_name, content_hash, vector, updated_at)
+        VALUES %s
+        ON CONFLICT (book_id) DO UPDATE SET
+            model_name = EXCLUDED.model_name,
+            content_hash = EXCLUDED.content_hash,
+            vector = EXCLUDED.vector,
+            updated_at = EXCLUDED.updated_at
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        execute_values(cursor.cursor, sql, rows, page_size=page_size)
+
+
+def read_vectors(after=None, limit=10000, model_name=None):
+    """
+    ``(book_ids, vectors)`` for up to ``limit`` stored embeddings after ``after``, in id order.
+
+    With ``model_name`` set, only vectors computed by that model are read.
+
+    PostgreSQL concatenates the vectors into a single ``bytea`` value, which
+    NumPy wraps as a float32 matrix without copying it. Returns ``([], None)``
+    once there are no rows left.
+    """
+    table = BookEmbedding._meta.db_table
+    conditions, params = [], []
+    if after is not None:
+        conditions.append('book_id > %s')
+        params.append(after)
+    if model_name is not None:
+        conditions.append('model_name = %s')
+        params.append(model_name)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    params.append(limit)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f"""
+                SELECT array_agg(book_id ORDER BY book_id), string_agg(vector, ''::bytea ORDER BY book_id)
+                FROM (SELECT book_id, vector FROM {table} {where} ORDER BY book_id LIMIT %s) page
+            """, params)
+            book_ids, data = cursor.fetchone()
+        else:
+            cursor.execute(f"SELECT book_id, vector FROM {table} {where} ORDER BY book_id LIMIT %s", params)
+            rows = cursor.fetchall()
+            book_ids = [book_id for book_id, _ in rows]
+            data = b''.join(bytes(vector) for _, vector in rows)
+    if not book_ids:
+        return [], None
+    return book_ids, np.frombuffer(data, dtype=np.float32).reshape(len(book_ids), -1)
+
+
+def iter_vectors(chunk_size=10000, model_name=None):
+    """Stream every stored embedding as ``(book_ids, vectors)`` chunks, using keyset pagination."""
+    after = None
+    while True:
+        book_ids, vectors = read_vectors(after, chunk_size, model_name)
+        if not book_ids:
+            return
+        yield book_ids, vectors
+        after = book_ids[-1]
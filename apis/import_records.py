@@ -0,0 +1,82 @@
+"""
+Turn parsed JSONL items into the plain rows the importers write.
+
+These run in the parser processes, so they only use the standard library.
+Row tuples follow ``copy_loader.BOOK_COLUMNS`` and ``AUTHOR_COLUMNS``.
+"""
+import hashlib
+import json
+import re
+from datetime import date
+
+_DATE = re.compile(r'(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?')
+
+
+def parse_date(date_str):
+    """Parse ``YYYY-MM-DD``, ``YYYY-MM`` or ``YYYY`` (missing parts are 1). Returns None if parsing fails."""
+    if not date_str:
+        return None
+    match = _DATE.fullmatch(date_str)
+    if match is None:
+        return None
+    year, month, day = match.groups()
+    try:
+        return date(int(year), int(month or 1), int(day or 1))
+    except ValueError:
+        return None
+
+
+def row_hash(*values):
+    """md5 of the record's values, stored as ``content_hash`` so an upsert can tell unchanged rows apart."""
+    return hashlib.md5(json.dumps(values, default=str).encode()).hexdigest()
+
+
+def book_record(item):
+    """``(book row, [(book_id, author_id), ...])`` for one line of books.json."""
+    book_id = item.get('id')
+    links = [
+        (book_id, author_data.get('id'))
+        for author_data in item.get('authors', [])
+        if author_data.get('id')
+    ]
+    row = (
+        book_id,
+        item.get('title'),
+        parse_date(item.get('publication_date', '')),
+        item.get('isbn13', '') or item.get('isbn', ''),
+        item.get('description', ''),
+    )
+    # The authors are part of the hash, so a changed author list counts as a change
+    return (*row, row_hash(*row[1:], sorted(author_id for _, author_id in links))), links
+
+
+def book_item(row, author_ids):
+    """The books.json line that ``book_record`` turns into ``row``, so a dead-lettered book can be imported again."""
+    book_id, title, published_date, isbn, description, _ = row
+    return {
+        'id': book_id,
+        'title': title,
+        'publication_date': published_date.isoformat() if published_date else '',
+        'isbn13': isbn,
+        'description': description,
+        'authors': [{'id': author_id} for author_id in author_ids],
+    }
+
+
+# authors.json keys in copy_loader.AUTHOR_COLUMNS order, with their defaults
+AUTHOR_FIELDS = (
+    ('id', None), ('name', None), ('gender', ''), ('image_url', ''), ('about', ''), ('ratings_count', 0),
+    ('average_rating', 0.0), ('text_reviews_count', 0), ('work_ids', []), ('book_ids', []),
+    ('works_count', 0), ('fans_count', 0),
+)
+
+
+def author_record(item):
+    """Author row for one line of authors.json."""
+    row = tuple(item.get(key, default) for key, default in AUTHOR_FIELDS)
+    return (*row, row_hash(*row[1:]))
+
+
+def author_item(row):
+    """The authors.json line that ``author_record`` turns into ``row``."""
+    return {key: value for (key, _), value in zip(AUTHOR_FIELDS, row)}
@@ -0,0 +1,118 @@
+"""
+Checkpoints and dead letters for the JSONL importers.
+
+The input is read in byte ranges (see ``common.jsonl_reader``). Once every
+record of a range has been committed, the end of that range is saved in
+``ImportCheckpoint`` within the same transaction as the batch that completed
+it, so ``--resume`` restarts exactly after committed data. The writes are
+idempotent (conflicts are skipped or upserted), so re-reading the part of a
+range that was already written is harmless.
+
+Lines that cannot be parsed and records that the database rejects are
+appended to a dead-letter JSONL file instead of stopping the import. Lines
+are written as they were read, and records as the JSON item they were
+parsed from plus an ``_error`` key, so the file can be fixed up and fed to
+the same command again.
+"""
+import hashlib
+import json
+import os
+from collections import deque
+
+from django.db import transaction
+from django.utils import timezone
+
+from apis.models import ImportCheckpoint
+
+_SAMPLE_BYTES = 2 ** 20
+
+
+def file_fingerprint(path):
+    """sha256 over the file size and its first and last MB: cheap, and changes whenever the file is replaced."""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(_SAMPLE_BYTES))
+        if size > _SAMPLE_BYTES:
+            f.seek(max(size - _SAMPLE_BYTES, _SAMPLE_BYTES))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ImportRun:
+    def __init__(self, command, file_path, resume=False, dead_letter_path=None):
+        self.file_path = file_path
+        self.dead_letter_path = dead_letter_path or f"{file_path}.failed.jsonl"
+        self.dead_letters = 0
+        self.checkpoint, _ = ImportCheckpoint.objects.get_or_create(
+            command=command, fingerprint=file_fingerprint(file_path), defaults={'file_path': file_path},
+        )
+        if not resume:
+            self.checkpoint.offset = 0
+            self.checkpoint.completed = False
+            self.checkpoint.save()
+        # (records received up to and including this range, range end offset)
+        self._ranges = deque()
+        self._received = 0
+        self._handled = 0
+
+    @property
+    def start_offset(self):
+        return self.checkpoint.offset
+
+    @property
+    def completed(self):
+        return self.checkpoint.completed
+
+    def range_read(self, end, record_count):
+        self._received += record_count
+        self._ranges.append((self._received, end))
+
+    def batch_done(self, record_count):
+        """
+        Count a written (or dead-lettered) batch and advance the checkpoint past finished ranges.
+
+        Call inside the batch's transaction so the offset commits with the data.
+        The counters here only move once that transaction has committed, so a
+        batch whose commit fails can be reported again without being counted twice.
+        """
+        handled = self._handled + record_count
+        finished = 0
+        offset = None
+        for received, end in self._ranges:
+            if received > handled:
+                break
+            finished += 1
+            offset = end
+        if offset is not None:
+            ImportCheckpoint.objects.filter(pk=self.checkpoint.pk).update(offset=offset, updated_at=timezone.now())
+
+        def committed():
+            self._handled = handled
+            for _ in range(finished):
+                self._ranges.popleft()
+            if offset is not None:
+                self.checkpoint.offset = offset
+
+        transaction.on_commit(committed)
+
+    def dead_letter_lines(self, failures):
+        """Record the original text of ``(line, error)`` pairs for lines that could not be parsed."""
+        self._dead_letter(line for line, _ in failures)
+
+    def dead_letter_records(self, items, error):
+        """Record JSON items whose records the database rejected."""
+        self._dead_letter(json.dumps({**item, '_error': error}, default=str) for item in items)
+
+    def _dead_letter(self, lines):
+        with open(self.dead_letter_path, 'a') as f:
+            for line in lines:
+                f.write(line + '\n')
+                self.dead_letters += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        self.batch_done(0)
+        self.checkpoint.completed = True
+        self.checkpoint.save(update_fields=['completed', 'updated_at'])
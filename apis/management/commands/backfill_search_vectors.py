@@ -0,0 +1,43 @@
+import time
+
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from apis.models import Book
+from apis.search import SEARCH_CONFIG
+
+
+class Command(BaseCommand):
+    help = ('Fill Book.tsv_title and tsv_description in id-ordered chunks, one UPDATE per chunk. '
+            'New and edited books are kept up to date by a database trigger.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every book, not only those with a missing vector')
+
+    def handle(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size']
+        books = Book.objects.order_by('id')
+        if not kwargs['all']:
+            books = books.filter(Q(tsv_title__isnull=True) | Q(tsv_description__isnull=True))
+
+        updated = 0
+        last_id = None
+        started_at = time.perf_counter()
+        # Page on the primary key; each chunk commits on its own, so an interrupted run just continues
+        while True:
+            chunk = books if last_id is None else books.filter(id__gt=last_id)
+            ids = list(chunk.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            updated += Book.objects.filter(id__in=ids).update(
+                tsv_title=SearchVector('title', config=SEARCH_CONFIG),
+                tsv_description=SearchVector('description', config=SEARCH_CONFIG),
+            )
+            last_id = ids[-1]
+            elapsed = time.perf_counter() - started_at
+            self.stdout.write(f"Updated {updated} books ({updated / elapsed:.0f} books/sec)")
+
+        self.stdout.write(self.style.SUCCESS(f"Search vectors filled for {updated} books"))
@@ -0,0 +1,123 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.encoder_service import EncoderClient, load_model
+
+WORDS = (
+    "a young wizard discovers a hidden world of magic while a detective in victorian london "
+    "investigates a series of murders and a family saga spans three generations on a farm"
+).split()
+
+
+def sample_descriptions(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [' '.join(rng.choice(WORDS, size=rng.integers(20, 120))) for _ in range(count)]
+
+
+def _worker(number, mode, socket_path, model_name, torch_threads, texts, barrier, results):
+    try:
+        if mode == 'local':
+            model = load_model(model_name, torch_threads)
+            encode = model.encode
+        else:
+            encode = EncoderClient(socket_path).encode
+        encode(["warm up"])
+        barrier.wait()
+        latencies = []
+        for text in texts:
+            start = time.perf_counter()
+            encode([text])
+            latencies.append(time.perf_counter() - start)
+    except threading.BrokenBarrierError:
+        results.put((number, None, "gave up waiting for the other workers to start"))
+    except Exception as e:
+        barrier.abort()  # release the others instead of leaving them waiting for this worker
+        results.put((number, None, f"{type(e).__name__}: {e}"))
+    else:
+        results.put((number, latencies, None))
+
+
+class Command(BaseCommand):
+    help = 'Load-test description encoding: a model per worker process against the shared micro-batching sidecar.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['local', 'sidecar'], nargs='+', default=['local', 'sidecar'])
+        parser.add_argument('--socket', default=settings.RECOMMENDER.get('ENCODER_SOCKET') or '/tmp/book-encoder.sock')
+        parser.add_argument('--concurrency', type=int, default=8, help='Simulated web worker processes')
+        parser.add_argument('--requests', type=int, default=400, help='Total single-description requests')
+        parser.add_argument('--torch-threads', type=int, default=None,
+                            help='torch threads per worker in local mode (default: torch picks, as today)')
+        parser.add_argument('--timeout', type=float, default=600,
+                            help='Seconds to wait for the workers of each mode to start and to finish')
+
+    def handle(self, *args, **kwargs):
+        concurrency = kwargs['concurrency']
+        texts = sample_descriptions(kwargs['requests'])
+        per_worker = [texts[i::concurrency] for i in range(concurrency)]
+
+        for mode in kwargs['mode']:
+            barrier = multiprocessing.Barrier(concurrency + 1)
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=_worker, args=(
+                    number, mode, kwargs['socket'], settings.RECOMMENDER['MODEL_NAME'], kwargs['torch_threads'],
+                    chunk, barrier, results,
+                ))
+                for number, chunk in enumerate(per_worker)
+            ]
+            for worker in workers:
+                worker.start()
+            try:
+                barrier.wait(timeout=kwargs['timeout'])
+            except threading.BrokenBarrierError:
+                pass  # a worker failed or is too slow to start; each one reports why below
+            start = time.perf_counter()
+            latencies, failures = self._collect(workers, results, kwargs['timeout'])
+            elapsed = time.perf_counter() - start
+            for number, worker in enumerate(workers):
+                if number in failures and worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+            for number, error in sorted(failures.items()):
+                self.stderr.write(self.style.ERROR(f"{mode}: worker {number} failed: {error}"))
+            if not latencies:
+                continue
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            self.stdout.write(
+                f"{mode:<8} {len(latencies) / elapsed:>8.1f} req/s  "
+                f"p50 {p50:.1f} ms  p95 {p95:.1f} ms  p99 {p99:.1f} ms"
+                + (f"  ({len(workers) - len(failures)} of {len(workers)} workers)" if failures else "")
+            )
+
+    def _collect(self, workers, results, timeout):
+        """Latencies of the workers that finished within ``timeout``, and an error for each that did not."""
+        deadline = time.monotonic() + timeout
+        latencies, failures = [], {}
+        pending = set(range(len(workers)))
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                failures.update((number, f"no result after {timeout:g}s") for number in pending)
+                break
+            # A worker that had exited before the get below has already flushed anything it put
+            exited = {number for number in pending if not workers[number].is_alive()}
+            try:
+                number, worker_latencies, error = results.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                for number in exited:
+                    failures[number] = f"exited with code {workers[number].exitcode} without a result"
+                pending -= exited
+                continue
+            pending.discard(number)
+            if error:
+                failures[number] = error
+            else:
+                latencies.extend(worker_latencies)
+        return latencies, failures
@@ -0,0 +1,74 @@
+import io
+import json
+import os
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from apis import copy_loader
+from apis.models import Author, Book
+
+
+def write_synthetic_books(path, num_books, num_authors, seed=0):
+    """A books JSONL file in the importbook format, each book by one to three of ``num_authors`` authors."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for i in range(num_books):
+            authors = rng.choice(num_authors, size=rng.integers(1, 4), replace=False)
+            f.write(json.dumps({
+                'id': f"bench-{i}",
+                'title': f"Benchmark book {i}",
+                'authors': [{'id': f"bench-author-{author}", 'role': ''} for author in authors],
+                'publication_date': f"{1900 + i % 120}-{1 + i % 12:02d}" if i % 3 else str(1900 + i % 120),
+                'isbn13': f"bench-{i:013d}",
+                'description': f"A synthetic description of benchmark book {i}.",
+            }) + '\n')
+
+
+class Command(BaseCommand):
+    help = ('Time importbook on a synthetic JSONL catalogue and report queries per batch and rows/sec. '
+            'Everything is written inside a transaction that is rolled back at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100000)
+        parser.add_argument('--authors', type=int, default=20000)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--loader', choices=['copy', 'orm'], default=None)
+        parser.add_argument('--workers', type=int, default=max(1, cpu_count() - 1), help='Parser processes')
+
+    def handle(self, *args, **kwargs):
+        num_books = kwargs['books']
+        loader = kwargs['loader'] or ('copy' if copy_loader.is_available() else 'orm')
+        batch_size = kwargs['batch_size'] or (50000 if loader == 'copy' else 1000)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'books.jsonl')
+            write_synthetic_books(path, num_books, kwargs['authors'])
+            self.stdout.write(f"{num_books} synthetic books by {kwargs['authors']} authors, "
+                              f"{loader} loader, batches of {batch_size}, {kwargs['workers']} parser processes")
+
+            with transaction.atomic():
+                Author.objects.bulk_create(
+                    [Author(id=f"bench-author-{i}", name=f"Author {i}") for i in range(kwargs['authors'])],
+                    batch_size=5000,
+                )
+                with CaptureQueriesContext(connection) as queries:
+                    started_at = time.perf_counter()
+                    call_command('importbook', path, batch_size=batch_size, loader=loader,
+                                 workers=kwargs['workers'], stdout=io.StringIO())
+                    elapsed = time.perf_counter() - started_at
+                books = Book.objects.filter(id__startswith='bench-').count()
+                links = Book.authors.through.objects.filter(book_id__startswith='bench-').count()
+                transaction.set_rollback(True)
+
+        batches = -(-num_books // batch_size)
+        self.stdout.write(f"Imported {books} books and {links} author links in {elapsed:.1f}s")
+        # copy_loader logs its COPY statements with the rest; count them apart so the two loaders compare fairly
+        copies = sum(query['sql'].startswith('COPY ') for query in queries.captured_queries)
+        self.stdout.write(f"Queries per batch: {len(queries) / batches:.1f} ({copies / batches:.1f} of them COPY)")
+        self.stdout.write(f"Rows/sec: {(books + links) / elapsed:.0f} ({books / elapsed:.0f} books/sec)")
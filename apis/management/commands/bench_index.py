@@ -0,0 +1,97 @@
+import time
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from common.vector_index import create_index, index_memory_bytes, sample_rows, set_search_params, train_index
+
+
+def synthetic_vectors(num_vectors, dimension, seed=0, num_clusters=1000):
+    """Clustered Gaussian vectors, closer to sentence embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((num_clusters, dimension), dtype=np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    vectors = centres[labels] + 0.5 * rng.standard_normal((num_vectors, dimension), dtype=np.float32)
+    return vectors.astype(np.float32)
+
+
+def recall_at_k(found, expected):
+    k = expected.shape[1]
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found, expected))
+    return hits / (len(expected) * k)
+
+
+class Command(BaseCommand):
+    help = ('Report recall@k, search latency and memory per book of FAISS index types and compressions '
+            'against the exact flat index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vectors', help='.npy file of float32 book vectors (default: synthetic)')
+        parser.add_argument('--num-vectors', type=int, default=200000)
+        parser.add_argument('--dimension', type=int, default=384)
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--train-size', type=int, default=100000)
+        parser.add_argument('--nprobe', type=int, default=16)
+        parser.add_argument('--ef-search', type=int, default=64)
+        parser.add_argument('--search-threads', type=int, default=1,
+                            help='FAISS OpenMP threads while searching; 1 matches one request per worker')
+        parser.add_argument('--specs', nargs='+', default=[
+            'Flat', 'SQfp16', 'SQ8', 'PQ48', 'PCA128,Flat', 'PCA128,SQ8',
+            'IVF1024,Flat', 'IVF1024,SQ8', 'HNSW32', 'IVF1024,PQ48',
+        ])
+
+    def handle(self, *args, **kwargs):
+        k = kwargs['k']
+        build_threads = faiss.omp_get_max_threads()
+
+        if kwargs['vectors']:
+            vectors = np.load(kwargs['vectors'], mmap_mode='r')
+            source = kwargs['vectors']
+        else:
+            vectors = synthetic_vectors(kwargs['num_vectors'], kwargs['dimension'])
+            source = 'synthetic'
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        num_vectors, dimension = vectors.shape
+        queries = sample_rows(vectors, kwargs['queries'], seed=1)
+        queries = queries + 0.05 * np.random.default_rng(2).standard_normal(queries.shape, dtype=np.float32)
+
+        self.stdout.write(f"{num_vectors} vectors of dimension {dimension} ({source}), {len(queries)} queries, k={k}")
+
+        exact = faiss.IndexFlatL2(dimension)
+        exact.add(vectors)
+        _, expected = exact.search(queries, k)
+
+        self.stdout.write(
+            f"{'index':<20} {'build s':>8} {'recall@' + str(k):>9} {'p50 ms':>8} {'p99 ms':>8} "
+            f"{'memory MB':>10} {'bytes/book':>10}"
+        )
+        for spec in kwargs['specs']:
+            try:
+                index = create_index(spec, dimension)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+            faiss.omp_set_num_threads(build_threads)
+            start = time.perf_counter()
+            train_index(index, sample_rows(vectors, kwargs['train_size']))
+            index.add(vectors)
+            build_seconds = time.perf_counter() - start
+            set_search_params(index, nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'])
+
+            faiss.omp_set_num_threads(kwargs['search_threads'])
+            latencies = []
+            found = []
+            for query in queries:
+                start = time.perf_counter()
+                _, labels = index.search(query.reshape(1, -1), k)
+                latencies.append(time.perf_counter() - start)
+                found.append(labels[0])
+
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            memory_bytes = index_memory_bytes(index)
+            self.stdout.write(
+                f"{spec:<20} {build_seconds:>8.1f} {recall_at_k(found, expected):>9.3f} "
+                f"{p50:>8.3f} {p99:>8.3f} {memory_bytes / 2 ** 20:>10.1f} {memory_bytes / num_vectors:>10.0f}"
+            )
@@ -0,0 +1,61 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# What every manage.py command and web worker does at boot: set up Django and
+# import the API views (which import the recommender).
+LAZY_SNIPPET = """
+import django
+django.setup()
+import apis.views
+"""
+
+# The same boot with the recommender loaded up front. This is what every
+# process paid before the recommender became lazy.
+EAGER_SNIPPET = LAZY_SNIPPET + """
+from common.recommender import warm_up
+warm_up()
+"""
+
+
+class Command(BaseCommand):
+    help = 'Compare process startup time with a lazy and an eagerly loaded recommender.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Number of cold starts per mode')
+
+    def handle(self, *args, **kwargs):
+        runs = kwargs['runs']
+        env = {'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE}
+        for label, snippet in [('lazy (current)', LAZY_SNIPPET), ('eager (before)', EAGER_SNIPPET)]:
+            timings = []
+            for _ in range(runs):
+                elapsed, error = self._time_process(snippet, env)
+                if error:
+                    self.stderr.write(self.style.ERROR(f"{label}: process failed: {error}"))
+                    break
+                timings.append(elapsed)
+            if timings:
+                self.stdout.write(
+                    f"{label:<16} min {min(timings):.3f}s  "
+                    f"median {statistics.median(timings):.3f}s  max {max(timings):.3f}s"
+                )
+
+    def _time_process(self, snippet, env):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', snippet],
+            env={**os.environ, **env},
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            return elapsed, result.stderr.strip().splitlines()[-1]
+        return elapsed, None
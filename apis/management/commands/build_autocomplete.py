@@ -0,0 +1,24 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apis.autocomplete import Autocomplete
+
+
+class Command(BaseCommand):
+    help = 'Build the in-memory autocomplete index from the database and write it as a snapshot for web workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.AUTOCOMPLETE['SNAPSHOT_PATH'])
+        parser.add_argument('--top-k', type=int, default=settings.AUTOCOMPLETE.get('TOP_K', 10),
+                            help='Suggestions kept per prefix')
+
+    def handle(self, *args, **kwargs):
+        started_at = time.perf_counter()
+        autocomplete = Autocomplete.from_database(kwargs['top_k'])
+        autocomplete.save(kwargs['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {len(autocomplete.books)} books and {len(autocomplete.authors)} authors "
+            f"in {time.perf_counter() - started_at:.1f}s; wrote {kwargs['output']}"
+        ))
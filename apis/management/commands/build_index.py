@@ -0,0 +1,87 @@
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.change_log import build_position_path, load_position, position_path, save_position
+from apis.embeddings import iter_vectors
+from common.build_shards import assemble_index, write_index_files
+from common.index_files import load_spooled_ids
+from common.vector_index import add_index_arguments, create_index, sample_rows, spec_from_options, train_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the serving index from already computed vectors, without loading the model.'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--from-store', action='store_true',
+                            help='Read the vectors stored in BookEmbedding for RECOMMENDER["MODEL_NAME"]')
+        source.add_argument('--from-shards', metavar='BUILD_DIR',
+                            help='Read the shards kept by export_data --keep-shards')
+        add_index_arguments(parser)
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Vectors read from the database, and added to the index, at a time')
+        parser.add_argument('--staging-path', default=os.path.join(settings.BASE_DIR, 'book_vectors.staging'),
+                            help='Raw float32 file the stored vectors are streamed into')
+
+    def handle(self, *args, **kwargs):
+        config = settings.RECOMMENDER
+        started_at = time.perf_counter()
+        try:
+            index_spec = spec_from_options(kwargs)
+            vectors_path = config['VECTORS_PATH']
+            if kwargs['from_shards']:
+                total = assemble_index(
+                    kwargs['from_shards'], index_spec, config['INDEX_PATH'], config['BOOK_IDS_PATH'],
+                    vectors_path=vectors_path, train_size=kwargs['train_size'],
+                    nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'],
+                )
+                position = load_position(build_position_path(kwargs['from_shards']))
+            else:
+                total = self._build_from_store(kwargs, index_spec, vectors_path)
+                # Stored vectors were computed at various times, so no log position covers them
+                position = None
+        except ValueError as e:
+            raise CommandError(str(e))
+        save_position(position_path(config['INDEX_PATH']), position)
+        self.stdout.write(self.style.SUCCESS(
+            f"Built a {index_spec} index of {total} books in {time.perf_counter() - started_at:.0f}s"
+        ))
+
+    def _build_from_store(self, kwargs, index_spec, vectors_path):
+        config = settings.RECOMMENDER
+        chunk_size = kwargs['chunk_size']
+        staging_path = kwargs['staging_path']
+        ids_path = f"{staging_path}.ids"
+        count = 0
+        dimension = None
+        try:
+            # Stream vectors and ids into flat files first: only one chunk is in
+            # memory, and the index is trained and filled from a consistent snapshot.
+            with open(staging_path, 'wb') as staging, open(ids_path, 'wb') as staged_ids:
+                for chunk_ids, vectors in iter_vectors(chunk_size, model_name=config['MODEL_NAME']):
+                    dimension = vectors.shape[1]
+                    staging.write(vectors.data)
+                    staged_ids.write(''.join(f"{book_id}\n" for book_id in chunk_ids).encode('utf-8'))
+                    count += len(chunk_ids)
+                    self.stdout.write(f"Staged {count} vectors...")
+            if not count:
+                raise CommandError(f"No vectors stored for {config['MODEL_NAME']}; run export_data or importembbed first")
+            book_ids = load_spooled_ids(ids_path, count)
+            vectors = np.memmap(staging_path, dtype=np.float32, mode='r', shape=(count, dimension))
+            index = create_index(index_spec, dimension)
+            train_index(index, sample_rows(vectors, kwargs['train_size']))
+            chunks = (vectors[start:start + chunk_size] for start in range(0, len(vectors), chunk_size))
+            return write_index_files(
+                index, chunks, book_ids, config['INDEX_PATH'], config['BOOK_IDS_PATH'],
+                vectors_path=vectors_path, nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'],
+            )
+        finally:
+            for path in (staging_path, ids_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
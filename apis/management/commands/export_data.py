@@ -1,101 +1,150 @@
 import os
+import shutil
+import time
 from django.core.management.base import BaseCommand
-import faiss
+from multiprocessing import cpu_count
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from multiprocessing import Pool, cpu_count
+from django.conf import settings
+from apis.change_log import (
+    build_position_path, current_position, earliest, load_position, position_path, save_position,
+)
+from apis.embeddings import content_hash, save_embeddings, split_stale
 from apis.models import Book
-import cProfile
-import pstats
+from common.build_shards import SHARD_OF_SQL, ShardWriter, assemble_index, shard_build_dir
+from common.embedding_pipeline import encode_pipeline
+from common.vector_index import add_index_arguments, spec_from_options
 
-CHECKPOINT_PATH = 'checkpoint.npy'
-INDEX_PATH = 'book_index.faiss'
-BOOK_IDS_PATH = 'book_ids.npy'
+BUILD_DIR = os.path.join(settings.BASE_DIR, 'index_build')
+INDEX_PATH = settings.RECOMMENDER['INDEX_PATH']
+BOOK_IDS_PATH = settings.RECOMMENDER['BOOK_IDS_PATH']
+VECTORS_PATH = settings.RECOMMENDER['VECTORS_PATH']
 
-def encode_in_batches(descriptions, model, batch_size=1000):
-    encoded = []
-    for i in range(0, len(descriptions), batch_size):
-        batch = descriptions[i:i + batch_size]
-        embeddings = model.encode(batch, convert_to_numpy=True)
-        encoded.append(embeddings)
-    return np.vstack(encoded)
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        add_index_arguments(parser)
+        parser.add_argument('--batch-size', type=int, default=10000, help='Books per pipeline batch')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Encoder processes (default: one per 2 cores)')
+        parser.add_argument('--torch-threads', type=int, default=None,
+                            help='torch threads per encoder process (default: cores / workers)')
+        parser.add_argument('--build-dir', default=BUILD_DIR,
+                            help='Where per-batch shards are checkpointed; an interrupted build resumes from here')
+        parser.add_argument('--fresh', action='store_true', help='Discard shards left by an earlier build')
+        parser.add_argument('--keep-shards', action='store_true', help='Keep the shards after the index is assembled')
+        parser.add_argument('--num-shards', type=int, default=1,
+                            help='Split the build into this many independent shards of the book ids')
+        parser.add_argument('--shard', type=int, default=None,
+                            help='Only encode this shard (0-based); combine the shards with merge_shards')
+        parser.add_argument('--reencode', action='store_true',
+                            help='Encode every description, ignoring stored embeddings with a matching hash')
+
     def handle(self, *args, **kwargs):
         try:
             print("Execution started...")
-            model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-            batch_size = 10000
-            num_workers = cpu_count()
-            print(f"Number of workers: {num_workers}")
-            pool = Pool(num_workers)
-
-            books_iterator = Book.objects.all().values('id', 'description').iterator(chunk_size=batch_size)
-            current_index = 0
-
-            if os.path.exists(CHECKPOINT_PATH):
-                checkpoint = np.load(CHECKPOINT_PATH, allow_pickle=True).item()
-                start_batch = checkpoint['batch_index']
-                all_book_ids = checkpoint['book_ids']
-                index = faiss.read_index(INDEX_PATH)
-                print(f"Resuming from batch {start_batch}...")
-            else:
-                start_batch = 0
-                all_book_ids = []
-                index = None
+            index_spec = spec_from_options(kwargs)
+            batch_size = kwargs['batch_size']
+            num_workers = kwargs['workers'] or max(1, cpu_count() // 2)
+            torch_threads = kwargs['torch_threads'] or max(1, cpu_count() // num_workers)
+            print(f"Encoder workers: {num_workers} x {torch_threads} torch threads")
+
+            num_shards = kwargs['num_shards']
+            shard = kwargs['shard']
+            build_dir = kwargs['build_dir']
+            if shard is not None:
+                if not 0 <= shard < num_shards:
+                    raise ValueError(f"--shard must be between 0 and {num_shards - 1}")
+                build_dir = shard_build_dir(build_dir, shard, num_shards)
+                print(f"Building shard {shard} of {num_shards} in {build_dir}")
+            elif num_shards != 1:
+                raise ValueError("--num-shards needs --shard")
+
+            if kwargs['fresh'] and os.path.isdir(build_dir):
+                shutil.rmtree(build_dir)
+            shards = ShardWriter(build_dir)
+            start_batch, last_id = shards.resume()
+            if last_id is None:
                 print("Starting from scratch...")
-
-            total_batches = 0
-
-            for i, book_batch in enumerate(self._batch(books_iterator, batch_size)):
-                current_index += 1
-                total_batches += 1
-                if i < start_batch:
-                    continue  # Skip already processed batches
-
-                descriptions = [book['description'] for book in book_batch]
-
-                print(f"Processing batch {i + 1}...")
-
-                profiler = cProfile.Profile()
-                profiler.enable()
-
-                embeddings = encode_in_batches(descriptions, model, batch_size=1000)
-
-                profiler.disable()
-                stats = pstats.Stats(profiler).sort_stats(pstats.SortKey.TIME)
-                stats.print_stats()
-
-                if index is None:
-                    dimension = embeddings.shape[1]
-                    index = faiss.IndexFlatL2(dimension)
-                    faiss.omp_set_num_threads(num_workers)
-                    print("FAISS index created...")
-
-                index.add(embeddings)
-
-                # Accumulate book IDs in memory
-                all_book_ids.extend([book['id'] for book in book_batch])
-
-                # Save checkpoint and book IDs after each batch
-                checkpoint = {'batch_index': i + 1, 'book_ids': all_book_ids}
-                np.save(CHECKPOINT_PATH, checkpoint)
-                np.save(BOOK_IDS_PATH, all_book_ids)
-                faiss.write_index(index, INDEX_PATH)
-
-                print(f"Batch {i + 1} processed and added to the FAISS index...")
-
-            pool.close()
-            pool.join()
-
-            # Save FAISS index and remove checkpoint file
-            faiss.write_index(index, INDEX_PATH)
-            os.remove(CHECKPOINT_PATH)
-            print(f"Execution completed with {total_batches} total batches.")
+                # Taken before any book is read; a resumed build keeps the position of its first run
+                save_position(build_position_path(build_dir), current_position())
+            else:
+                print(f"Resuming from batch {start_batch}, after book {last_id}...")
+
+            model_name = settings.RECOMMENDER['MODEL_NAME']
+            # Filled by the producer thread: batch_no -> (book_ids, reused vectors, hashes of stale books).
+            self._plans = {}
+            books_done = reused_count = recomputed_count = 0
+            started_at = time.perf_counter()
+            results = encode_pipeline(
+                self._stale_batches(batch_size, start_batch, last_id, model_name, kwargs['reencode'], shard, num_shards),
+                model_name,
+                num_workers,
+                torch_threads,
+            )
+            # Batches finish out of order; each is checkpointed as its own shard.
+            for i, encoded_ids, vectors in results:
+                book_ids, reused, stale = self._plans.pop(i)
+                if encoded_ids:
+                    save_embeddings(encoded_ids, stale, vectors, model_name)
+                    reused.update(zip(encoded_ids, vectors))
+                shards.write(i, book_ids, np.vstack([reused[book_id] for book_id in book_ids]))
+                books_done += len(book_ids)
+                reused_count += len(book_ids) - len(encoded_ids)
+                recomputed_count += len(encoded_ids)
+                rate = books_done / (time.perf_counter() - started_at)
+                print(f"Batch {i + 1} written ({rate:.0f} books/sec)...")
+
+            elapsed = time.perf_counter() - started_at
+            print(f"Embedded {books_done} books in {elapsed:.0f}s: "
+                  f"{reused_count} stored vectors reused, {recomputed_count} recomputed.")
+            shards.mark_complete()
+            if shard is not None:
+                print(f"Shard {shard} complete; run merge_shards --num-shards {num_shards} once every shard is.")
+                return
+
+            print(f"Assembling the {index_spec} index...")
+            total = assemble_index(
+                build_dir, index_spec, INDEX_PATH, BOOK_IDS_PATH,
+                vectors_path=VECTORS_PATH,
+                train_size=kwargs['train_size'], nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'],
+            )
+            save_position(position_path(INDEX_PATH), earliest([load_position(build_position_path(build_dir))]))
+            if not kwargs['keep_shards']:
+                shutil.rmtree(build_dir)
+            print(f"Execution completed: {total} books indexed.")
 
         except Exception as e:
             print(f"An error occurred: {e}")
 
+    def _description_batches(self, batch_size, start_batch, last_id, shard=None, num_shards=1):
+        """Stream ``(batch_no, ids, descriptions)`` in id order, after ``last_id``, through a server-side cursor."""
+        books = Book.objects.order_by('id')
+        if last_id is not None:
+            books = books.filter(id__gt=last_id)
+        if shard is not None:
+            books = books.extra(where=[SHARD_OF_SQL.format(column='id')], params=[num_shards, shard])
+        books = books.values_list('id', 'description').iterator(chunk_size=batch_size)
+        for i, book_batch in enumerate(self._batch(books, batch_size), start=start_batch):
+            yield i, [book_id for book_id, _ in book_batch], [description or '' for _, description in book_batch]
+
+    def _stale_batches(self, batch_size, start_batch, last_id, model_name, reencode, shard, num_shards):
+        """
+        Hand only the books without a valid stored embedding to the encoders.
+
+        The rest of each batch is remembered in ``self._plans`` so the shard
+        can be completed from stored vectors once the encoded part returns.
+        """
+        batches = self._description_batches(batch_size, start_batch, last_id, shard, num_shards)
+        for i, book_ids, descriptions in batches:
+            if reencode:
+                reused = {}
+                stale = {book_id: content_hash(text, model_name) for book_id, text in zip(book_ids, descriptions)}
+            else:
+                reused, stale = split_stale(book_ids, descriptions, model_name)
+            self._plans[i] = (book_ids, reused, stale)
+            stale_texts = [text for book_id, text in zip(book_ids, descriptions) if book_id in stale]
+            yield i, [book_id for book_id in book_ids if book_id in stale], stale_texts
+
     def _batch(self, iterator, batch_size):
         batch = []
         for item in iterator:
@@ -104,4 +153,4 @@ class Command(BaseCommand):
                 yield batch
                 batch = []
         if batch:
-            yield batch
\ No newline at end of file
+            yield batch
@@ -0,0 +1,27 @@
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.index_files import live_index_files, write_mmap_files
+
+
+class Command(BaseCommand):
+    help = 'Write the memory-mapped vectors and compact book ids used when RECOMMENDER["MMAP"] is on.'
+
+    def handle(self, *args, **kwargs):
+        config = settings.RECOMMENDER
+        try:
+            _, index_path, book_ids_path, _ = live_index_files(config['INDEX_PATH'], config['BOOK_IDS_PATH'])
+            index = faiss.read_index(index_path)
+            book_ids = np.load(book_ids_path)
+        except (OSError, RuntimeError) as e:
+            raise CommandError(f"Cannot read the book index: {e}")
+
+        if index.ntotal != len(book_ids):
+            raise CommandError(f"Index holds {index.ntotal} vectors but there are {len(book_ids)} book ids")
+
+        write_mmap_files(index, book_ids, config['INDEX_PATH'], config['BOOK_IDS_PATH'], config['VECTORS_PATH'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {index.ntotal} vectors to {config['VECTORS_PATH']} and compact ids to {config['BOOK_IDS_PATH']}"
+        ))
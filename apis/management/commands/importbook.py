@@ -1,8 +1,14 @@
-import json
+from collections import Counter
+from multiprocessing import cpu_count
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from apis.models import Author, Book
-from datetime import datetime
+from django.db import InterfaceError, OperationalError, transaction
+from django.utils import timezone
+from apis import copy_loader
+from apis.import_records import book_item, book_record
+from apis.import_runs import ImportRun
+from apis.models import Author, AuthorBookRef, Book, BookChange
+from common.jsonl_reader import iter_chunks
+from common.utils import invalidate_recommendations
 
 
 class Command(BaseCommand):
@@ -10,44 +16,53 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('file_path', type=str, help='The path to the JSON file to be imported')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Records per batch (default: 50000 with COPY, 1000 through the ORM)')
+        parser.add_argument('--loader', choices=['copy', 'orm'], default=None,
+                            help='copy streams batches through PostgreSQL COPY (the default on PostgreSQL); '
+                                 'orm uses bulk_create and works on any database')
+        parser.add_argument('--workers', type=int, default=max(1, cpu_count() - 1),
+                            help='Processes parsing the file; 1 parses in this process')
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update existing books whose content changed instead of skipping them; '
+                                 'books whose content hash matches are left untouched')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue after the last batch committed by an earlier run over the same file')
+        parser.add_argument('--dead-letter', default=None,
+                            help='Where unparseable lines and rejected records go (default: <file_path>.failed.jsonl)')
 
     def handle(self, *args, **kwargs):
         file_path = kwargs['file_path']
-        batch_size = 1000  # Process 1000 records per batch
+        self.use_copy = (kwargs['loader'] or ('copy' if copy_loader.is_available() else 'orm')) == 'copy'
+        batch_size = kwargs['batch_size'] or (50000 if self.use_copy else 1000)
+        self.upsert = kwargs['upsert']
+        self.counts = Counter()
         batch = []
         author_ids = set()
         book_authors = []
 
-        with open(file_path, 'r') as file:
-            try:
-                for line in file:
-                    item = json.loads(line.strip())
-
-                    # Extract data from the JSON object
-                    book_id = item.get('id')
-                    title = item.get('title')
-                    authors_data = item.get('authors', [])
-                    published_date = item.get('publication_date', '')
-                    isbn = item.get('isbn13', '') or item.get('isbn', '')
-                    description = item.get('description', '')
+        self.run = ImportRun('importbook', file_path, resume=kwargs['resume'], dead_letter_path=kwargs['dead_letter'])
+        if self.run.completed:
+            self.stdout.write(self.style.SUCCESS(f'{file_path} has already been imported'))
+            return
+        if self.run.start_offset:
+            self.stdout.write(f"Resuming {file_path} from byte {self.run.start_offset}")
 
+        try:
+            # Lines are parsed in worker processes and come back in file order
+            chunks = iter_chunks(file_path, book_record, workers=kwargs['workers'], start=self.run.start_offset)
+            for _, end, records, failures in chunks:
+                if failures:
+                    self.run.dead_letter_lines(failures)
+                self.run.range_read(end, len(records))
+                for row, links in records:
                     # Collect author IDs
-                    for author_data in authors_data:
-                        author_id = author_data.get('id')
-                        if author_id:
-                            author_ids.add(author_id)
-                            book_authors.append((book_id, author_id))
-
-                    # Add book to the batch
-                    batch.append(
-                        Book(
-                            id=book_id,
-                            title=title,
-                            published_date=self.parse_date(published_date),
-                            isbn=isbn,
-                            description=description
-                        )
-                    )
+                    for _, author_id in links:
+                        author_ids.add(author_id)
+                    book_authors.extend(links)
+
+                    # Add the book to the batch, in copy_loader.BOOK_COLUMNS order
+                    batch.append(row)
 
                     # Process the batch if it's full
                     if len(batch) >= batch_size:
@@ -56,51 +71,118 @@ class Command(BaseCommand):
                         author_ids.clear()  # Clear author IDs for the next set
                         book_authors.clear()  # Clear author mapping for the next set
 
-                # Process any remaining records in the batch
-                if batch:
-                    self._process_batch(batch, author_ids, book_authors)
-
-            except json.JSONDecodeError as e:
-                self.stderr.write(self.style.ERROR(f"Failed to decode JSON object: {e}"))
-            except Exception as e:
-                self.stderr.write(self.style.ERROR(f"An error occurred: {e}"))
+            # Process any remaining records in the batch
+            if batch:
+                self._process_batch(batch, author_ids, book_authors)
+            self.run.finish()
 
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"An error occurred: {e}; rerun with --resume to continue"))
+            return
+
+        if self.run.dead_letters:
+            self.stderr.write(self.style.WARNING(
+                f"{self.run.dead_letters} records could not be imported; see {self.run.dead_letter_path}"
+            ))
+        if self.upsert:
+            self.stdout.write(
+                f"{self.counts['inserted']} inserted, {self.counts['updated']} updated, "
+                f"{self.counts['unchanged']} unchanged, {self.counts['skipped']} skipped (ISBN used by another book)"
+            )
         self.stdout.write(self.style.SUCCESS(f'Data imported successfully from {file_path}'))
 
     def _process_batch(self, batch, author_ids, book_authors):
         try:
             with transaction.atomic():
-                # Create or update books in bulk
-                Book.objects.bulk_create(batch, ignore_conflicts=True)
-
-                # Fetch all authors
-                authors = Author.objects.filter(id__in=author_ids).values_list('id', flat=True)
-                author_dict = {author_id: Author.objects.get(pk=author_id) for author_id in authors}
-
-                # Update authors for books
-                for book_id, author_id in book_authors:
-                    if author_id in author_dict:
-                        book = Book.objects.get(pk=book_id)
-                        book.authors.add(author_dict[author_id])
-                        book.save()
-
+                if self.use_copy:
+                    counts = copy_loader.load_books(batch, book_authors, upsert=self.upsert)
+                elif self.upsert:
+                    counts = self._upsert(batch, author_ids, book_authors)
+                else:
+                    counts = self._bulk_create(batch, author_ids, book_authors)
+                # Committed together with the batch
+                self.run.batch_done(len(batch))
+            if counts:
+                self.counts.update(counts)
+
+        except (InterfaceError, OperationalError):
+            raise  # the database itself is failing, not the batch; rerun with --resume
         except Exception as e:
-            self.stderr.write(self.style.ERROR(f"Failed to process batch: {e}"))
-
-    def parse_date(self, date_str):
-        """Parse date string to a date object. Returns None if parsing fails."""
-        formats = ['%Y-%m-%d', '%Y-%m', '%Y']
-        for fmt in formats:
-            try:
-                if date_str:
-                    # If the date format is YYYY-MM, set day to 01
-                    if fmt == '%Y-%m' and len(date_str) == 7:
-                        return datetime.strptime(date_str + '-01', fmt + '-%d').date()
-                    # If the date format is YYYY, set month and day to 01
-                    elif fmt == '%Y' and len(date_str) == 4:
-                        return datetime.strptime(date_str + '-01-01', fmt + '-%m-%d').date()
-                    else:
-                        return datetime.strptime(date_str, fmt).date()
-            except ValueError:
-                continue
-        return None
+            if len(batch) == 1:
+                self.run.dead_letter_records([book_item(batch[0], [author_id for _, author_id in book_authors])], str(e))
+                self.run.batch_done(1)
+                return
+            # Retry the halves, down to the single rows the database rejects
+            self.stderr.write(self.style.ERROR(f"Failed to process a batch of {len(batch)}: {e}; retrying in halves"))
+            middle = len(batch) // 2
+            for half in (batch[:middle], batch[middle:]):
+                book_ids = {row[0] for row in half}
+                self._process_batch(half, author_ids, [link for link in book_authors if link[0] in book_ids])
+
+    def _bulk_create(self, batch, author_ids, book_authors):
+        # Create or update books in bulk
+        Book.objects.bulk_create(
+            [Book(**dict(zip(copy_loader.BOOK_COLUMNS, row))) for row in batch],
+            ignore_conflicts=True,
+        )
+
+        # Link only books that exist; a book can be skipped by ignore_conflicts (e.g. a duplicate ISBN)
+        existing_books = set(
+            Book.objects.filter(id__in={row[0] for row in batch}).values_list('id', flat=True)
+        )
+        self._link(existing_books, author_ids, book_authors)
+
+    def _upsert(self, batch, author_ids, book_authors):
+        """ORM version of copy_loader.load_books(upsert=True), for databases without COPY."""
+        rows = {}
+        for row in batch:
+            rows.setdefault(row[0], row)  # the first row wins for repeated ids
+        stored = dict(Book.objects.filter(id__in=rows).values_list('id', 'content_hash'))
+        isbn_owners = dict(Book.objects.filter(isbn__in={row[3] for row in rows.values()}).values_list('isbn', 'id'))
+        counts = Counter(inserted=0, updated=0, unchanged=0, skipped=0)
+        new_books, changed_books = [], []
+        now = timezone.now()
+        for book_id, row in rows.items():
+            # ISBNs are unique: skip one that another book owns, or that an earlier book in the batch took
+            if isbn_owners.setdefault(row[3], book_id) != book_id:
+                counts['skipped'] += 1
+            elif book_id not in stored:
+                new_books.append(Book(**dict(zip(copy_loader.BOOK_COLUMNS, row))))
+            elif stored[book_id] != row[-1]:
+                changed_books.append(Book(updated_at=now, **dict(zip(copy_loader.BOOK_COLUMNS, row))))
+            else:
+                counts['unchanged'] += 1
+
+        Book.objects.bulk_create(new_books)
+        # bulk_update skips auto_now, so updated_at is set above, and only on changed books
+        Book.objects.bulk_update(changed_books, [*copy_loader.BOOK_COLUMNS[1:], 'updated_at'])
+        counts['inserted'], counts['updated'] = len(new_books), len(changed_books)
+
+        # The author list is part of the hash: replace the links of changed books
+        changed_ids = {book.id for book in changed_books}
+        Book.authors.through.objects.filter(book_id__in=changed_ids).delete()
+        self._link(changed_ids | {book.id for book in new_books}, author_ids, book_authors)
+
+        # What the model signals would have done for these writes
+        BookChange.objects.bulk_create(
+            [BookChange(book_id=book.id, operation=BookChange.CREATED) for book in new_books]
+            + [BookChange(book_id=book.id, operation=BookChange.UPDATED) for book in changed_books]
+        )
+        transaction.on_commit(lambda: invalidate_recommendations(changed_ids))
+        return counts
+
+    def _link(self, book_ids, author_ids, book_authors):
+        """Link ``book_ids`` to their existing authors, and to authors whose record lists them."""
+        # Authors are imported separately, so some may not exist yet
+        existing_authors = set(Author.objects.filter(id__in=author_ids).values_list('id', flat=True))
+        links = {
+            (book_id, author_id)
+            for book_id, author_id in book_authors
+            if book_id in book_ids and author_id in existing_authors
+        }
+        links.update(AuthorBookRef.objects.filter(book_id__in=book_ids).values_list('book_id', 'author_id'))
+        BookAuthor = Book.authors.through
+        BookAuthor.objects.bulk_create(
+            [BookAuthor(book_id=book_id, author_id=author_id) for book_id, author_id in links],
+            ignore_conflicts=True,
+        )
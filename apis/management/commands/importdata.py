@@ -1,8 +1,14 @@
-import json
+from collections import Counter
+from multiprocessing import cpu_count
 
 from django.core.management.base import BaseCommand
-from apis.models import Author
-from django.db import transaction
+from apis import copy_loader
+from apis.import_records import author_item, author_record
+from apis.import_runs import ImportRun
+from apis.models import Author, AuthorBookRef, AuthorWork, Book
+from django.db import InterfaceError, OperationalError, transaction
+from django.utils import timezone
+from common.jsonl_reader import iter_chunks
 
 
 class Command(BaseCommand):
@@ -10,71 +16,160 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('file_path', type=str, help='The path to the JSON file to be imported')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Records per batch (default: 50000 with COPY, 1000 through the ORM)')
+        parser.add_argument('--loader', choices=['copy', 'orm'], default=None,
+                            help='copy streams batches through PostgreSQL COPY (the default on PostgreSQL); '
+                                 'orm uses bulk_create and works on any database')
+        parser.add_argument('--workers', type=int, default=max(1, cpu_count() - 1),
+                            help='Processes parsing the file; 1 parses in this process')
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update existing authors whose content changed instead of skipping them; '
+                                 'authors whose content hash matches are left untouched')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue after the last batch committed by an earlier run over the same file')
+        parser.add_argument('--dead-letter', default=None,
+                            help='Where unparseable lines and rejected records go (default: <file_path>.failed.jsonl)')
 
     def handle(self, *args, **kwargs):
         file_path = kwargs['file_path']
+        self.use_copy = (kwargs['loader'] or ('copy' if copy_loader.is_available() else 'orm')) == 'copy'
 
         # Initialize a list to batch process
-        batch_size = 1000  # Adjust batch size as needed
+        batch_size = kwargs['batch_size'] or (50000 if self.use_copy else 1000)
+        self.upsert = kwargs['upsert']
+        self.counts = Counter()
         batch = []
 
-        with open(file_path, 'r') as file:
-            try:
-                for line in file:
-                    # Load each line as a separate JSON object
-                    item = json.loads(line.strip())
-
-                    # Extract data from the JSON object
-                    author_id = item.get('id')
-                    name = item.get('name')
-                    gender = item.get('gender', '')
-                    image_url = item.get('image_url', '')
-                    about = item.get('about', '')
-                    ratings_count = item.get('ratings_count', 0)
-                    average_rating = item.get('average_rating', 0.0)
-                    text_reviews_count = item.get('text_reviews_count', 0)
-                    work_ids = item.get('work_ids', [])
-                    book_ids = item.get('book_ids', [])
-                    works_count = item.get('works_count', 0)
-                    fans_count = item.get('fans_count', 0)
-
-                    # Append to batch list
-                    batch.append(
-                        Author(
-                            id=author_id,
-                            name=name,
-                            gender=gender,
-                            image_url=image_url,
-                            about=about,
-                            ratings_count=ratings_count,
-                            average_rating=average_rating,
-                            text_reviews_count=text_reviews_count,
-                            work_ids=work_ids,
-                            book_ids=book_ids,
-                            works_count=works_count,
-                            fans_count=fans_count
-                        )
-                    )
+        self.run = ImportRun('importdata', file_path, resume=kwargs['resume'], dead_letter_path=kwargs['dead_letter'])
+        if self.run.completed:
+            self.stdout.write(self.style.SUCCESS(f'{file_path} has already been imported'))
+            return
+        if self.run.start_offset:
+            self.stdout.write(f"Resuming {file_path} from byte {self.run.start_offset}")
+
+        try:
+            # Lines are parsed in worker processes and come back in file order
+            chunks = iter_chunks(file_path, author_record, workers=kwargs['workers'], start=self.run.start_offset)
+            for _, end, records, failures in chunks:
+                if failures:
+                    self.run.dead_letter_lines(failures)
+                self.run.range_read(end, len(records))
+                for row in records:
+                    # Append to batch list, in copy_loader.AUTHOR_COLUMNS order
+                    batch.append(row)
 
                     # Process the batch if it's full
                     if len(batch) >= batch_size:
                         self._process_batch(batch)
                         batch = []  # Clear batch list for the next set
 
-                # Process any remaining records in the batch
-                if batch:
-                    self._process_batch(batch)
+            # Process any remaining records in the batch
+            if batch:
+                self._process_batch(batch)
+            self.run.finish()
 
-            except json.JSONDecodeError as e:
-                self.stderr.write(self.style.ERROR(f"Failed to decode JSON object: {e}"))
-            except Exception as e:
-                self.stderr.write(self.style.ERROR(f"An error occurred: {e}"))
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"An error occurred: {e}; rerun with --resume to continue"))
+            return
 
+        if self.run.dead_letters:
+            self.stderr.write(self.style.WARNING(
+                f"{self.run.dead_letters} records could not be imported; see {self.run.dead_letter_path}"
+            ))
+        if self.upsert:
+            self.stdout.write(
+                f"{self.counts['inserted']} inserted, {self.counts['updated']} updated, "
+                f"{self.counts['unchanged']} unchanged"
+            )
         self.stdout.write(self.style.SUCCESS(f'Data imported successfully from {file_path}'))
 
     def _process_batch(self, batch):
         try:
             with transaction.atomic():  # Ensure the operation is atomic
-                Author.objects.bulk_create(batch, ignore_conflicts=True)  # Use bulk_create to optimize database writes
+                if self.use_copy:
+                    counts = copy_loader.load_authors(batch, upsert=self.upsert)
+                elif self.upsert:
+                    counts = self._upsert(batch)
+                else:
+                    counts = None
+                    Author.objects.bulk_create(  # Use bulk_create to optimize database writes
+                        [Author(**dict(zip(copy_loader.AUTHOR_COLUMNS, row))) for row in batch],
+                        ignore_conflicts=True,
+                    )
+                if not self.use_copy:
+                    self._add_listed_ids(batch)
+                # Committed together with the batch
+                self.run.batch_done(len(batch))
+            if counts:
+                self.counts.update(counts)
+        except (InterfaceError, OperationalError):
+            raise  # the database itself is failing, not the batch; rerun with --resume
         except Exception as e:
-            self.stderr.write(self.style.ERROR(f"Failed to process batch: {e}"))
+            if len(batch) == 1:
+                self.run.dead_letter_records([author_item(batch[0])], str(e))
+                self.run.batch_done(1)
+                return
+            # Retry the halves, down to the single rows the database rejects
+            self.stderr.write(self.style.ERROR(f"Failed to process a batch of {len(batch)}: {e}; retrying in halves"))
+            middle = len(batch) // 2
+            self._process_batch(batch[:middle])
+            self._process_batch(batch[middle:])
+
+    def _upsert(self, batch):
+        """ORM version of copy_loader.load_authors(upsert=True), for databases without COPY."""
+        rows = {}
+        for row in batch:
+            rows.setdefault(row[0], row)  # the first row wins for repeated ids
+        stored = dict(Author.objects.filter(id__in=rows).values_list('id', 'content_hash'))
+        now = timezone.now()
+        new_authors = [
+            Author(**dict(zip(copy_loader.AUTHOR_COLUMNS, row)))
+            for author_id, row in rows.items() if author_id not in stored
+        ]
+        changed_authors = [
+            Author(updated_at=now, **dict(zip(copy_loader.AUTHOR_COLUMNS, row)))
+            for author_id, row in rows.items() if author_id in stored and stored[author_id] != row[-1]
+        ]
+        Author.objects.bulk_create(new_authors, ignore_conflicts=True)
+        # bulk_update skips auto_now, so updated_at is set above, and only on changed authors
+        Author.objects.bulk_update(changed_authors, [*copy_loader.AUTHOR_COLUMNS[1:], 'updated_at'])
+        # Their listed ids are written again by _add_listed_ids
+        changed_ids = [author.id for author in changed_authors]
+        AuthorWork.objects.filter(author_id__in=changed_ids).delete()
+        AuthorBookRef.objects.filter(author_id__in=changed_ids).delete()
+        return {
+            'inserted': len(new_authors),
+            'updated': len(changed_authors),
+            'unchanged': len(rows) - len(new_authors) - len(changed_authors),
+        }
+
+    def _add_listed_ids(self, batch):
+        """ORM version of the AuthorWork/AuthorBookRef writes in copy_loader.load_authors."""
+        works, refs = set(), set()
+        for row in batch:
+            author = dict(zip(copy_loader.AUTHOR_COLUMNS, row))
+            if isinstance(author['work_ids'], list):
+                works.update((author['id'], str(work_id)) for work_id in author['work_ids'])
+            if isinstance(author['book_ids'], list):
+                refs.update((author['id'], str(book_id)) for book_id in author['book_ids'])
+        AuthorWork.objects.bulk_create(
+            [AuthorWork(author_id=author_id, work_id=work_id) for author_id, work_id in works],
+            ignore_conflicts=True,
+        )
+        AuthorBookRef.objects.bulk_create(
+            [AuthorBookRef(author_id=author_id, book_id=book_id) for author_id, book_id in refs],
+            ignore_conflicts=True,
+        )
+
+        # Link the listed books that are already imported
+        existing_books = set(Book.objects.filter(id__in={book_id for _, book_id in refs}).values_list('id', flat=True))
+        BookAuthor = Book.authors.through
+        BookAuthor.objects.bulk_create(
+            [
+                BookAuthor(book_id=book_id, author_id=author_id)
+                for author_id, book_id in refs
+                if book_id in existing_books
+            ],
+            ignore_conflicts=True,
+        )
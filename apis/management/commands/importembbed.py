@@ -1,7 +1,9 @@
+import time
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from sentence_transformers import SentenceTransformer
-from apis.models import Book  # Replace 'your_app' with your actual app name
-import numpy as np
+from apis.embeddings import save_embeddings, split_stale
+from apis.models import Book
 
 
 class Command(BaseCommand):
@@ -12,32 +14,47 @@ class Command(BaseCommand):
 
     def create_book_embeddings(self, batch_size=1000):
         """
-        Generate book embeddings using a pre-trained model and update the database.
+        Generate embeddings for books whose description changed since they were last encoded.
         """
-        # Load pre-trained model
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Same model as the recommender, so stored vectors can be reused by export_data
+        model_name = settings.RECOMMENDER['MODEL_NAME']
+        model = SentenceTransformer(model_name)
 
         # Get the total count of books
         total_books = Book.objects.count()
         print(f"Total books: {total_books}")
 
-        # Generate embeddings in batches
-        for i in range(0, total_books, batch_size):
-            # Fetch a batch of books
-            batch = Book.objects.all()[i:i + batch_size]
-            descriptions = [book.description for book in batch if book.description]
-
-            if not descriptions:
-                continue
-
-            # Generate embeddings
-            embeddings = model.encode(descriptions, show_progress_bar=True)
-
-            # Update embeddings in the database
-            for book, embedding in zip(batch, embeddings):
-                book.embedding = embedding.tolist()  # Convert numpy array to list
-                book.save(update_fields=['embedding'])
-
-            print(f"Processed books from {i} to {i + len(batch) - 1}")
-
-        print("Finished generating embeddings for all books.")
+        processed = reused_count = recomputed_count = 0
+        write_seconds = 0.0
+        last_id = None
+        # Generate embeddings in batches, paging on the primary key rather than OFFSET
+        while True:
+            books = Book.objects.order_by('id')
+            if last_id is not None:
+                books = books.filter(id__gt=last_id)
+            batch = list(books.values_list('id', 'description')[:batch_size])
+            if not batch:
+                break
+            book_ids = [book_id for book_id, _ in batch]
+            descriptions = [description or '' for _, description in batch]
+
+            reused, stale = split_stale(book_ids, descriptions, model_name)
+            # Keep ids and texts paired so every vector lands on its own book
+            stale_ids = [book_id for book_id in book_ids if book_id in stale]
+            if stale_ids:
+                texts = [text for book_id, text in zip(book_ids, descriptions) if book_id in stale]
+                embeddings = model.encode(texts, show_progress_bar=True)
+                started_at = time.perf_counter()
+                save_embeddings(stale_ids, stale, embeddings, model_name)
+                write_seconds += time.perf_counter() - started_at
+
+            processed += len(batch)
+            reused_count += len(reused)
+            recomputed_count += len(stale_ids)
+            last_id = book_ids[-1]
+            print(f"Processed {processed} of {total_books} books (up to {last_id})")
+
+        print(f"Finished generating embeddings for all books: "
+              f"{reused_count} stored vectors reused, {recomputed_count} recomputed.")
+        if recomputed_count:
+            print(f"Wrote {recomputed_count / max(write_seconds, 1e-9):.0f} embeddings/sec.")
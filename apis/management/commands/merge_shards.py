@@ -0,0 +1,49 @@
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.change_log import build_position_path, earliest, load_position, position_path, save_position
+from apis.management.commands.export_data import BUILD_DIR
+from common.build_shards import assemble_index, is_complete, shard_build_dir
+from common.vector_index import add_index_arguments, spec_from_options
+
+
+class Command(BaseCommand):
+    help = 'Combine the shards written by export_data --shard i --num-shards N into one serving index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-shards', type=int, required=True)
+        parser.add_argument('--build-dir', default=BUILD_DIR,
+                            help='Directory holding the shard-<i>-of-<N> build directories')
+        add_index_arguments(parser)
+        parser.add_argument('--keep-shards', action='store_true', help='Keep the shards after the index is assembled')
+
+    def handle(self, *args, **kwargs):
+        num_shards = kwargs['num_shards']
+        build_dirs = [shard_build_dir(kwargs['build_dir'], shard, num_shards) for shard in range(num_shards)]
+        unfinished = [shard for shard, build_dir in enumerate(build_dirs) if not is_complete(build_dir)]
+        if unfinished:
+            raise CommandError(f"Shards not complete yet: {', '.join(map(str, unfinished))}")
+
+        config = settings.RECOMMENDER
+        started_at = time.perf_counter()
+        try:
+            index_spec = spec_from_options(kwargs)
+            total = assemble_index(
+                build_dirs, index_spec, config['INDEX_PATH'], config['BOOK_IDS_PATH'],
+                vectors_path=config['VECTORS_PATH'],
+                train_size=kwargs['train_size'], nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        save_position(position_path(config['INDEX_PATH']),
+                      earliest(load_position(build_position_path(build_dir)) for build_dir in build_dirs))
+        if not kwargs['keep_shards']:
+            for build_dir in build_dirs:
+                shutil.rmtree(build_dir)
+        self.stdout.write(self.style.SUCCESS(
+            f"Merged {num_shards} shards into a {index_spec} index of {total} books "
+            f"in {time.perf_counter() - started_at:.0f}s"
+        ))
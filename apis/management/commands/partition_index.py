@@ -0,0 +1,58 @@
+import os
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.build_shards import shard_of
+from common.index_files import atomic_save_npy, book_id_str, compact_book_ids, live_index_files
+from common.vector_index import empty_copy, enable_reconstruct
+
+
+class Command(BaseCommand):
+    help = 'Split the serving index into shards for run_shard_server, by the same book id hash as export_data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-shards', type=int, required=True)
+        parser.add_argument('--output-dir', default=os.path.join(settings.BASE_DIR, 'index_shards'))
+        parser.add_argument('--chunk-size', type=int, default=100000)
+
+    def handle(self, *args, **kwargs):
+        config = settings.RECOMMENDER
+        num_shards = kwargs['num_shards']
+        chunk_size = kwargs['chunk_size']
+        try:
+            # Mapped rather than read: the index is only streamed through, once per shard
+            _, index_path, book_ids_path, _ = live_index_files(config['INDEX_PATH'], config['BOOK_IDS_PATH'])
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            book_ids = np.load(book_ids_path, mmap_mode='r')
+        except (OSError, RuntimeError) as e:
+            raise CommandError(f"Cannot read the book index: {e}")
+        if index.ntotal != len(book_ids):
+            raise CommandError(f"Index holds {index.ntotal} vectors but there are {len(book_ids)} book ids")
+
+        shard_of_row = np.fromiter((shard_of(book_id_str(book_id), num_shards) for book_id in book_ids),
+                                   dtype=np.int32, count=len(book_ids))
+        # Every shard starts from an empty copy of the index, so IVF shards
+        # share the trained centroids (and PQ shards the codebooks).
+        empty = empty_copy(index)
+        enable_reconstruct(index)
+        os.makedirs(kwargs['output_dir'], exist_ok=True)
+        # One shard in memory at a time: each is filled by a pass over the
+        # mapped index, written out and freed before the next.
+        for shard in range(num_shards):
+            shard_index = faiss.clone_index(empty)
+            for start in range(0, index.ntotal, chunk_size):
+                n = min(chunk_size, index.ntotal - start)
+                rows = np.flatnonzero(shard_of_row[start:start + n] == shard)
+                if len(rows):
+                    shard_index.add(index.reconstruct_n(start, n)[rows])
+
+            index_path = os.path.join(kwargs['output_dir'], f"shard-{shard}-of-{num_shards}.faiss")
+            faiss.write_index(shard_index, f"{index_path}.tmp")
+            os.replace(f"{index_path}.tmp", index_path)
+            atomic_save_npy(os.path.join(kwargs['output_dir'], f"shard-{shard}-of-{num_shards}_ids.npy"),
+                            compact_book_ids(book_ids[shard_of_row == shard]))
+            self.stdout.write(f"Shard {shard}: {shard_index.ntotal} books -> {index_path}")
+            del shard_index
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.encoder_service import EncoderServer, MicroBatcher, load_model
+
+
+class Command(BaseCommand):
+    help = 'Run the local sentence-encoder sidecar that web workers reach over a Unix socket.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=settings.RECOMMENDER.get('ENCODER_SOCKET') or '/tmp/book-encoder.sock')
+        parser.add_argument('--max-batch-size', type=int, default=64, help='Most texts encoded in one batch')
+        parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                            help='How long to wait for more requests after the first one of a batch')
+        parser.add_argument('--torch-threads', type=int, default=None, help='torch intra-op threads')
+
+    def handle(self, *args, **kwargs):
+        model = load_model(settings.RECOMMENDER['MODEL_NAME'], kwargs['torch_threads'])
+        batcher = MicroBatcher(
+            lambda texts: model.encode(texts, batch_size=kwargs['max_batch_size'], convert_to_numpy=True),
+            max_batch_size=kwargs['max_batch_size'],
+            max_wait=kwargs['max_wait_ms'] / 1000,
+        )
+        server = EncoderServer(kwargs['socket'], batcher)
+        self.stdout.write(self.style.SUCCESS(f"Encoder listening on {kwargs['socket']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Encoded {batcher.texts_encoded} texts in {batcher.batches} batches")
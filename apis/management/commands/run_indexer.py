@@ -0,0 +1,130 @@
+import time
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apis.change_log import START, advance, load_position, pending_changes, position_path
+from apis.models import Book, BookChange
+from common.incremental_index import IncrementalIndex
+from common.index_files import live_index_files, numeric_book_id
+from common.recommender import get_recommender
+
+
+class Command(BaseCommand):
+    help = 'Apply the book change log to the incrementally maintained index in RECOMMENDER["INDEX_VERSIONS_DIR"].'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between polls of the change log')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Most change log entries applied per version')
+        parser.add_argument('--gap-timeout', type=float, default=300.0,
+                            help='Stop waiting for a change log id to commit after this many seconds '
+                                 '(its transaction rolled back)')
+        parser.add_argument('--compact-ratio', type=float, default=0.1,
+                            help='Rebuild without tombstones once they exceed this fraction of the index')
+        parser.add_argument('--keep-versions', type=int, default=3, help='Newest versions always kept, the live one included')
+        parser.add_argument('--keep-seconds', type=float, default=60.0,
+                            help='Keep replaced versions at least this long, so web workers loading one '
+                                 'never lose it mid-load; allow for RELOAD_INTERVAL plus the load time')
+        parser.add_argument('--once', action='store_true', help='Apply what is pending and exit')
+
+    def handle(self, *args, **kwargs):
+        directory = settings.RECOMMENDER.get('INDEX_VERSIONS_DIR')
+        if not directory:
+            raise CommandError("Set RECOMMENDER['INDEX_VERSIONS_DIR'] to run the indexer")
+
+        index = IncrementalIndex.load(directory)
+        if index is None:
+            index = self._bootstrap(directory, kwargs['keep_versions'], kwargs['keep_seconds'])
+        self.stdout.write(
+            f"Serving version {index.version}: {index.live_count} books, change log cursor {index.cursor}"
+            f"{f' ({len(index.gaps)} ids not committed yet)' if index.gaps else ''}"
+        )
+        # When each gap in the change log was first waited for; restarting waits afresh
+        self._gaps_since = {}
+
+        while True:
+            applied = self._apply_pending(index, directory, kwargs)
+            if not applied:
+                if kwargs['once']:
+                    break
+                time.sleep(kwargs['interval'])
+
+    def _bootstrap(self, directory, keep_versions, keep_seconds):
+        """Start from the full build, replaying the log from the position the build recorded."""
+        config = settings.RECOMMENDER
+        try:
+            _, index_path, book_ids_path, _ = live_index_files(config['INDEX_PATH'], config['BOOK_IDS_PATH'])
+            built = faiss.read_index(index_path)
+            book_ids = np.load(book_ids_path)
+        except (OSError, RuntimeError) as e:
+            raise CommandError(f"No index version yet and cannot read the full build: {e}")
+        position = load_position(position_path(config['INDEX_PATH']))
+        if position is None:
+            self.stdout.write(self.style.WARNING(
+                "The build recorded no change log position; replaying the whole log"
+            ))
+            position = START
+        try:
+            index = IncrementalIndex.from_index(built, book_ids)
+        except ValueError as e:
+            raise CommandError(str(e))
+        index.save(directory, position['cursor'], keep_versions, gaps=position['gaps'], keep_seconds=keep_seconds)
+        self.stdout.write(f"Bootstrapped from {config['INDEX_PATH']}")
+        return index
+
+    def _give_up_on_old_gaps(self, index, timeout):
+        now = time.monotonic()
+        self._gaps_since = {gap: self._gaps_since.get(gap, now) for gap in index.gaps}
+        expired = {gap for gap, since in self._gaps_since.items() if now - since > timeout}
+        if expired:
+            index.gaps = [gap for gap in index.gaps if gap not in expired]
+            self.stdout.write(f"Gave up on {len(expired)} change log ids that never committed")
+
+    def _apply_pending(self, index, directory, kwargs):
+        self._give_up_on_old_gaps(index, kwargs['gap_timeout'])
+        position = {'cursor': index.cursor, 'gaps': index.gaps}
+        changes = pending_changes(position, kwargs['batch_size'])
+        if not changes:
+            return False
+
+        # Only the latest operation per book matters; the book row gives the current text.
+        latest = {}
+        for change in changes:
+            latest[change.book_id] = change.operation
+        upsert_ids = [book_id for book_id, operation in latest.items() if operation != BookChange.DELETED]
+        descriptions = dict(Book.objects.filter(id__in=upsert_ids).values_list('id', 'description'))
+
+        deletes = set()
+        upserts = {}
+        skipped = 0
+        for book_id in latest:
+            numeric_id = numeric_book_id(book_id)
+            if numeric_id is None:
+                skipped += 1
+                continue
+            if book_id in descriptions:
+                upserts[numeric_id] = book_id
+            else:
+                deletes.add(numeric_id)
+
+        if upserts:
+            vectors = get_recommender().encode([descriptions[book_id] or '' for book_id in upserts.values()])
+            upserts = dict(zip(upserts, vectors))
+
+        index.apply(upserts, deletes)
+        if index.tombstone_ratio > kwargs['compact_ratio']:
+            index.compact()
+            self.stdout.write("Compacted tombstones")
+        position = advance(position, changes)
+        version = index.save(directory, position['cursor'], kwargs['keep_versions'], gaps=position['gaps'],
+                             keep_seconds=kwargs['keep_seconds'])
+
+        lag = (timezone.now() - min(change.created_at for change in changes)).total_seconds()
+        self.stdout.write(
+            f"Version {version}: {len(upserts)} upserted, {len(deletes)} removed"
+            f"{f', {skipped} non-numeric ids skipped' if skipped else ''}; oldest change was {lag:.1f}s old"
+        )
+        return True
@@ -0,0 +1,44 @@
+import os
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from common.recommender import IndexState
+from common.shard_search import ShardServer, parse_address
+from common.vector_index import enable_reconstruct, set_search_params
+
+
+class Command(BaseCommand):
+    help = 'Serve one shard of a partitioned book index to the recommenders listed in RECOMMENDER["SHARDS"].'
+
+    def add_arguments(self, parser):
+        parser.add_argument('index', help='Shard index file written by partition_index')
+        parser.add_argument('book_ids', help='Book ids of the shard, row for row')
+        parser.add_argument('--listen', default='127.0.0.1:7600', help='host:port to listen on')
+        parser.add_argument('--nprobe', type=int)
+        parser.add_argument('--ef-search', type=int)
+
+    def handle(self, *args, **kwargs):
+        try:
+            stat = os.stat(kwargs['index'])
+            index = faiss.read_index(kwargs['index'])
+            book_ids = np.load(kwargs['book_ids'])
+        except (OSError, RuntimeError) as e:
+            raise CommandError(f"Cannot read the shard: {e}")
+        if index.ntotal != len(book_ids):
+            raise CommandError(f"Shard holds {index.ntotal} vectors but there are {len(book_ids)} book ids")
+        set_search_params(index, nprobe=kwargs['nprobe'], ef_search=kwargs['ef_search'])
+        enable_reconstruct(index)
+        # Same version tag as an unsharded index: partition_index replaces the file on every run
+        state = IndexState(index, book_ids, version=f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+        server = ShardServer(parse_address(kwargs['listen']), state)
+        self.stdout.write(self.style.SUCCESS(f"Serving {index.ntotal} books on {kwargs['listen']}"))
+        self.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
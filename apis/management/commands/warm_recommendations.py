@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from apis.models import Book
+from common.recommender import RecommenderUnavailable, get_recommender
+
+
+class Command(BaseCommand):
+    help = 'Preload the shared recommendation cache for the most-favourited books.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=1000, help='Number of most-favourited books to preload')
+        parser.add_argument('--k', type=int, default=5, help='Recommendations per book')
+
+    def handle(self, *args, **kwargs):
+        recommender = get_recommender()
+        # Without a shared tier the results would only land in this command's own local cache
+        if recommender.cache.shared_alias is None:
+            raise CommandError(
+                "RECOMMENDER['CACHE']['SHARED_ALIAS'] is not set, so there is no cache the web workers "
+                "share to warm; point it at a Django cache alias such as Redis or Memcached"
+            )
+
+        books = (
+            Book.objects.annotate(favorite_count=Count('favorited_by'))
+            .filter(favorite_count__gt=0)
+            .order_by('-favorite_count')
+            .values_list('id', 'description')[:kwargs['top']]
+        )
+        try:
+            for book_id, description in books:
+                recommender.recommend_for_book(book_id, description, k=kwargs['k'])
+        except RecommenderUnavailable as e:
+            self.stderr.write(self.style.ERROR(str(e)))
+            return
+
+        stats = recommender.cache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {len(books)} books: {stats['misses']} computed, "
+            f"{stats['local_hits'] + stats['shared_hits']} already cached"
+        ))
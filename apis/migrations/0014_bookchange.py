@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0013_book_embedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.CharField(max_length=500)),
+                ('operation', models.CharField(choices=[('create', 'Created'), ('update', 'Updated'), ('delete', 'Deleted')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
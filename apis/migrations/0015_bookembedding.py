@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0014_bookchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookEmbedding',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stored_embedding', serialize=False, to='apis.book')),
+                ('model_name', models.CharField(max_length=255)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
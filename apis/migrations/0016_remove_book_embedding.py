@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 15:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0015_bookembedding'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='book',
+            name='embedding',
+        ),
+    ]
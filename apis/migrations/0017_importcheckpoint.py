@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-18 15:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0016_remove_book_embedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=50)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('file_path', models.CharField(max_length=1000)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('command', 'fingerprint')},
+            },
+        ),
+    ]
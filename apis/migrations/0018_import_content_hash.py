@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0017_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0018_import_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthorWork',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('work_id', models.CharField(db_index=True, max_length=500)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='works', to='apis.author')),
+            ],
+            options={
+                'unique_together': {('author', 'work_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AuthorBookRef',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.CharField(db_index=True, max_length=500)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='book_refs', to='apis.author')),
+            ],
+            options={
+                'unique_together': {('author', 'book_id')},
+            },
+        ),
+        # Fill the new tables from the existing JSON lists and link the books that are already imported
+        migrations.RunSQL(
+            """
+            INSERT INTO apis_authorwork (author_id, work_id)
+            SELECT DISTINCT author.id, work.id
+            FROM apis_author author, jsonb_array_elements_text(author.work_ids) AS work(id)
+            WHERE jsonb_typeof(author.work_ids) = 'array'
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO apis_authorbookref (author_id, book_id)
+            SELECT DISTINCT author.id, book.id
+            FROM apis_author author, jsonb_array_elements_text(author.book_ids) AS book(id)
+            WHERE jsonb_typeof(author.book_ids) = 'array'
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO apis_book_authors (book_id, author_id)
+            SELECT ref.book_id, ref.author_id
+            FROM apis_authorbookref ref
+            JOIN apis_book book ON book.id = ref.book_id
+            ON CONFLICT DO NOTHING;
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
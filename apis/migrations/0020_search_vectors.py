@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-18 15:29
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0019_author_relations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tsv_title'], name='idx_tsv_title_gin'),
+        ),
+        # Compute the search vectors in the database on every insert and on updates of the source columns.
+        # The text search configuration must match apis.search.SEARCH_CONFIG.
+        migrations.RunSQL(
+            """
+            CREATE FUNCTION apis_book_search_vectors() RETURNS trigger AS $$
+            BEGIN
+                NEW.tsv_title := to_tsvector('english', coalesce(NEW.title, ''));
+                NEW.tsv_description := to_tsvector('english', coalesce(NEW.description, ''));
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER apis_book_search_vectors
+            BEFORE INSERT OR UPDATE OF title, description ON apis_book
+            FOR EACH ROW EXECUTE PROCEDURE apis_book_search_vectors();
+            """,
+            """
+            DROP TRIGGER apis_book_search_vectors ON apis_book;
+            DROP FUNCTION apis_book_search_vectors();
+            """,
+        ),
+    ]
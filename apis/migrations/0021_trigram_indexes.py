@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 15:30
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0020_search_vectors'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='author',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='idx_author_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='idx_book_title_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
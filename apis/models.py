@@ -24,7 +24,14 @@ class Author(TimestampMixin):
     book_ids = models.JSONField(default=list)
     works_count = models.IntegerField(default=0)
     fans_count = models.IntegerField(default=0)
+    # Hash of the imported record, so importbook/importdata --upsert can skip unchanged rows
+    content_hash = models.CharField(max_length=32, blank=True, default='')
 
+    class Meta:
+        indexes = [
+            # Serves substring (ILIKE) and similarity matching on names, see apis.search
+            GinIndex(fields=['name'], name='idx_author_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
@@ -37,18 +44,52 @@ class Book(TimestampMixin):
     published_date = models.DateField(blank=True, null=True)  # Allow null values
     isbn = models.CharField(max_length=130, unique=True)
     description = models.TextField(blank=True, null=True)
+    # Kept up to date by a database trigger (migration 0020); backfill_search_vectors fills older rows
     tsv_title = SearchVectorField(null=True, blank=True)
     tsv_description = SearchVectorField(null=True, blank=True)
+    # Hash of the imported record (authors included), see Author.content_hash
+    content_hash = models.CharField(max_length=32, blank=True, default='')
 
     class Meta:
         indexes = [
             GinIndex(fields=['tsv_description'], name='idx_tsv_description_gin'),
+            GinIndex(fields=['tsv_title'], name='idx_tsv_title_gin'),
+            GinIndex(fields=['title'], name='idx_book_title_trgm', opclasses=['gin_trgm_ops']),
         ]
 
     def __str__(self):
         return self.title
 
 
+class AuthorWork(models.Model):
+    """A work id from an author's record, so work lookups are index scans instead of JSON decoding."""
+    author = models.ForeignKey(Author, related_name='works', on_delete=models.CASCADE)
+    work_id = models.CharField(max_length=500, db_index=True)
+
+    class Meta:
+        unique_together = ('author', 'work_id')
+
+    def __str__(self):
+        return f"{self.author_id} - {self.work_id}"
+
+
+class AuthorBookRef(models.Model):
+    """
+    A book id from an author's record.
+
+    Not a foreign key: authors are imported before books. The importers add
+    the matching ``Book.authors`` link as soon as both rows exist.
+    """
+    author = models.ForeignKey(Author, related_name='book_refs', on_delete=models.CASCADE)
+    book_id = models.CharField(max_length=500, db_index=True)
+
+    class Meta:
+        unique_together = ('author', 'book_id')
+
+    def __str__(self):
+        return f"{self.author_id} - {self.book_id}"
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(User, related_name='favorites', on_delete=models.CASCADE)
     book = models.ForeignKey(Book, related_name='favorited_by', on_delete=models.CASCADE)
@@ -59,4 +100,56 @@ class Favorite(models.Model):
         ordering = ['-added_at']
 
     def __str__(self):
-        return f"{self.user.username} - {self.book.title}"
\ No newline at end of file
+        return f"{self.user.username} - {self.book.title}"
+
+
+class BookEmbedding(models.Model):
+    """
+    A book's description vector, stored as raw float32 bytes.
+
+    ``content_hash`` covers the exact text and the model name the vector was
+    computed from, so builds can tell which vectors are still valid.
+    """
+    book = models.OneToOneField(Book, primary_key=True, related_name='stored_embedding', on_delete=models.CASCADE)
+    model_name = models.CharField(max_length=255)
+    content_hash = models.CharField(max_length=64)
+    vector = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.book_id} ({self.model_name})"
+
+
+class BookChange(models.Model):
+    """Durable log of book writes, consumed in order by the run_indexer command."""
+    CREATED = 'create'
+    UPDATED = 'update'
+    DELETED = 'delete'
+    OPERATION_CHOICES = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    # Not a foreign key: the entry must outlive the book when it is deleted.
+    book_id = models.CharField(max_length=500)
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.operation} {self.book_id}"
+
+
+class ImportCheckpoint(models.Model):
+    """How far an import of one input file has been committed, so it can resume after a crash."""
+    command = models.CharField(max_length=50)
+    fingerprint = models.CharField(max_length=64)
+    file_path = models.CharField(max_length=1000)
+    offset = models.BigIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('command', 'fingerprint')
+
+    def __str__(self):
+        return f"{self.command} {self.file_path} @ {self.offset}"
@@ -0,0 +1,100 @@
+"""
+Book and author search backed by PostgreSQL indexes.
+
+Full-text: ``tsv_title`` and ``tsv_description`` are maintained by a trigger
+(migration 0020) and GIN-indexed, so matching is an index lookup rather than
+a scan.
+
+Substring: ``Book.title`` and ``Author.name`` have ``pg_trgm`` GIN indexes
+(migration 0021), which serve ``ILIKE '%text%'`` for text of three or more
+characters. Matches are ranked by trigram similarity.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Case, F, IntegerField, Q, Value, When
+
+from apis.models import Author, Book
+
+# Must match the configuration used by the trigger in migration 0020
+SEARCH_CONFIG = 'english'
+
+# Title matches count this much more than description matches when ranking
+TITLE_WEIGHT = 2.0
+
+
+def fulltext(queryset, text):
+    """Books whose title or description matches ``text`` (web search syntax), best ranked first."""
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    return queryset.filter(
+        Q(tsv_title=query) | Q(tsv_description=query)
+    ).annotate(
+        rank=SearchRank(F('tsv_title'), query) * TITLE_WEIGHT + SearchRank(F('tsv_description'), query)
+    ).order_by('-rank', 'id')
+
+
+def _pattern(text):
+    """``ILIKE`` pattern matching ``text`` anywhere, with its wildcards escaped."""
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def book_matches_sql(text, limit):
+    """
+    ``(sql, params)`` selecting the ids of books whose title or an author's name contains ``text``.
+
+    The two matches are separate index lookups unioned set-wise (not a join
+    filtered by OR), and a book found both ways is returned once with its
+    best similarity.
+    """
+    sql = f"""
+        SELECT matches.id
+        FROM (
+            SELECT book.id, similarity(book.title, %(text)s) AS score
+            FROM {Book._meta.db_table} book
+            WHERE book.title ILIKE %(pattern)s
+            UNION ALL
+            SELECT link.book_id, similarity(author.name, %(text)s)
+            FROM {Author._meta.db_table} author
+            JOIN {Book.authors.through._meta.db_table} link ON link.author_id = author.id
+            WHERE author.name ILIKE %(pattern)s
+        ) matches
+        GROUP BY matches.id
+        ORDER BY max(matches.score) DESC, matches.id
+        LIMIT %(limit)s
+    """
+    return sql, {'text': text, 'pattern': _pattern(text), 'limit': limit}
+
+
+def author_matches_sql(text, limit):
+    """``(sql, params)`` selecting the ids of authors whose name contains ``text``, most similar first."""
+    sql = f"""
+        SELECT author.id
+        FROM {Author._meta.db_table} author
+        WHERE author.name ILIKE %(pattern)s
+        ORDER BY similarity(author.name, %(text)s) DESC, author.id
+        LIMIT %(limit)s
+    """
+    return sql, {'text': text, 'pattern': _pattern(text), 'limit': limit}
+
+
+def _ids(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def in_order(queryset, ids):
+    """``queryset`` restricted to ``ids``, in that order."""
+    if not ids:
+        return queryset.none()
+    position = Case(*[When(pk=pk, then=Value(i)) for i, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(position)
+
+
+def substring_books(queryset, text, limit):
+    """The ``limit`` books best matching ``text`` by title or author name."""
+    return in_order(queryset, _ids(*book_matches_sql(text, limit)))
+
+
+def substring_authors(queryset, text, limit):
+    """The ``limit`` authors whose name best matches ``text``."""
+    return in_order(queryset, _ids(*author_matches_sql(text, limit)))
@@ -11,7 +11,7 @@ from .models import Book, Favorite
 class BookSerializer(serializers.ModelSerializer):
     class Meta:
         model = Book
-        fields = '__all__'
+        exclude = ('content_hash',)
 from rest_framework import serializers
 from .models import Favorite, Book
 
@@ -72,4 +72,10 @@ class UserLoginSerializer(serializers.Serializer):
 class AuthorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Author
-        fields = '__all__'
+        exclude = ('content_hash',)
+
+
+class AuthorSummarySerializer(AuthorSerializer):
+    """An author without the listed work and book ids, which live in AuthorWork / AuthorBookRef."""
+    class Meta(AuthorSerializer.Meta):
+        exclude = ('content_hash', 'work_ids', 'book_ids')
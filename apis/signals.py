@@ -0,0 +1,61 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from apis.autocomplete import author_op, book_op, record_favorite, record_write
+from apis.models import Author, Book, BookChange, Favorite
+from common.recommender import get_recommender
+
+
+@receiver(pre_save, sender=Book)
+def remember_description_change(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'description' not in update_fields:
+        instance._description_changed = False
+        return
+    old_description = Book.objects.filter(pk=instance.pk).values_list('description', flat=True).first()
+    instance._description_changed = old_description != instance.description
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, created, **kwargs):
+    if created or getattr(instance, '_description_changed', True):
+        operation = BookChange.CREATED if created else BookChange.UPDATED
+        BookChange.objects.create(book_id=instance.pk, operation=operation)
+        get_recommender().cache.invalidate_book(instance.pk)
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    BookChange.objects.create(book_id=instance.pk, operation=BookChange.DELETED)
+    get_recommender().cache.invalidate_book(instance.pk)
+
+
+# Keep this process's autocomplete index current, if it has been loaded, and the other processes' in step
+@receiver(post_save, sender=Book)
+def autocomplete_book_saved(sender, instance, created, **kwargs):
+    record_write([book_op(instance, created)])
+
+
+@receiver(post_delete, sender=Book)
+def autocomplete_book_deleted(sender, instance, **kwargs):
+    record_write([('remove', 'books', instance.pk, None, None)])
+
+
+@receiver(post_save, sender=Author)
+def autocomplete_author_saved(sender, instance, **kwargs):
+    record_write([author_op(instance)])
+
+
+@receiver(post_delete, sender=Author)
+def autocomplete_author_deleted(sender, instance, **kwargs):
+    record_write([('remove', 'authors', instance.pk, None, None)])
+
+
+@receiver(post_save, sender=Favorite)
+def autocomplete_favorite_added(sender, instance, created, **kwargs):
+    if created:
+        record_favorite(instance.book_id, 1)
+
+
+@receiver(post_delete, sender=Favorite)
+def autocomplete_favorite_removed(sender, instance, **kwargs):
+    record_favorite(instance.book_id, -1)
@@ -1,3 +1,1202 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import operator
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from apis import autocomplete, change_log, copy_loader, search
+from apis.import_records import book_record
+from apis.import_runs import ImportRun
+from apis.management.commands.export_data import Command as ExportDataCommand
+from apis.models import Author, AuthorBookRef, AuthorWork, Book, BookChange, Favorite, User
+from common import recommender as recommender_module
+from common.build_shards import MANIFEST, ShardWriter, assemble_index, is_complete, shard_build_dir, shard_of
+from common.encoder_service import MicroBatcher
+from common.incremental_index import IncrementalIndex, read_current
+from common.index_files import (
+    book_id_str, compact_book_ids, live_index_files, load_spooled_ids, numeric_book_id, versions_dir,
+)
+from common.jsonl_reader import byte_ranges, iter_chunks, parse_range
+from common.prefix_index import PrefixIndex
+from common.recommendation_cache import RecommendationCache
+from common.recommender import BookRecommender, IndexState, RecommenderUnavailable
+from common.shard_search import ShardedSearcher, ShardedState, ShardsUnavailable
+
+# Loads the memory-mapped recommender, touches every vector with a search,
+# then reports its memory once the parent says all workers are loaded.
+MMAP_WORKER = """
+import json, sys
+from common.recommender import BookRecommender
+
+def memory():
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    return {key: int(fields[key].split()[0]) for key in ('Rss', 'Pss', 'Anonymous')}
+
+before = memory()
+recommender = BookRecommender(None, sys.argv[2], None, mmap=True, vectors_path=sys.argv[1])
+recommender.index.search(recommender.index.vectors[:8], 5)
+print('ready', flush=True)
+sys.stdin.readline()
+after = memory()
+print(json.dumps({key: after[key] - before[key] for key in after}), flush=True)
+sys.stdin.readline()
+"""
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/smaps_rollup'), 'needs Linux smaps_rollup')
+class MmapIndexMemoryTests(SimpleTestCase):
+    num_vectors = 50000
+    dimension = 384
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.vectors_path = os.path.join(cls.tmp_dir.name, 'book_vectors.npy')
+        cls.book_ids_path = os.path.join(cls.tmp_dir.name, 'book_ids.npy')
+        rng = np.random.default_rng(0)
+        np.save(cls.vectors_path, rng.random((cls.num_vectors, cls.dimension), dtype=np.float32))
+        np.save(cls.book_ids_path, np.arange(cls.num_vectors, dtype=np.int64))
+        cls.vectors_kb = os.path.getsize(cls.vectors_path) // 1024
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+        super().tearDownClass()
+
+    def _run_workers(self, count):
+        workers = [
+            subprocess.Popen(
+                [sys.executable, '-c', MMAP_WORKER, self.vectors_path, self.book_ids_path],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=settings.BASE_DIR,
+                env={**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE},
+            )
+            for _ in range(count)
+        ]
+        try:
+            for worker in workers:
+                self.assertEqual(worker.stdout.readline().strip(), 'ready')
+            reports = []
+            for worker in workers:
+                worker.stdin.write('\n')
+                worker.stdin.flush()
+                reports.append(json.loads(worker.stdout.readline()))
+            return reports
+        finally:
+            for worker in workers:
+                worker.communicate('\n')
+
+    def test_workers_share_one_copy_of_the_vectors(self):
+        private_kb = {}
+        pss_kb = {}
+        for count in (1, 2, 4):
+            reports = self._run_workers(count)
+            private_kb[count] = max(report['Anonymous'] for report in reports)
+            pss_kb[count] = max(report['Pss'] for report in reports)
+
+        for count, kb in private_kb.items():
+            # No worker copies the vectors into its own heap.
+            self.assertLess(kb, self.vectors_kb // 4, f"{count} workers: {kb} KB private")
+        # Private memory per worker stays flat as workers are added...
+        self.assertLess(private_kb[4], private_kb[1] + self.vectors_kb // 10)
+        # ...while the shared pages are split between them.
+        self.assertLess(pss_kb[4], pss_kb[1])
+
+
+class BookIdsTests(SimpleTestCase):
+    def test_only_canonical_integers_are_stored_as_numbers(self):
+        self.assertEqual(compact_book_ids(['12', '-3', '7']).dtype, np.int64)
+        for book_ids in (['123', '0123'], ['7', ' 7'], ['8', '+8'], ['1000', '1_000'], ['1', '99999999999999999999']):
+            compact = compact_book_ids(book_ids)
+            self.assertEqual(compact.dtype.kind, 'S', book_ids)
+            self.assertEqual([book_id_str(book_id) for book_id in compact], book_ids)
+
+    def test_non_ascii_ids_round_trip_through_utf8(self):
+        compact = compact_book_ids(['livre-é', '書籍'])
+        self.assertEqual([book_id_str(book_id) for book_id in compact], ['livre-é', '書籍'])
+        state = IndexState(faiss.IndexFlatL2(2), compact)
+        self.assertEqual(state.row_for('書籍'), 1)
+
+    def test_spooled_ids_match_compact_book_ids(self):
+        for book_ids in (['5', '12', '-3'], ['123', '0123'], ['a', '書籍']):
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(''.join(f"{book_id}\n" for book_id in book_ids).encode())
+                f.flush()
+                spooled = load_spooled_ids(f.name, len(book_ids))
+            self.assertEqual([book_id_str(book_id) for book_id in spooled], book_ids)
+            self.assertEqual(spooled.dtype.kind, compact_book_ids(book_ids).dtype.kind)
+
+    def test_numeric_ids_are_not_found_under_another_spelling(self):
+        state = IndexState(faiss.IndexFlatL2(2), compact_book_ids(['123', '7']))
+        self.assertEqual(state.row_for('123'), 0)
+        self.assertIsNone(state.row_for('0123'))
+        self.assertIsNone(state.row_for(' 7'))
+        self.assertIsNone(numeric_book_id('0123'))
+        self.assertEqual(numeric_book_id(b'123'), 123)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'recommendation-tests'},
+})
+class RecommendationCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_least_recently_used_entries_are_evicted_first(self):
+        cache = RecommendationCache(max_entries=2)
+        cache.set('1', 5, 'v1', ['10'])
+        cache.set('2', 5, 'v1', ['20'])
+        self.assertEqual(cache.get('1', 5, 'v1'), ['10'])  # '2' is now the least recently used
+        cache.set('3', 5, 'v1', ['30'])
+        self.assertIsNone(cache.get('2', 5, 'v1'))
+        self.assertEqual(cache.get('1', 5, 'v1'), ['10'])
+        self.assertEqual(cache.get('3', 5, 'v1'), ['30'])
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_local_entries_expire(self):
+        cache = RecommendationCache(local_timeout=-1)
+        cache.set('1', 5, 'v1', ['10'])
+        self.assertIsNone(cache.get('1', 5, 'v1'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_a_new_index_version_clears_local_entries(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        vectors = np.random.default_rng(0).standard_normal((20, 8), dtype=np.float32)
+        built = faiss.IndexFlatL2(8)
+        built.add(vectors)
+        index = IncrementalIndex.from_index(built, [str(i) for i in range(20)])
+        index.save(tmp_dir.name, 0)
+        cache = RecommendationCache()
+        recommender = BookRecommender(None, None, None, cache=cache, versions_dir=tmp_dir.name)
+        similar = recommender.similar_books('3')
+        self.assertEqual(cache.get('3', 5, index.version), similar)
+
+        time.sleep(0.001)  # version names are timestamps
+        index.save(tmp_dir.name, 1)
+        recommender._next_reload_check = 0
+        self.assertEqual(recommender.state.version, index.version)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_invalidating_a_book_hides_its_shared_entries_from_other_processes(self):
+        writer, reader, other = (RecommendationCache(shared_alias='shared') for _ in range(3))
+        writer.set('1', 5, 'v1', ['10'])
+        writer.set('2', 5, 'v1', ['20'])
+        self.assertEqual(reader.get('1', 5, 'v1'), ['10'])
+
+        reader.invalidate_book('1')
+        self.assertIsNone(reader.get('1', 5, 'v1'))
+        self.assertIsNone(other.get('1', 5, 'v1'))
+        self.assertEqual(other.get('2', 5, 'v1'), ['20'])
+        # The writer's own local copy lives until its local timeout
+        self.assertEqual(writer.get('1', 5, 'v1'), ['10'])
+
+        writer.set('1', 5, 'v1', ['11'])
+        self.assertEqual(other.get('1', 5, 'v1'), ['11'])
+
+    def test_stats_count_hits_misses_and_invalidations(self):
+        cache = RecommendationCache(shared_alias='shared')
+        RecommendationCache(shared_alias='shared').set('1', 5, 'v1', ['10'])
+        self.assertIsNone(cache.get('2', 5, 'v1'))
+        cache.get('1', 5, 'v1')  # shared, then cached locally
+        cache.get('1', 5, 'v1')
+        cache.invalidate_book('1')
+        self.assertEqual(cache.stats(), {
+            'local_hits': 1, 'shared_hits': 1, 'misses': 1, 'invalidations': 1,
+            'entries': 0, 'max_entries': 10000, 'hit_rate': 2 / 3,
+        })
+
+
+# Builds one shard of a synthetic catalogue the way export_data --shard does:
+# only the shard's books, in id order, checkpointed batch by batch.
+SHARD_WORKER = """
+import sys
+import numpy as np
+from common.build_shards import ShardWriter, shard_build_dir, shard_of
+
+build_dir, shard, num_shards, num_books, dimension = sys.argv[1], *map(int, sys.argv[2:])
+vectors = np.random.default_rng(0).standard_normal((num_books, dimension), dtype=np.float32)
+book_ids = np.array(sorted(str(1000 + i) for i in range(num_books)))
+mine = np.array([shard_of(book_id, num_shards) == shard for book_id in book_ids])
+writer = ShardWriter(shard_build_dir(build_dir, shard, num_shards))
+for batch_no, start in enumerate(range(0, mine.sum(), 300)):
+    rows = np.flatnonzero(mine)[start:start + 300]
+    writer.write(batch_no, book_ids[rows], vectors[np.array([int(book_id) - 1000 for book_id in book_ids[rows]])])
+writer.mark_complete()
+"""
+
+
+class ShardedBuildTests(SimpleTestCase):
+    num_books = 3000
+    dimension = 32
+    num_shards = 3
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+        self.vectors = np.random.default_rng(0).standard_normal((self.num_books, self.dimension), dtype=np.float32)
+        self.book_ids = np.array([str(1000 + i) for i in range(self.num_books)])
+
+    def _build_single(self, spec):
+        writer = ShardWriter(os.path.join(self.tmp, 'single'))
+        order = np.argsort(self.book_ids)
+        for batch_no, start in enumerate(range(0, self.num_books, 500)):
+            rows = order[start:start + 500]
+            writer.write(batch_no, self.book_ids[rows], self.vectors[rows])
+        return self._assemble([os.path.join(self.tmp, 'single')], spec, 'single')
+
+    def _build_sharded(self, spec):
+        build_dir = os.path.join(self.tmp, 'sharded')
+        workers = [
+            subprocess.Popen(
+                [sys.executable, '-c', SHARD_WORKER, build_dir,
+                 str(shard), str(self.num_shards), str(self.num_books), str(self.dimension)],
+                cwd=settings.BASE_DIR,
+            )
+            for shard in range(self.num_shards)
+        ]
+        for worker in workers:
+            self.assertEqual(worker.wait(), 0)
+        build_dirs = [shard_build_dir(build_dir, shard, self.num_shards) for shard in range(self.num_shards)]
+        self.assertTrue(all(is_complete(shard_dir) for shard_dir in build_dirs))
+        return self._assemble(build_dirs, spec, 'merged')
+
+    def _assemble(self, build_dirs, spec, name):
+        index_path = os.path.join(self.tmp, f'{name}.faiss')
+        book_ids_path = os.path.join(self.tmp, f'{name}_ids.npy')
+        total = assemble_index(build_dirs, spec, index_path, book_ids_path, train_size=2000, nprobe=4)
+        self.assertEqual(total, self.num_books)
+        return faiss.read_index(index_path), np.load(book_ids_path)
+
+    def test_sharded_build_matches_single_build(self):
+        queries = np.random.default_rng(1).standard_normal((50, self.dimension), dtype=np.float32)
+        for spec in ('Flat', 'IVF16,Flat'):
+            with self.subTest(spec=spec):
+                self.tmp = tempfile.mkdtemp(dir=self.tmp)
+                single_index, single_ids = self._build_single(spec)
+                merged_index, merged_ids = self._build_sharded(spec)
+                np.testing.assert_array_equal(merged_ids, single_ids)
+                single_distances, single_rows = single_index.search(queries, 10)
+                merged_distances, merged_rows = merged_index.search(queries, 10)
+                np.testing.assert_array_equal(merged_rows, single_rows)
+                np.testing.assert_array_equal(merged_distances, single_distances)
+
+    def test_overlapping_shards_are_rejected(self):
+        for name in ('a', 'b'):
+            ShardWriter(os.path.join(self.tmp, name)).write(0, self.book_ids[:10], self.vectors[:10])
+        with self.assertRaises(ValueError):
+            self._assemble([os.path.join(self.tmp, 'a'), os.path.join(self.tmp, 'b')], 'Flat', 'overlap')
+
+    def test_resume_after_a_crash_mid_write_neither_loses_nor_repeats_books(self):
+        build_dir = os.path.join(self.tmp, 'build')
+        order = np.argsort(self.book_ids)
+        batches = [order[start:start + 500] for start in range(0, self.num_books, 500)]
+        writer = ShardWriter(build_dir)
+        for batch_no in (0, 1, 2, 4):  # batch 3 was still being encoded
+            writer.write(batch_no, self.book_ids[batches[batch_no]], self.vectors[batches[batch_no]])
+        # The crash hit while batch 3 was written: a truncated temporary file and a torn manifest line
+        with open(os.path.join(build_dir, 'batch-000003.npy.tmp'), 'wb') as f:
+            f.write(b'\x93NUMPY')
+        with open(os.path.join(build_dir, MANIFEST), 'a') as f:
+            f.write('{"batch": 3, "vectors": "batch-0000')
+
+        next_batch, last_id = ShardWriter(build_dir).resume()
+        self.assertEqual((next_batch, last_id), (3, self.book_ids[batches[2][-1]]))
+        self.assertEqual(sorted(name for name in os.listdir(build_dir) if name.startswith('batch-')),
+                         [f"batch-{i:06d}{suffix}" for i in range(3) for suffix in ('.ids.npy', '.npy')])
+
+        # The resumed run continues after last_id
+        remaining = order[self.book_ids[order] > last_id]
+        for batch_no, start in enumerate(range(0, len(remaining), 500), start=next_batch):
+            rows = remaining[start:start + 500]
+            writer.write(batch_no, self.book_ids[rows], self.vectors[rows])
+        _, book_ids = self._assemble([build_dir], 'Flat', 'resumed')
+        np.testing.assert_array_equal(book_ids.astype(str), np.sort(self.book_ids))
+
+    def test_raw_vectors_file_never_outlives_its_book_ids(self):
+        build_dir = os.path.join(self.tmp, 'build')
+        ShardWriter(build_dir).write(0, self.book_ids, self.vectors)
+        paths = [os.path.join(self.tmp, name) for name in ('index.faiss', 'ids.npy', 'vectors.npy')]
+        assemble_index(build_dir, 'Flat', *paths, train_size=2000)
+        np.testing.assert_array_equal(np.load(paths[2]), self.vectors)
+
+        assemble_index(build_dir, 'IVF16,SQ8', *paths, train_size=2000)
+        self.assertFalse(os.path.exists(paths[2]))
+        self.assertNotIn('merged.npy', os.listdir(build_dir))
+
+    def test_index_and_book_ids_are_published_together(self):
+        build_dir = os.path.join(self.tmp, 'build')
+        ShardWriter(build_dir).write(0, self.book_ids, self.vectors)
+        paths = [os.path.join(self.tmp, name) for name in ('index.faiss', 'ids.npy', 'vectors.npy')]
+        published = []
+        for spec in ('Flat', 'IVF16,SQ8', 'Flat'):
+            time.sleep(0.001)  # version names are timestamps
+            assemble_index(build_dir, spec, *paths, train_size=2000)
+            version, index_path, book_ids_path, vectors_path = live_index_files(*paths)
+            published.append(version)
+            self.assertEqual({os.path.dirname(path) for path in (index_path, book_ids_path, vectors_path)},
+                             {os.path.join(versions_dir(paths[0]), version)})
+            self.assertEqual([os.path.realpath(path) for path in paths[:2]], [index_path, book_ids_path])
+
+        # The version replaced last is kept for readers still loading it
+        self.assertEqual(sorted(os.listdir(versions_dir(paths[0]))), sorted(['CURRENT', *published[1:]]))
+        state = BookRecommender(paths[0], paths[1], None).state
+        self.assertEqual((state.version, state.index.ntotal), (published[-1], self.num_books))
+
+    def test_index_and_book_ids_of_different_lengths_are_refused(self):
+        index_path, book_ids_path = os.path.join(self.tmp, 'index.faiss'), os.path.join(self.tmp, 'ids.npy')
+        index = faiss.IndexFlatL2(self.dimension)
+        index.add(self.vectors[:10])
+        faiss.write_index(index, index_path)
+        np.save(book_ids_path, np.arange(9))
+        with self.assertRaises(RecommenderUnavailable):
+            BookRecommender(index_path, book_ids_path, None).state
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ShardedSearchTests(SimpleTestCase):
+    num_books = 4000
+    dimension = 32
+    num_shards = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        tmp = cls.tmp_dir.name
+        rng = np.random.default_rng(0)
+        cls.vectors = rng.standard_normal((cls.num_books, cls.dimension), dtype=np.float32)
+        cls.queries = rng.standard_normal((20, cls.dimension), dtype=np.float32)
+        index = faiss.IndexFlatL2(cls.dimension)
+        index.add(cls.vectors)
+        book_ids = np.arange(1000, 1000 + cls.num_books, dtype=np.int64)
+        cls.single = IndexState(index, book_ids)
+
+        config = {**settings.RECOMMENDER, 'INDEX_PATH': os.path.join(tmp, 'book_index.faiss'),
+                  'BOOK_IDS_PATH': os.path.join(tmp, 'book_ids.npy')}
+        faiss.write_index(index, config['INDEX_PATH'])
+        np.save(config['BOOK_IDS_PATH'], book_ids)
+        shards_dir = os.path.join(tmp, 'shards')
+        with override_settings(RECOMMENDER=config):
+            call_command('partition_index', num_shards=cls.num_shards, output_dir=shards_dir, stdout=open(os.devnull, 'w'))
+
+        cls.addresses = [f"127.0.0.1:{_free_port()}" for _ in range(cls.num_shards)]
+        cls.servers = [
+            cls.start_server(os.path.join(shards_dir, f"shard-{shard}-of-{cls.num_shards}"), address)
+            for shard, address in enumerate(cls.addresses)
+        ]
+
+    @classmethod
+    def start_server(cls, prefix, address):
+        server = subprocess.Popen(
+            [sys.executable, 'manage.py', 'run_shard_server', f"{prefix}.faiss", f"{prefix}_ids.npy",
+             '--listen', address],
+            stdout=subprocess.PIPE, text=True, cwd=settings.BASE_DIR,
+        )
+        assert server.stdout.readline().startswith('Serving'), 'shard server did not start'
+        return server
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.kill()
+            server.wait()
+        cls.tmp_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.searcher = ShardedSearcher(self.addresses, timeout=2.0)
+        self.addCleanup(self.searcher.close)
+
+    def test_merged_results_match_single_index(self):
+        results, missing = self.searcher.search(self.queries, 10)
+        self.assertEqual(missing, [])
+        expected = self.single.nearest(self.queries, 10)
+        self.assertEqual([[book_id for _, book_id in found] for found in results],
+                         [[book_id for _, book_id in found] for found in expected])
+        for found, single_found in zip(results, expected):
+            np.testing.assert_allclose([d for d, _ in found], [d for d, _ in single_found], rtol=1e-6)
+
+    def test_state_excludes_and_looks_up_vectors_across_shards(self):
+        state = ShardedState(self.searcher)
+        vector = state.vector_for('1042')
+        np.testing.assert_array_equal(vector, self.vectors[42])
+        self.assertEqual(state.search(vector, 5, exclude='1042'), self.single.search(vector, 5, exclude='1042'))
+        self.assertEqual(state.search_many(self.queries[:3], 5, exclude={'1001'}),
+                         self.single.search_many(self.queries[:3], 5, exclude={'1001'}))
+        self.assertIsNone(state.vector_for('999999'))
+
+    def test_slow_shard_is_left_out(self):
+        self.searcher.timeout = 0.3
+        slow = self.servers[1]
+        os.kill(slow.pid, signal.SIGSTOP)
+        try:
+            with self.assertLogs('common.shard_search', 'WARNING'):
+                result = ShardedState(self.searcher).search(self.queries[0], 10)
+        finally:
+            os.kill(slow.pid, signal.SIGCONT)
+        self.assertEqual(result.missing_shards, [self.addresses[1]])
+        self.assertEqual(len(result), 10)
+
+    def test_version_changes_when_a_shard_comes_back_with_other_data(self):
+        prefix = os.path.join(self.tmp_dir.name, 'shards', f"shard-0-of-{self.num_shards}")
+        address = f"127.0.0.1:{_free_port()}"
+        server = self.start_server(prefix, address)
+        searcher = ShardedSearcher([address], timeout=2.0)
+        self.addCleanup(searcher.close)
+        state = ShardedState(searcher)
+        searcher.connect()
+        version = state.version
+
+        server.kill()
+        server.wait()
+        os.utime(f"{prefix}.faiss")  # as if partition_index had rewritten the shard
+        server = self.start_server(prefix, address)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.kill)
+        with self.assertLogs('common.shard_search', 'WARNING'):
+            with self.assertRaises(ShardsUnavailable):
+                state.search(self.queries[0], 5)  # the old connection went with the old server
+        self.assertEqual(state.version, version)
+        state.search(self.queries[0], 5)
+        self.assertNotEqual(state.version, version)
+
+
+class StubModel:
+    """Stands in for the sentence encoder and records what it was asked to encode."""
+
+    def __init__(self, vector):
+        self.vector = np.asarray(vector, dtype=np.float32)
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return np.tile(self.vector, (len(texts), 1))
+
+
+class SimilarBooksTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        index_path, book_ids_path = os.path.join(tmp_dir.name, 'index.faiss'), os.path.join(tmp_dir.name, 'ids.npy')
+        # Stored out of id order, so rows and ids differ
+        book_ids = ['30', '4', '100', '7']
+        index = faiss.IndexFlatL2(2)
+        index.add(np.array([[3, 0], [0, 0], [10, 0], [1, 0]], dtype=np.float32))
+        faiss.write_index(index, index_path)
+        np.save(book_ids_path, compact_book_ids(book_ids))
+        for book_id in book_ids:
+            Book.objects.create(id=book_id, title=f"Book {book_id}", isbn=book_id)
+
+        self.recommender = BookRecommender(index_path, book_ids_path, 'not-a-model', cache=RecommendationCache())
+        self.addCleanup(setattr, recommender_module, '_recommender', None)
+        recommender_module._recommender = self.recommender
+
+    def test_ids_map_to_their_rows(self):
+        state = self.recommender.state
+        self.assertEqual([state.row_for(book_id) for book_id in ('30', '4', '100', '7')], [0, 1, 2, 3])
+        self.assertIsNone(state.row_for('5'))
+
+    def test_similar_is_answered_from_the_index_without_the_model(self):
+        response = self.client.get(reverse('similar_books', kwargs={'pk': 4}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['id'] for book in response.json()], ['7', '30', '100'])
+        self.assertIsNone(self.recommender._model)
+
+    def test_similar_for_a_book_not_in_the_index_is_404(self):
+        Book.objects.create(id='5', title='Not indexed yet', isbn='5')
+        response = self.client.get(reverse('similar_books', kwargs={'pk': 5}))
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(self.recommender._model)
+
+    def test_only_books_missing_from_the_index_are_encoded(self):
+        model = self.recommender._model = StubModel([9, 0])
+        self.assertEqual(self.recommender.recommend_for_book('4', 'indexed', k=2), ['7', '30'])
+        self.assertEqual(model.encoded, [])
+        self.assertEqual(self.recommender.recommend_for_book('5', 'new book', k=2), ['100', '30'])
+        self.assertEqual(model.encoded, ['new book'])
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.batch_sizes = []
+
+    def encode(self, texts):
+        self.batch_sizes.append(len(texts))
+        return [[float(text)] for text in texts]
+
+    def submit_concurrently(self, batcher, requests):
+        with ThreadPoolExecutor(len(requests)) as pool:
+            return list(pool.map(batcher.submit, requests))
+
+    def test_batches_are_capped_at_max_batch_size(self):
+        # A long max_wait: batches close only when full
+        batcher = MicroBatcher(self.encode, max_batch_size=4, max_wait=5)
+        requests = [[str(i)] for i in range(8)]
+        results = self.submit_concurrently(batcher, requests)
+        self.assertEqual(self.batch_sizes, [4, 4])
+        self.assertEqual((batcher.batches, batcher.texts_encoded), (2, 8))
+        for request, vectors in zip(requests, results):
+            self.assertEqual(vectors.tolist(), [[float(request[0])]])
+
+    def test_a_lone_request_waits_at_most_max_wait(self):
+        batcher = MicroBatcher(self.encode, max_batch_size=64, max_wait=0.05)
+        started_at = time.monotonic()
+        vectors = batcher.submit(['1', '2', '3'])
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.05)
+        self.assertLess(time.monotonic() - started_at, 1)
+        self.assertEqual(self.batch_sizes, [3])
+        self.assertEqual(vectors.tolist(), [[1.0], [2.0], [3.0]])
+
+    def test_each_caller_gets_its_own_rows_of_a_shared_batch(self):
+        batcher = MicroBatcher(self.encode, max_batch_size=9, max_wait=5)
+        requests = [['1', '2'], ['3'], ['4', '5', '6'], ['7', '8', '9']]
+        results = self.submit_concurrently(batcher, requests)
+        self.assertEqual(self.batch_sizes, [9])
+        for request, vectors in zip(requests, results):
+            self.assertEqual(vectors.tolist(), [[float(text)] for text in request])
+
+    def test_encode_errors_reach_every_caller_of_the_batch(self):
+        def fail(texts):
+            raise RuntimeError('model crashed')
+        batcher = MicroBatcher(fail, max_batch_size=2, max_wait=5)
+        with ThreadPoolExecutor(2) as pool:
+            futures = [pool.submit(batcher.submit, [str(i)]) for i in range(2)]
+        for future in futures:
+            with self.assertRaisesMessage(RuntimeError, 'model crashed'):
+                future.result()
+
+
+class AuthorRelationsApiTests(TestCase):
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.create_user(username='editor', password='secret'))
+        Book.objects.create(id='b1', title='One', isbn='1')
+        Book.objects.create(id='b2', title='Two', isbn='2')
+
+    def relations(self, author_id):
+        return (
+            set(AuthorWork.objects.filter(author_id=author_id).values_list('work_id', flat=True)),
+            set(AuthorBookRef.objects.filter(author_id=author_id).values_list('book_id', flat=True)),
+            set(Book.objects.filter(authors__id=author_id).values_list('id', flat=True)),
+        )
+
+    def test_api_writes_keep_the_indexed_relations_in_step(self):
+        response = self.api.post(reverse('add_author'), {
+            'id': '7', 'name': 'Ursula K. Le Guin', 'work_ids': [1, 2], 'book_ids': ['b1', 'b9'],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.relations('7'), ({'1', '2'}, {'b1', 'b9'}, {'b1'}))
+
+        response = self.api.put(reverse('update_author', kwargs={'pk': 7}), {
+            'id': '7', 'name': 'Ursula K. Le Guin', 'work_ids': [2, 3], 'book_ids': ['b2'],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.relations('7'), ({'2', '3'}, {'b2'}, {'b1', 'b2'}))
+
+
+class TrigramSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        tolkien = Author.objects.create(id='1', name='J.R.R. Tolkien')
+        Author.objects.create(id='2', name='Christopher Tolkien')
+        hobbit = Book.objects.create(id='10', title='The Hobbit', isbn='10')
+        hobbit.authors.add(tolkien)
+        rings = Book.objects.create(id='11', title='The Fellowship of the Ring, by Tolkien', isbn='11')
+        rings.authors.add(tolkien)
+        Book.objects.create(id='12', title='Dune', isbn='12')
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            # The test tables are tiny, so make the planner show the index it would use on a real catalogue
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_book_search_uses_trigram_indexes(self):
+        plan = self.explain(*search.book_matches_sql('tolkien', 5))
+        self.assertIn('idx_book_title_trgm', plan)
+        self.assertIn('idx_author_name_trgm', plan)
+        self.assertNotIn('Seq Scan on apis_book ', plan)
+
+    def test_author_search_uses_trigram_index(self):
+        plan = self.explain(*search.author_matches_sql('tolkien', 5))
+        self.assertIn('idx_author_name_trgm', plan)
+
+    def test_books_matching_by_title_and_author_are_returned_once(self):
+        books = list(search.substring_books(Book.objects.all(), 'tolkien', 5).values_list('id', flat=True))
+        self.assertCountEqual(books, ['10', '11'])
+        self.assertEqual(search.substring_books(Book.objects.all(), '50%', 5).count(), 0)
+
+    def test_endpoints_keep_their_response_shape(self):
+        response = self.client.get('/apis/books/', {'search': 'hobb'})
+        self.assertEqual([book['id'] for book in response.json()], ['10'])
+        self.assertEqual(set(response.json()[0]), {
+            'id', 'created_at', 'updated_at', 'is_active', 'title', 'published_date', 'isbn', 'description',
+            'tsv_title', 'tsv_description', 'authors',
+        })
+        response = self.client.get('/apis/authors/', {'search': 'tolkien'})
+        self.assertCountEqual([author['id'] for author in response.json()], ['1', '2'])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'search vectors are maintained by a PostgreSQL trigger')
+class FullTextSearchTests(TestCase):
+    def vectors(self, book_id):
+        return Book.objects.values_list('tsv_title', 'tsv_description').get(id=book_id)
+
+    def test_trigger_fills_vectors_on_insert_and_on_text_updates(self):
+        book = Book.objects.create(id='1', title='The Hobbit', description='A dragon guards its gold', isbn='1')
+        tsv_title, tsv_description = self.vectors('1')
+        self.assertIn("'hobbit'", tsv_title)
+        self.assertIn("'dragon'", tsv_description)
+
+        book.title = 'The Silmarillion'
+        book.save()
+        tsv_title, _ = self.vectors('1')
+        self.assertIn("'silmarillion'", tsv_title)
+        self.assertNotIn("'hobbit'", tsv_title)
+
+        Book.objects.filter(id='1').update(description='Elves leave Valinor')
+        _, tsv_description = self.vectors('1')
+        self.assertIn("'valinor'", tsv_description)
+        self.assertNotIn("'dragon'", tsv_description)
+
+    def test_title_matches_rank_first(self):
+        Book.objects.create(id='1', title='Tales', description='Dragons, dragons and more dragons', isbn='1')
+        Book.objects.create(id='2', title='Dragon Tales', description='Stories for children', isbn='2')
+        Book.objects.create(id='3', title='Dune', description='Sand and spice', isbn='3')
+        self.assertEqual(list(search.fulltext(Book.objects.all(), 'dragon').values_list('id', flat=True)), ['2', '1'])
+
+        response = self.client.get('/apis/books/', {'search': 'dragons', 'mode': 'fulltext'})
+        self.assertEqual([book['id'] for book in response.json()], ['2', '1'])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the shard expression is PostgreSQL SQL')
+class ShardExpressionTests(TestCase):
+    def test_sql_shards_match_shard_of(self):
+        book_ids = [str(i) for i in range(300)] + ['OL123W', 'é-ü', 'a' * 200, ' spaced ']
+        Book.objects.bulk_create(
+            Book(id=book_id, title=book_id, isbn=f"isbn-{i}") for i, book_id in enumerate(book_ids)
+        )
+        export = ExportDataCommand()
+        for num_shards in (1, 3, 8):
+            for shard in range(num_shards):
+                with self.subTest(num_shards=num_shards, shard=shard):
+                    selected = [book_id for _, ids, _ in export._description_batches(100, 0, None, shard, num_shards)
+                                for book_id in ids]
+                    self.assertEqual(sorted(selected),
+                                     sorted(book_id for book_id in book_ids if shard_of(book_id, num_shards) == shard))
+
+
+class PrefixIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.items = {
+            book_id: (f"{rng.choice(['The ', ''])}{' '.join(rng.choice(list('xyz'), size=3))} {book_id}",
+                      int(rng.integers(100)))
+            for book_id in range(2000)
+        }
+        # A small scan limit makes most short prefixes precomputed, so both lookup paths are exercised
+        self.index = PrefixIndex.build(
+            [(book_id, label, score) for book_id, (label, score) in self.items.items()], top_k=5, scan_limit=20,
+        )
+
+    def expected(self, prefix, limit=5):
+        matches = [
+            book_id for book_id, (label, _) in self.items.items()
+            if label.lower().startswith(prefix) or label.lower().startswith('the ' + prefix)
+        ]
+        matches.sort(key=lambda book_id: (-self.items[book_id][1], self.items[book_id][0], book_id))
+        return [(book_id, self.items[book_id][0]) for book_id in matches[:limit]]
+
+    def assertMatchesScan(self):
+        for prefix in ['x', 'y z', 'the x', 'x y x', 'z x z 1']:
+            self.assertEqual(self.index.search(prefix), self.expected(prefix), prefix)
+
+    def test_search_ranks_by_score_and_skips_leading_articles(self):
+        self.assertMatchesScan()
+        self.assertEqual(self.index.search('  Y,Z! '), self.expected('y z'))
+        self.assertEqual(self.index.search(''), [])
+
+    def test_incremental_updates_match_a_rebuild(self):
+        rng = np.random.default_rng(1)
+        for step in range(500):
+            book_id = int(rng.integers(2200))
+            if step % 3 == 0:
+                self.items.pop(book_id, None)
+                self.index.remove(book_id)
+            else:
+                self.items[book_id] = (f"x {'y' if step % 2 else 'z'} {book_id}", int(rng.integers(200)))
+                self.index.add(book_id, *self.items[book_id])
+        self.assertMatchesScan()
+
+
+# Checkpoint state moves on commit, so the transactions must really commit
+class ImportRunTests(TransactionTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'authors.jsonl')
+        self.write([{'id': f"a{i}", 'name': f"Author {i}"} for i in range(4)])
+
+    def write(self, items, mode='w'):
+        with open(self.path, mode) as f:
+            f.writelines(json.dumps(item) + '\n' for item in items)
+
+    def test_resume_starts_after_the_committed_offset(self):
+        run = ImportRun('test', self.path)
+        run.range_read(10, 2)
+        run.range_read(20, 2)
+        with transaction.atomic():
+            run.batch_done(3)  # only the first range is finished
+        self.assertEqual(ImportRun('test', self.path, resume=True).start_offset, 10)
+        self.assertEqual(ImportRun('test', self.path).start_offset, 0)  # without --resume it starts over
+
+    def test_failed_commit_is_not_counted_twice(self):
+        run = ImportRun('test', self.path)
+        run.range_read(10, 2)
+        run.range_read(20, 2)
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                run.batch_done(2)
+                raise DatabaseError('commit failed')
+        run.batch_done(2)  # the batch is dead-lettered and reported once more
+        self.assertEqual(ImportRun('test', self.path, resume=True).start_offset, 10)
+
+    def test_completed_file_is_skipped_and_a_changed_one_is_not(self):
+        out = io.StringIO()
+        call_command('importdata', self.path, loader='orm', workers=1, stdout=out)
+        self.assertEqual(Author.objects.count(), 4)
+        Author.objects.all().delete()
+
+        out = io.StringIO()
+        call_command('importdata', self.path, resume=True, loader='orm', workers=1, stdout=out)
+        self.assertIn('has already been imported', out.getvalue())
+        self.assertEqual(Author.objects.count(), 0)
+
+        self.write([{'id': 'a9', 'name': 'Author 9'}], mode='a')  # a new fingerprint
+        run = ImportRun('importdata', self.path, resume=True)
+        self.assertEqual((run.start_offset, run.completed), (0, False))
+        call_command('importdata', self.path, resume=True, loader='orm', workers=1, stdout=io.StringIO())
+        self.assertEqual(Author.objects.count(), 5)
+
+
+# The rebuild thread reads through its own connection, so the test data must be committed
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'autocomplete-tests'},
+    },
+    AUTOCOMPLETE={'SNAPSHOT_PATH': None, 'TOP_K': 10, 'SHARED_ALIAS': 'shared'},
+)
+class AutocompleteSharingTests(TransactionTestCase):
+    def setUp(self):
+        caches['shared'].clear()
+        autocomplete._autocomplete = autocomplete._rebuild_thread = None
+        autocomplete._pending_favorites.clear()
+        autocomplete._favorites_published_at = 0.0
+        self.addCleanup(setattr, autocomplete, '_autocomplete', None)
+        Book.objects.create(id='1', title='Dune', isbn='1')
+
+    def titles(self, prefix):
+        return [book['title'] for book in autocomplete.get_autocomplete().suggest(prefix)['books']]
+
+    def test_writes_in_another_process_are_applied_from_the_log(self):
+        self.assertEqual(self.titles('du'), ['Dune'])
+        # What another worker's signal handlers leave behind: the row, and a log entry
+        Book.objects.bulk_create([Book(id='2', title='Dune Messiah', isbn='2')])
+        autocomplete._append([('add', 'books', '2', 'Dune Messiah', 0)])
+
+        self.assertEqual(self.titles('du'), ['Dune', 'Dune Messiah'])
+        self.assertEqual(autocomplete.get_autocomplete().changes, autocomplete.shared_changes())
+        self.assertIsNone(autocomplete._rebuild_thread)
+
+    def test_falling_behind_the_log_triggers_a_rebuild(self):
+        self.assertEqual(self.titles('du'), ['Dune'])
+        Book.objects.bulk_create([Book(id='2', title='Dune Messiah', isbn='2')])
+        with self.settings(AUTOCOMPLETE={**settings.AUTOCOMPLETE, 'LOG_SIZE': 2}):
+            for _ in range(3):
+                autocomplete._append([('add', 'books', '2', 'Dune Messiah', 0)])
+            self.assertIsNone(caches['shared'].get(autocomplete.ENTRY_KEY.format(1)))
+
+            autocomplete.get_autocomplete()  # starts the rebuild; the old index answers meanwhile
+            autocomplete._rebuild_thread.join()
+        self.assertEqual(self.titles('du'), ['Dune', 'Dune Messiah'])
+        self.assertEqual(autocomplete.get_autocomplete().changes, autocomplete.shared_changes())
+
+    def test_own_writes_do_not_trigger_a_rebuild(self):
+        self.assertEqual(self.titles('du'), ['Dune'])
+        Book.objects.create(id='2', title='Dune Messiah', isbn='2')
+        self.assertEqual(autocomplete.get_autocomplete().changes, autocomplete.shared_changes())
+        self.assertEqual(self.titles('du'), ['Dune', 'Dune Messiah'])
+        self.assertIsNone(autocomplete._rebuild_thread)
+
+    def test_favourite_counts_are_logged_in_batches(self):
+        self.assertEqual(self.titles('du'), ['Dune'])
+        Book.objects.create(id='2', title='Dune Messiah', isbn='2')
+        users = [User.objects.create_user(f"reader{i}", password='secret') for i in range(3)]
+        changes = autocomplete.shared_changes()
+
+        def logged():
+            return caches['shared'].get(autocomplete.ENTRY_KEY.format(autocomplete.shared_changes()))
+
+        Favorite.objects.create(user=users[0], book_id='2')
+        self.assertEqual(autocomplete.shared_changes(), changes + 1)
+        self.assertEqual(logged(), [('favorites', 'books', '2', None, 1)])
+
+        # Within FAVORITES_INTERVAL: applied here right away, logged later in one entry
+        for user in users[1:]:
+            Favorite.objects.create(user=user, book_id='2')
+        Favorite.objects.create(user=users[0], book_id='1')
+        self.assertEqual(autocomplete.shared_changes(), changes + 1)
+        self.assertEqual(self.titles('du'), ['Dune Messiah', 'Dune'])
+
+        autocomplete._favorites_published_at = 0.0
+        autocomplete.get_autocomplete()
+        self.assertEqual(autocomplete.shared_changes(), changes + 2)
+        self.assertEqual(sorted(logged()), [('favorites', 'books', '1', None, 1), ('favorites', 'books', '2', None, 3)])
+
+        # Entries hold counts, not deltas, so applying one again changes nothing
+        index = autocomplete.get_autocomplete()
+        index.apply(logged())
+        self.assertEqual(index.books.get('2'), ('Dune Messiah', 3))
+
+
+# A transaction per import, so now() differs between imports and updated_at changes can be seen
+class ImportUpsertTests(TransactionTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+        Author.objects.create(id='a1', name='Author One')
+        Author.objects.create(id='a2', name='Author Two')
+
+    def run_import(self, command, name, items, loader):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(item) + '\n' for item in items)
+        out = io.StringIO()
+        call_command(command, path, upsert=True, loader=loader, workers=1, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def check_book_upsert(self, loader):
+        def book(book_id, description, isbn=None, authors=('a1',)):
+            return {'id': book_id, 'title': book_id.upper(), 'isbn13': isbn or f"isbn-{book_id}",
+                    'description': description, 'authors': [{'id': author} for author in authors]}
+
+        def changes_since(change_id):
+            return set(BookChange.objects.filter(id__gt=change_id).values_list('book_id', 'operation'))
+
+        out = self.run_import('importbook', 'first.jsonl', [book('b1', 'one'), book('b2', 'two')], loader)
+        self.assertIn('2 inserted, 0 updated, 0 unchanged, 0 skipped', out)
+        self.assertEqual(changes_since(0), {('b1', BookChange.CREATED), ('b2', BookChange.CREATED)})
+        stamps = dict(Book.objects.values_list('id', 'updated_at'))
+        last_change = BookChange.objects.latest('id').id
+        cache = RecommendationCache()
+        patcher = mock.patch.object(recommender_module, '_recommender',
+                                    BookRecommender('unused', 'unused', 'not-a-model', cache=cache))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for book_id in ('b1', 'b2'):
+            cache.set(book_id, 5, 'v1', ['b9'])
+
+        out = self.run_import('importbook', 'second.jsonl', [
+            book('b1', 'one'),
+            book('b2', 'two, revised', authors=('a1', 'a2')),
+            book('b3', 'three'),
+            book('b3', 'three again'),  # repeated id: the first row wins
+            book('b4', 'four', isbn='shared'),
+            book('b5', 'five', isbn='shared'),  # ISBN taken earlier in the batch
+            book('b6', 'six', isbn='isbn-b1'),  # ISBN owned by another book
+        ], loader)
+        self.assertIn('2 inserted, 1 updated, 1 unchanged, 2 skipped', out)
+        # run_indexer re-embeds the changed book, and its cached recommendations are gone
+        self.assertEqual(changes_since(last_change), {
+            ('b2', BookChange.UPDATED), ('b3', BookChange.CREATED), ('b4', BookChange.CREATED),
+        })
+        self.assertIsNone(cache.get('b2', 5, 'v1'))
+        self.assertEqual(cache.get('b1', 5, 'v1'), ['b9'])
+
+        books = {book.id: book for book in Book.objects.all()}
+        self.assertEqual(set(books), {'b1', 'b2', 'b3', 'b4'})
+        self.assertEqual(books['b1'].updated_at, stamps['b1'])
+        self.assertGreater(books['b2'].updated_at, stamps['b2'])
+        self.assertEqual(books['b2'].description, 'two, revised')
+        self.assertEqual(set(books['b2'].authors.values_list('id', flat=True)), {'a1', 'a2'})
+        self.assertEqual(books['b3'].description, 'three')
+
+    def check_author_upsert(self, loader):
+        def author(author_id, work_ids, book_ids):
+            return {'id': author_id, 'name': author_id.upper(), 'work_ids': work_ids, 'book_ids': book_ids}
+
+        out = self.run_import('importdata', 'first.jsonl', [
+            author('a3', [1, 2], ['b8']), author('a4', [5], []),
+        ], loader)
+        self.assertIn('2 inserted, 0 updated, 0 unchanged', out)
+        stamps = dict(Author.objects.values_list('id', 'updated_at'))
+
+        out = self.run_import('importdata', 'second.jsonl', [
+            author('a3', [3], ['b9']), author('a4', [5], []), author('a5', [], []),
+        ], loader)
+        self.assertIn('1 inserted, 1 updated, 1 unchanged', out)
+        self.assertEqual(Author.objects.get(id='a4').updated_at, stamps['a4'])
+        self.assertGreater(Author.objects.get(id='a3').updated_at, stamps['a3'])
+        self.assertEqual(set(AuthorWork.objects.filter(author_id='a3').values_list('work_id', flat=True)), {'3'})
+        self.assertEqual(set(AuthorBookRef.objects.filter(author_id='a3').values_list('book_id', flat=True)), {'b9'})
+        self.assertEqual(set(AuthorWork.objects.filter(author_id='a4').values_list('work_id', flat=True)), {'5'})
+
+    def test_orm_book_upsert(self):
+        self.check_book_upsert('orm')
+
+    def test_orm_author_upsert(self):
+        self.check_author_upsert('orm')
+
+    def test_rejected_books_are_dead_lettered_for_replay(self):
+        books = [
+            {'id': f"b{i}", 'title': f"Book {i}", 'isbn13': f"isbn-{i}", 'publication_date': '2001-02',
+             'authors': [{'id': 'a1'}]}
+            for i in range(8)
+        ]
+        del books[5]['title']  # NOT NULL: fails its batch
+        path = os.path.join(self.tmp, 'books.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(item) + '\n' for item in books[:3])
+            f.write('{"id": "broken\n')
+            f.writelines(json.dumps(item) + '\n' for item in books[3:])
+        call_command('importbook', path, upsert=True, loader='orm', workers=1,
+                     stdout=io.StringIO(), stderr=io.StringIO())
+
+        # Only the rejected book is left out of the batch
+        self.assertEqual(set(Book.objects.values_list('id', flat=True)), {f"b{i}" for i in range(8)} - {'b5'})
+        with open(f"{path}.failed.jsonl") as f:
+            line, record = f.read().splitlines()
+        self.assertEqual(line, '{"id": "broken')
+        item = json.loads(record)
+        self.assertIn('_error', item)
+        self.assertEqual(item['id'], 'b5')
+        self.assertEqual(item['authors'], [{'id': 'a1'}])
+
+        item['title'] = 'Book 5'
+        out = self.run_import('importbook', 'replay.jsonl', [item], 'orm')
+        self.assertIn('1 inserted, 0 updated, 0 unchanged, 0 skipped', out)
+        book = Book.objects.get(id='b5')
+        self.assertEqual(book.published_date, datetime.date(2001, 2, 1))
+        self.assertEqual(list(book.authors.values_list('id', flat=True)), ['a1'])
+        # The record is read back as it was first parsed, apart from the fixed title
+        self.assertEqual(
+            book.content_hash,
+            book_record({**books[5], 'title': 'Book 5'})[0][-1],
+        )
+
+    @unittest.skipUnless(copy_loader.is_available(), 'COPY needs PostgreSQL')
+    def test_copy_book_upsert(self):
+        self.check_book_upsert('copy')
+
+    @unittest.skipUnless(copy_loader.is_available(), 'COPY needs PostgreSQL')
+    def test_copy_author_upsert(self):
+        self.check_author_upsert('copy')
+
+
+class JsonlReaderTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'items.jsonl')
+        self.ids = [f"item-{i}-{'x' * (i % 7)}" for i in range(200)]
+        # No newline after the last line
+        self.write(b'\n'.join(json.dumps({'id': item_id}).encode() for item_id in self.ids))
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def parse_all(self, ranges):
+        records, failures = [], []
+        for start, end in ranges:
+            parsed, failed = parse_range(self.path, start, end, operator.itemgetter('id'))
+            records.extend(parsed)
+            failures.extend(failed)
+        return records, failures
+
+    def test_ranges_cut_at_line_ends_and_cover_the_file(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        ranges = list(byte_ranges(self.path, chunk_bytes=50))  # cuts fall inside lines
+        self.assertGreater(len(ranges), 10)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (_, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual(data[end - 1:end], b'\n')
+        self.assertEqual(self.parse_all(ranges), (self.ids, []))
+
+    def test_ranges_start_at_an_offset(self):
+        with open(self.path, 'rb') as f:
+            offset = len(b''.join(f.readline() for _ in range(120)))
+        records, _ = self.parse_all(byte_ranges(self.path, chunk_bytes=64, start=offset))
+        self.assertEqual(records, self.ids[120:])
+        self.assertEqual(list(byte_ranges(self.path, start=os.path.getsize(self.path))), [])
+
+    def test_blank_and_undecodable_lines(self):
+        self.write(b'{"id": "a"}\n\n   \n{"id": \n\xff\xfe\n{"name": "no id"}\n{"id": "b"}\n')
+        records, failures = parse_range(self.path, 0, os.path.getsize(self.path), operator.itemgetter('id'))
+        self.assertEqual(records, ['a', 'b'])
+        self.assertEqual([line for line, _ in failures], ['{"id": ', '\ufffd\ufffd', '{"name": "no id"}'])
+        self.assertTrue(failures[2][1].startswith('KeyError'))
+
+    def test_worker_results_keep_file_order(self):
+        chunks = list(iter_chunks(self.path, operator.itemgetter('id'), workers=3, chunk_bytes=40, max_pending=4))
+        self.assertEqual([record for _, _, records, _ in chunks for record in records], self.ids)
+        self.assertEqual([start for start, _, _, _ in chunks[1:]], [end for _, end, _, _ in chunks[:-1]])
+        self.assertEqual(chunks, list(iter_chunks(self.path, operator.itemgetter('id'), chunk_bytes=40)))
+
+
+class IncrementalIndexTests(SimpleTestCase):
+    dimension = 16
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((500, self.dimension), dtype=np.float32)
+        self.book_ids = np.arange(1, 501).astype(str)
+
+    def build(self, spec):
+        built = faiss.index_factory(self.dimension, spec)
+        built.train(self.vectors)
+        built.add(self.vectors)
+        return IncrementalIndex.from_index(built, self.book_ids)
+
+    def nearest(self, index, vector):
+        inner, book_ids, excluded_rows = index.serving_parts()
+        return IndexState(inner, book_ids, excluded_rows=excluded_rows).search(vector, 1)
+
+    def test_apply_replaces_and_removes_books(self):
+        for spec in ('Flat', 'IVF4,Flat'):
+            with self.subTest(spec=spec):
+                index = self.build(spec)
+                new_vector = -self.vectors[9]
+                index.apply({10: new_vector, 1000: self.vectors[0] + 100}, {20})
+                self.assertEqual(index.live_count, 500)
+                self.assertEqual(self.nearest(index, new_vector), ['10'])
+                self.assertNotEqual(self.nearest(index, self.vectors[9]), ['10'])
+                self.assertNotEqual(self.nearest(index, self.vectors[19]), ['20'])
+                self.assertEqual(self.nearest(index, self.vectors[0] + 100), ['1000'])
+
+    def test_non_flat_indexes_tombstone_until_compacted(self):
+        index = self.build('IVF4,Flat')
+        index.apply({}, {1, 2, 3})
+        self.assertEqual(index.index.ntotal, 500)
+        self.assertEqual(len(index.tombstones), 3)
+        self.assertEqual(list(index.serving_parts()[1][:3]), [-1, -1, -1])
+
+        index.compact()
+        self.assertEqual(len(index.tombstones), 0)
+        self.assertEqual(index.index.ntotal, 497)
+        self.assertNotIn(1, index.ids)
+        self.assertEqual(self.nearest(index, self.vectors[3]), ['4'])
+
+    def test_versions_are_saved_and_loaded_through_current(self):
+        self.assertIsNone(IncrementalIndex.load(self.directory))
+        index = self.build('IVF4,Flat')
+        index.apply({}, {5})
+        first = index.save(self.directory, 7, keep_versions=2, gaps=[4, 6], keep_seconds=0)
+        for cursor in (8, 9):
+            time.sleep(0.001)  # version names are timestamps
+            index.save(self.directory, cursor, keep_versions=2, keep_seconds=0)
+
+        loaded = IncrementalIndex.load(self.directory)
+        self.assertEqual((loaded.version, loaded.cursor, loaded.gaps), (index.version, 9, []))
+        self.assertEqual(list(loaded.tombstones), list(index.tombstones))
+        self.assertEqual(list(loaded.ids), list(index.ids))
+        self.assertEqual(read_current(self.directory)['version'], index.version)
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.faiss')]), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f"index-{first}.faiss")))
+
+
+    def test_recently_replaced_versions_are_kept(self):
+        index = self.build('Flat')
+        first = index.save(self.directory, 1, keep_versions=1)
+        time.sleep(0.001)
+        index.save(self.directory, 2, keep_versions=1)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f"index-{first}.faiss")))
+
+        # The first was replaced long enough ago; the second only now
+        time.sleep(0.05)
+        index.save(self.directory, 3, keep_versions=1, keep_seconds=0.01)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f"index-{first}.faiss")))
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.faiss')]), 2)
+
+    def test_load_follows_current_when_its_version_was_removed(self):
+        index = self.build('Flat')
+        index.save(self.directory, 1, keep_seconds=0)
+        stale = read_current(self.directory)
+        time.sleep(0.001)
+        index.save(self.directory, 2, keep_versions=1, keep_seconds=0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, stale['index'])))
+
+        # The reader saw CURRENT just before the indexer replaced it and removed the old version
+        with mock.patch('common.incremental_index.read_current', side_effect=[stale, read_current(self.directory)]):
+            loaded = IncrementalIndex.load(self.directory)
+        self.assertEqual((loaded.version, loaded.cursor), (index.version, 2))
+
+
+class ChangeLogTests(TestCase):
+    def log(self, *ids):
+        BookChange.objects.bulk_create(BookChange(id=i, book_id=str(i), operation=BookChange.UPDATED) for i in ids)
+
+    def test_position_remembers_ids_that_were_not_committed(self):
+        self.log(1, 2, 4, 7)
+        position = change_log.current_position()
+        self.assertEqual(position, {'cursor': 7, 'gaps': [3, 5, 6]})
+
+        self.log(5, 8)  # 5 committed late
+        changes = change_log.pending_changes(position, limit=10)
+        self.assertEqual([change.id for change in changes], [5, 8])
+        self.assertEqual(change_log.advance(position, changes), {'cursor': 8, 'gaps': [3, 6]})
+
+    def test_limited_batches_leave_no_ids_behind(self):
+        self.log(1, 2, 3, 5, 6)
+        position = change_log.START
+        seen = []
+        while True:
+            changes = change_log.pending_changes(position, limit=2)
+            if not changes:
+                break
+            seen.extend(change.id for change in changes)
+            position = change_log.advance(position, changes)
+        self.assertEqual(seen, [1, 2, 3, 5, 6])
+        self.assertEqual(position, {'cursor': 6, 'gaps': [4]})
+
+    def test_builds_start_from_the_earliest_shard_position(self):
+        self.assertIsNone(change_log.earliest([{'cursor': 3, 'gaps': []}, None]))
+        self.assertEqual(change_log.earliest([{'cursor': 9, 'gaps': []}, {'cursor': 3, 'gaps': [2]}]),
+                         {'cursor': 3, 'gaps': [2]})
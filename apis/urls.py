@@ -2,29 +2,40 @@
 from django.contrib import admin
 from django.urls import path
 
-from apis.views import UserSignUpView, UserLoginView, BooksAPIViewSet, AuthorAPIViewSet, FavoriteBooksAPIViewSet
+from apis.views import UserSignUpView, UserLoginView, BooksAPIViewSet, AuthorAPIViewSet, FavoriteBooksAPIViewSet, \
+    RecommendationCacheStatsView, AutocompleteView
 
 urlpatterns = [
     # User related APIs
     path('add_user/', UserSignUpView.as_view({"post": "create"}), name='add_user'),
-    path("login/", UserLoginView.as_view({"post": "create"}), name="user_login"),
+    path("login/", UserLoginView.as_view(), name="user_login"),
 
     # Book related APIs
     path("books/", BooksAPIViewSet.as_view({"get": "list"}), name="books"),
     path("book/<int:pk>/", BooksAPIViewSet.as_view({"get": "retrieve"}), name="book"),
+    path("book/<int:pk>/similar/", BooksAPIViewSet.as_view({"get": "similar"}), name="similar_books"),
     path("add_book/", BooksAPIViewSet.as_view({"post": "create"}), name="add_book"),
     path("update_book/<int:pk>/", BooksAPIViewSet.as_view({"put": "update"}), name="update_book"),
     path("delete_book/<int:pk>/", BooksAPIViewSet.as_view({"delete": "destroy"}), name="delete_book"),
 
+    # Search related APIs
+    path("autocomplete/", AutocompleteView.as_view(), name="autocomplete"),
+
     # Author related APIs
     path("authors/", AuthorAPIViewSet.as_view({"get": "list"}), name="authors"),
     path("author/<int:pk>/", AuthorAPIViewSet.as_view({"get": "retrieve"}), name="author"),
+    path("author/<int:pk>/books/", AuthorAPIViewSet.as_view({"get": "books"}), name="author_books"),
     path("add_author/", AuthorAPIViewSet.as_view({"post": "create"}), name="add_author"),
     path("update_author/<int:pk>/", AuthorAPIViewSet.as_view({"put": "update"}), name="update_author"),
     path("delete_author/<int:pk>/", AuthorAPIViewSet.as_view({"delete": "destroy"}), name="delete_author"),
 
     # Favourite related APIs
     path("favorites/", FavoriteBooksAPIViewSet.as_view({"get": "list", "post": "create"}), name="favorites-list-create"),
+    path("favorites/recommendations/", FavoriteBooksAPIViewSet.as_view({"get": "recommendations"}),
+         name="favorites-recommendations"),
     path("favorites/<int:pk>/", FavoriteBooksAPIViewSet.as_view({"delete": "destroy"}), name="favorites-delete"),
 
+    # Recommendation related APIs
+    path("recommendations/cache/", RecommendationCacheStatsView.as_view(), name="recommendation-cache-stats"),
+
 ]
@@ -1,23 +1,27 @@
 from django.contrib.auth import authenticate
-from django.db.models import Q, Count
+from django.db import transaction
+from django.db.models import Count
 from rest_framework import status
 from rest_framework.generics import DestroyAPIView
 from django.contrib.auth import authenticate, login as django_login
 from rest_framework.views import APIView
 
-from apis.models import User, Author
-from apis.serializers import UserSignupSerializer, UserLoginSerializer, AuthorSerializer
+from apis import search
+from apis.autocomplete import get_autocomplete
+from apis.models import User, Author, AuthorBookRef, AuthorWork
+from apis.serializers import UserSignupSerializer, UserLoginSerializer, AuthorSerializer, AuthorSummarySerializer
 from common.response_mixins import BaseAPIView
 from rest_framework.viewsets import ModelViewSet
 
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from common.utils import recommend_books
+from common.recommender import RecommenderUnavailable, get_recommender
+from common.utils import recommend_for_book, recommend_for_favorites, similar_books
 from .models import Book, Favorite
 from .serializers import BookSerializer, FavoriteSerializer
 
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.pagination import LimitOffsetPagination
 
 
@@ -41,13 +45,27 @@ class BooksAPIViewSet(BaseAPIView, ModelViewSet):
         search_query = self.request.query_params.get('search', None)
         queryset = Book.objects.all()
 
-        if search_query:
-            queryset = queryset.filter(
-                Q(title__icontains=search_query) |
-                Q(authors__name__icontains=search_query)
-            )
+        if search_query and self.request.query_params.get('mode') == 'fulltext':
+            # Ranked match on the indexed title and description search vectors
+            queryset = search.fulltext(queryset, search_query)
+        elif search_query:
+            # Trigram-indexed substring match on titles and author names, most similar first
+            queryset = search.substring_books(queryset, search_query, limit=5)
         return queryset[:5]  # Limit to 5 results
 
+    def similar(self, request, *args, **kwargs):
+        """Books similar to an indexed book, answered from the index alone."""
+        try:
+            similar_ids = similar_books(kwargs['pk'])
+        except RecommenderUnavailable:
+            return Response({"error": "Recommendations are unavailable."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if similar_ids is None:
+            return Response({"error": "Book not found in the recommendation index."}, status=status.HTTP_404_NOT_FOUND)
+
+        books = Book.objects.in_bulk(similar_ids)
+        book_list = [books[book_id] for book_id in similar_ids if book_id in books]
+        return Response(BookSerializer(book_list, many=True).data)
+
 class BookDeleteAPIView(BaseAPIView, DestroyAPIView):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
@@ -73,15 +91,58 @@ class AuthorAPIViewSet(BaseAPIView, ModelViewSet):
             self.permission_classes = [IsAuthenticated]
         return super().get_permissions()
 
+    def get_serializer_class(self):
+        if self.request.method in ['GET']:
+            return AuthorSummarySerializer
+        return AuthorSerializer
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            self._sync_listed_ids(serializer.save())
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            self._sync_listed_ids(serializer.save())
+
+    def _sync_listed_ids(self, author):
+        """
+        Make AuthorWork / AuthorBookRef match the author's listed ids, and link
+        the listed books that exist, as the importers do for imported authors.
+        Links are only added: a book's own record may list the author too.
+        """
+        work_ids = {str(work_id) for work_id in author.work_ids} if isinstance(author.work_ids, list) else set()
+        book_ids = {str(book_id) for book_id in author.book_ids} if isinstance(author.book_ids, list) else set()
+        author.works.exclude(work_id__in=work_ids).delete()
+        author.book_refs.exclude(book_id__in=book_ids).delete()
+        AuthorWork.objects.bulk_create(
+            [AuthorWork(author=author, work_id=work_id) for work_id in work_ids], ignore_conflicts=True,
+        )
+        AuthorBookRef.objects.bulk_create(
+            [AuthorBookRef(author=author, book_id=book_id) for book_id in book_ids], ignore_conflicts=True,
+        )
+        author.books.add(*Book.objects.filter(id__in=book_ids).values_list('id', flat=True))
+
     def get_queryset(self):
         search_query = self.request.query_params.get('search', None)
         queryset = Author.objects.all()
+        if self.request.method in ['GET']:
+            # The id lists can be large; reads use AuthorWork / AuthorBookRef and the books endpoint instead
+            queryset = queryset.defer('work_ids', 'book_ids', 'content_hash')
 
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query)
-            )
-        return queryset[:5]  # Limit to 5 results
+            queryset = search.substring_authors(queryset, search_query, limit=5)
+        if self.action == 'list':
+            return queryset[:5]  # Limit to 5 results
+        return queryset
+
+    def books(self, request, *args, **kwargs):
+        """An author's books, read through the indexed book-author link table."""
+        if not Author.objects.filter(pk=kwargs['pk']).exists():
+            return Response({"error": "Author not found"}, status=status.HTTP_404_NOT_FOUND)
+        queryset = Book.objects.filter(authors__id=kwargs['pk']).prefetch_related('authors').order_by('id')
+        paginator = DefaultPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(BookSerializer(page, many=True).data)
 
 
 class UserSignUpView(BaseAPIView, ModelViewSet):
@@ -158,10 +219,53 @@ class FavoriteBooksAPIViewSet(ModelViewSet):
             return Response({"error": "Max of 20 favorite books allowed."}, status=400)
 
         favorite, created = Favorite.objects.get_or_create(user=user, book_id=book_id)
-        recommendations = recommend_books(favorite.book.description)
+        try:
+            recommendations = recommend_for_book(favorite.book)
+        except RecommenderUnavailable:
+            recommendations = []
         book_list = Book.objects.filter(id__in=recommendations)
         serializer = self.get_serializer(favorite)
         return Response({
             "favorite": serializer.data,
             "recommendations": BookSerializer(book_list, many=True).data
         })
+
+    def recommendations(self, request, *args, **kwargs):
+        """Recommendations based on all of the user's favourites, excluding books already favourited."""
+        mode = request.query_params.get('mode', 'batch')
+        if mode not in ('batch', 'centroid'):
+            return Response({"error": "Mode must be 'batch' or 'centroid'."}, status=400)
+
+        favorites = list(self.get_queryset().values_list('book_id', 'book__description')[:20])
+        try:
+            recommended_ids = recommend_for_favorites(favorites, mode=mode)
+        except RecommenderUnavailable:
+            return Response({"error": "Recommendations are unavailable."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        books = Book.objects.in_bulk(recommended_ids)
+        book_list = [books[book_id] for book_id in recommended_ids if book_id in books]
+        return Response({"recommendations": BookSerializer(book_list, many=True).data})
+
+
+class RecommendationCacheStatsView(BaseAPIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return self.send_success_response(
+            message="Recommendation cache statistics.",
+            data=get_recommender().cache.stats(),
+        )
+
+
+class AutocompleteView(APIView):
+    """Type-ahead suggestions for titles and author names, answered from memory without a database query."""
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        text = request.query_params.get('q', '')
+        try:
+            limit = int(request.query_params.get('limit', 5))
+        except ValueError:
+            return Response({"error": "limit must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_autocomplete().suggest(text, max(limit, 1)))
@@ -0,0 +1,239 @@
+"""
+Append-only, resumable storage for an index build.
+
+Every encoded batch is written as its own shard: ``batch-<n>.npy``
+(float32 vectors) and ``batch-<n>.ids.npy`` (book ids). Only after both
+files are durable is a line appended to ``manifest.jsonl``, so the
+manifest never names a shard that is not complete. Checkpointing a batch
+costs O(batch), whatever the size of the catalogue.
+
+A large build can be split into independent builds over disjoint slices
+of the book ids (see ``shard_of``), each with its own build directory. The
+serving index is assembled from the shards of one or more builds once, at
+the end, in book id order, so a split build gives the same index as a
+single one. It is published as a new version of the serving files (see
+``common.index_files``), index and book ids together.
+"""
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+from common.index_files import (
+    BOOK_IDS_FILE, INDEX_FILE, VECTORS_FILE, atomic_save_npy, compact_book_ids, discard_version, fsync_file,
+    publish_version, start_version,
+)
+from common.vector_index import create_index, sample_rows, set_search_params, train_index
+
+MANIFEST = 'manifest.jsonl'
+COMPLETE_FILE = 'COMPLETE'
+
+
+# ``shard_of`` as a PostgreSQL expression over the column ``{column}``; takes the shard count and shard as parameters
+SHARD_OF_SQL = "('x' || substr(md5({column}), 1, 8))::bit(32)::bigint %% %s = %s"
+
+
+def shard_of(book_id, num_shards):
+    """
+    The build shard a book belongs to: its md5's first 32 bits modulo ``num_shards``.
+
+    ``export_data`` evaluates the same assignment in SQL (``SHARD_OF_SQL``),
+    so the database only returns the books of the shard being built.
+    """
+    return int(hashlib.md5(str(book_id).encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+
+def shard_build_dir(build_dir, shard, num_shards):
+    return os.path.join(build_dir, f"shard-{shard}-of-{num_shards}")
+
+
+def is_complete(build_dir):
+    return os.path.exists(os.path.join(build_dir, COMPLETE_FILE))
+
+
+def read_manifest(build_dir):
+    """Completed shards, in the order they were written; a torn last line is ignored."""
+    entries = []
+    try:
+        with open(os.path.join(build_dir, MANIFEST)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class ShardWriter:
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        os.makedirs(build_dir, exist_ok=True)
+
+    def resume(self):
+        """
+        Keep the longest run of shards numbered 0, 1, 2, ... and drop the rest.
+
+        Batches finish out of order, so shards after a gap are discarded;
+        the build restarts right after the last id of the kept run. Returns
+        ``(next_batch_no, last_id)``, with ``last_id`` None for a fresh build.
+        """
+        self._remove(COMPLETE_FILE)
+        by_batch = {entry['batch']: entry for entry in read_manifest(self.build_dir)}
+        kept = []
+        while len(kept) in by_batch:
+            kept.append(by_batch[len(kept)])
+        self._rewrite_manifest(kept)
+        keep_files = {name for entry in kept for name in (entry['vectors'], entry['ids'])}
+        for name in os.listdir(self.build_dir):
+            if name.startswith('batch-') and name not in keep_files:
+                os.remove(os.path.join(self.build_dir, name))
+        return len(kept), (kept[-1]['last_id'] if kept else None)
+
+    def write(self, batch_no, book_ids, vectors):
+        vectors_name = f"batch-{batch_no:06d}.npy"
+        ids_name = f"batch-{batch_no:06d}.ids.npy"
+        atomic_save_npy(os.path.join(self.build_dir, vectors_name), np.asarray(vectors, dtype=np.float32))
+        atomic_save_npy(os.path.join(self.build_dir, ids_name), np.asarray(book_ids))
+        entry = {
+            'batch': batch_no, 'vectors': vectors_name, 'ids': ids_name,
+            'count': len(book_ids), 'last_id': str(book_ids[-1]),
+        }
+        with open(os.path.join(self.build_dir, MANIFEST), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def mark_complete(self):
+        """Record that every book of this build has been written."""
+        with open(os.path.join(self.build_dir, COMPLETE_FILE), 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.build_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def _rewrite_manifest(self, entries):
+        tmp_path = os.path.join(self.build_dir, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.build_dir, MANIFEST))
+
+
+def iter_shards(build_dir):
+    """``(ids, vectors)`` for every shard in batch order; vectors are memory-mapped."""
+    for entry in sorted(read_manifest(build_dir), key=lambda entry: entry['batch']):
+        yield (
+            np.load(os.path.join(build_dir, entry['ids'])),
+            np.load(os.path.join(build_dir, entry['vectors']), mmap_mode='r'),
+        )
+
+
+def assemble_index(build_dirs, index_spec, index_path, book_ids_path, vectors_path=None,
+                   train_size=100000, nprobe=None, ef_search=None, chunk_size=100000):
+    """
+    Merge the shards of one or more builds into the serving index and publish it.
+
+    Vectors are first gathered into one memory-mapped matrix sorted by book
+    id, so the result does not depend on how the build was split or in which
+    order batches finished. For a flat index, that matrix also becomes the
+    raw vectors file at ``vectors_path`` for the memory-mapped serving mode;
+    for any other index a file left there by an earlier build is removed.
+    Returns the number of books indexed.
+    """
+    if isinstance(build_dirs, str):
+        build_dirs = [build_dirs]
+    shards = [shard for build_dir in build_dirs for shard in iter_shards(build_dir)]
+    if not shards:
+        raise ValueError(f"No completed shards in {', '.join(build_dirs)}")
+    book_ids = np.concatenate([ids for ids, _ in shards])
+    order = np.argsort(book_ids, kind='stable')
+    sorted_ids = book_ids[order]
+    if len(sorted_ids) > 1 and (sorted_ids[1:] == sorted_ids[:-1]).any():
+        raise ValueError("A book appears in more than one shard; were the builds split with the same shard count?")
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+
+    index = create_index(index_spec, shards[0][1].shape[1])
+    keep_vectors = vectors_path is not None and is_flat(index)
+    version_dir = start_version(index_path)
+    # For a flat index the merged matrix is the raw vectors file of the new version
+    staging_path = (os.path.join(version_dir, VECTORS_FILE) if keep_vectors
+                    else os.path.join(build_dirs[0], 'merged.npy'))
+    try:
+        merged = np.lib.format.open_memmap(staging_path, mode='w+', dtype=np.float32,
+                                           shape=(len(book_ids), index.d))
+        start = 0
+        for ids, vectors in shards:
+            merged[position[start:start + len(ids)]] = vectors
+            start += len(ids)
+        merged.flush()
+        if keep_vectors:
+            fsync_file(staging_path)
+
+        train_index(index, sample_rows(merged, train_size))
+        chunks = (merged[start:start + chunk_size] for start in range(0, len(merged), chunk_size))
+        total = write_index_files(index, chunks, sorted_ids, index_path, book_ids_path, vectors_path=vectors_path,
+                                  nprobe=nprobe, ef_search=ef_search, version_dir=version_dir)
+        del merged
+    except BaseException:
+        discard_version(version_dir)
+        raise
+    finally:
+        if not keep_vectors:
+            os.remove(staging_path)
+    return total
+
+
+def is_flat(index):
+    """Whether ``index`` stores raw float32 vectors, as the memory-mapped serving mode does."""
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+
+def write_index_files(index, chunks, book_ids, index_path, book_ids_path, vectors_path=None,
+                      nprobe=None, ef_search=None, version_dir=None):
+    """
+    Add ``chunks`` of vectors to the trained ``index`` and publish the serving files as one version.
+
+    For a flat index the vectors are also written to ``vectors_path``
+    (unless the caller already staged them in ``version_dir``); any other
+    index is published without them, so the memory-mapped mode never pairs
+    an older build's vectors with the new book ids. Only one chunk is held
+    in memory at a time. Returns the number of vectors added.
+    """
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    directory = version_dir or start_version(index_path)
+    vectors_file = os.path.join(directory, VECTORS_FILE)
+    try:
+        all_vectors = None
+        if vectors_path is not None and is_flat(index) and not os.path.exists(vectors_file):
+            all_vectors = np.lib.format.open_memmap(vectors_file, mode='w+', dtype=np.float32,
+                                                    shape=(len(book_ids), index.d))
+        start = 0
+        for vectors in chunks:
+            index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+            if all_vectors is not None:
+                all_vectors[start:start + len(vectors)] = vectors
+            start += len(vectors)
+        if all_vectors is not None:
+            all_vectors.flush()
+            del all_vectors
+            fsync_file(vectors_file)
+
+        faiss.write_index(index, os.path.join(directory, INDEX_FILE))
+        fsync_file(os.path.join(directory, INDEX_FILE))
+        atomic_save_npy(os.path.join(directory, BOOK_IDS_FILE), compact_book_ids(book_ids))
+        publish_version(directory, index_path, book_ids_path, vectors_path)
+    except BaseException:
+        discard_version(directory)
+        raise
+    return start
@@ -0,0 +1,94 @@
+"""
+Pipelined description encoding for index builds.
+
+A producer thread streams ``(batch_no, ids, descriptions)`` batches into a
+bounded queue, several encoder processes (each with its own model and a
+fixed torch thread count) turn them into vectors, and the caller consumes
+the results from a second bounded queue. Fetching, encoding and writing
+all overlap, and the queues keep memory bounded.
+"""
+import multiprocessing
+import queue
+import threading
+
+
+def _encode_worker(model_name, torch_threads, tasks, results):
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(torch_threads)
+    model = SentenceTransformer(model_name)
+    while True:
+        task = tasks.get()
+        if task is None:
+            results.put(None)
+            return
+        batch_no, ids, descriptions = task
+        if descriptions:
+            vectors = model.encode(descriptions, batch_size=256, convert_to_numpy=True)
+        else:
+            vectors = None
+        results.put((batch_no, ids, vectors))
+
+
+def _produce(batches, tasks, num_workers, errors):
+    from django.db import connections
+    try:
+        for batch in batches:
+            tasks.put(batch)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        connections.close_all()  # this thread's connections only
+        for _ in range(num_workers):
+            tasks.put(None)
+
+
+def encode_pipeline(batches, model_name, num_workers, torch_threads, queue_size=None):
+    """
+    Yield ``(batch_no, ids, vectors)`` for every batch, in completion order.
+    An empty batch is passed through with ``vectors`` None.
+
+    ``batches`` is consumed on a background thread, so it may stream from a
+    database cursor. A failure while producing is re-raised once the workers
+    have drained.
+    """
+    # Spawned rather than forked, so workers share no database connection or
+    # torch state with this process.
+    context = multiprocessing.get_context('spawn')
+    queue_size = queue_size or 2 * num_workers
+    tasks = context.Queue(queue_size)
+    results = context.Queue(queue_size)
+    workers = [
+        context.Process(target=_encode_worker, args=(model_name, torch_threads, tasks, results), daemon=True)
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    errors = []
+    producer = threading.Thread(target=_produce, args=(batches, tasks, num_workers, errors), daemon=True)
+    producer.start()
+
+    try:
+        finished = 0
+        while finished < num_workers:
+            try:
+                result = results.get(timeout=5)
+            except queue.Empty:
+                crashed = [worker.exitcode for worker in workers if worker.exitcode not in (None, 0)]
+                if crashed:
+                    raise RuntimeError(f"Encoder worker exited with code {crashed[0]}")
+                continue
+            if result is None:
+                finished += 1
+                continue
+            yield result
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+    producer.join()
+    if errors:
+        raise errors[0]
+
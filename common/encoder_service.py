@@ -0,0 +1,159 @@
+"""
+Local sentence-encoder sidecar reachable over a Unix socket.
+
+One process holds the model. Concurrent encode requests from web workers
+are collected into micro-batches (up to ``max_batch_size`` texts, waiting
+at most ``max_wait`` seconds for more after the first arrives) and run
+through the model together.
+"""
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from common.framing import ConnectionClosed, recv_array, recv_message, send_array, send_message
+
+
+class EncoderUnavailable(Exception):
+    """The sidecar could not be reached or failed to encode."""
+
+
+class _Request:
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.vectors = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Runs ``encode`` over batches of texts gathered from concurrent callers."""
+
+    def __init__(self, encode, max_batch_size=64, max_wait=0.005):
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts_encoded = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='encoder-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, texts):
+        """Encode ``texts``; blocks until the batch holding them has run."""
+        request = _Request(texts)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                vectors = np.asarray(self.encode(texts), dtype=np.float32)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            self.batches += 1
+            self.texts_encoded += len(texts)
+            start = 0
+            for request in batch:
+                request.vectors = vectors[start:start + len(request.texts)]
+                start += len(request.texts)
+                request.done.set()
+
+
+class _EncoderHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, _ = recv_message(self.request)
+            except ConnectionClosed:
+                return
+            try:
+                vectors = self.server.batcher.submit(header['texts'])
+            except Exception as e:
+                send_message(self.request, {'error': str(e)})
+                continue
+            send_array(self.request, {}, vectors)
+
+
+class EncoderServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.batcher = batcher
+        super().__init__(socket_path, _EncoderHandler)
+
+
+def load_model(model_name, torch_threads=None):
+    """Load the sentence encoder with a fixed torch thread count."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+        torch.set_num_interop_threads(1)
+    return SentenceTransformer(model_name)
+
+
+class EncoderClient:
+    """Thread-safe client; each thread keeps its own connection to the sidecar."""
+
+    def __init__(self, socket_path, timeout=10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _reset(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def encode(self, texts):
+        try:
+            sock = self._connection()
+            send_message(sock, {'texts': list(texts)})
+            header, vectors = recv_array(sock)
+        except (OSError, ConnectionClosed) as e:
+            self._reset()
+            raise EncoderUnavailable(f"Encoder sidecar at {self.socket_path} failed: {e}") from e
+        if vectors is None:
+            raise EncoderUnavailable(header['error'])
+        return vectors
@@ -0,0 +1,55 @@
+"""
+Length-prefixed messages for the local sidecar and shard servers.
+
+Each message is a fixed 8-byte prefix holding the sizes of a JSON header
+and a raw binary payload, followed by both. Vectors travel as raw float32
+bytes in the payload, so nothing is converted to or from JSON floats.
+"""
+import json
+import struct
+
+import numpy as np
+
+_PREFIX = struct.Struct('!II')
+
+
+class ConnectionClosed(Exception):
+    """The peer closed the connection before a whole message arrived."""
+
+
+def send_message(sock, header, payload=b''):
+    header_bytes = json.dumps(header).encode()
+    sock.sendall(_PREFIX.pack(len(header_bytes), len(payload)) + header_bytes + payload)
+
+
+def recv_message(sock):
+    header_size, payload_size = _PREFIX.unpack(_recv_exactly(sock, _PREFIX.size))
+    header = json.loads(_recv_exactly(sock, header_size))
+    payload = _recv_exactly(sock, payload_size) if payload_size else b''
+    return header, payload
+
+
+def send_array(sock, header, array):
+    array = np.ascontiguousarray(array)
+    send_message(sock, {**header, 'dtype': array.dtype.str, 'shape': list(array.shape)}, array.tobytes())
+
+
+def recv_array(sock):
+    """Receive a message sent with ``send_array``; returns ``(header, array)``."""
+    header, payload = recv_message(sock)
+    if 'error' in header:
+        return header, None
+    array = np.frombuffer(payload, dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+    return header, array
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionClosed(f"Connection closed after {received} of {size} bytes")
+        received += n
+    return bytes(buffer)
@@ -0,0 +1,197 @@
+"""
+Versioned book index that is updated in place from the book change log.
+
+Vectors live in a ``faiss.IndexIDMap2`` keyed by the numeric book id.
+Flat storage drops removed vectors directly; index types where removal is
+expensive or unsupported (IVF, HNSW, PQ) mark the rows as tombstones,
+which searches skip, until ``compact`` rebuilds the index without them.
+
+Each save writes a new ``index-<version>.faiss`` (plus its tombstones) and
+then atomically replaces ``CURRENT``, a small JSON file naming the live
+version and how far the change log has been applied to it (a cursor and
+the ids below it that had not committed yet). Serving processes
+watch ``CURRENT`` and swap to new versions without a restart.
+"""
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+from common.index_files import atomic_save_npy, compact_book_ids
+from common.vector_index import enable_reconstruct
+
+CURRENT_FILE = 'CURRENT'
+_LOAD_ATTEMPTS = 3
+
+
+def read_current(directory):
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _is_flat(index):
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+
+class IncrementalIndex:
+    def __init__(self, index, tombstones=None, cursor=0, version=None, gaps=()):
+        self.index = index
+        self.tombstones = np.zeros(0, dtype=np.int64) if tombstones is None else np.asarray(tombstones, np.int64)
+        self.cursor = cursor
+        self.gaps = list(gaps)
+        self.version = version
+        enable_reconstruct(self.inner)
+
+    @property
+    def inner(self):
+        return faiss.downcast_index(self.index.index)
+
+    @property
+    def ids(self):
+        return faiss.vector_to_array(self.index.id_map)
+
+    @property
+    def live_count(self):
+        return self.index.ntotal - len(self.tombstones)
+
+    @property
+    def tombstone_ratio(self):
+        return len(self.tombstones) / max(self.index.ntotal, 1)
+
+    @classmethod
+    def load(cls, directory):
+        """Load the live version named by ``CURRENT``; None if there is none yet."""
+        current = read_current(directory)
+        for attempt in range(_LOAD_ATTEMPTS):
+            if current is None:
+                return None
+            try:
+                index = faiss.read_index(os.path.join(directory, current['index']))
+                tombstones = np.load(os.path.join(directory, current['tombstones']))
+            except (OSError, RuntimeError):
+                # Removed by the indexer after a newer version went live: load that one instead
+                latest = read_current(directory)
+                if latest == current or attempt == _LOAD_ATTEMPTS - 1:
+                    raise
+                current = latest
+                continue
+            return cls(index, tombstones, cursor=current['cursor'], version=current['version'],
+                       gaps=current.get('gaps', ()))
+
+    @classmethod
+    def from_index(cls, index, book_ids, chunk_size=100000):
+        """Wrap a row-addressed index built by ``export_data`` into an id-mapped one."""
+        enable_reconstruct(index)
+        empty = faiss.clone_index(index)
+        empty.reset()
+        id_mapped = faiss.IndexIDMap2(empty)
+        book_ids = compact_book_ids(book_ids)
+        if book_ids.dtype.kind != 'i':
+            raise ValueError("The incremental index is keyed by numeric book ids; this build has other ids")
+        for start in range(0, index.ntotal, chunk_size):
+            n = min(chunk_size, index.ntotal - start)
+            id_mapped.add_with_ids(index.reconstruct_n(start, n), book_ids[start:start + n])
+        return cls(id_mapped)
+
+    def apply(self, upserts, deletes):
+        """
+        Remove ``deletes`` and the old vectors of ``upserts``, then add the new ones.
+
+        ``upserts`` maps numeric book ids to vectors; ``deletes`` is a set of ids.
+        """
+        stale_ids = np.fromiter(set(deletes) | set(upserts), dtype=np.int64)
+        if len(stale_ids):
+            if _is_flat(self.inner):
+                self.index.remove_ids(faiss.IDSelectorBatch(stale_ids))
+            else:
+                rows = np.flatnonzero(np.isin(self.ids, stale_ids))
+                self.tombstones = np.union1d(self.tombstones, rows)
+        if upserts:
+            ids = np.fromiter(upserts, dtype=np.int64, count=len(upserts))
+            vectors = np.vstack([upserts[book_id] for book_id in upserts]).astype(np.float32)
+            self.index.add_with_ids(vectors, ids)
+
+    def compact(self, chunk_size=100000):
+        """Rebuild the index without tombstoned rows, keeping any trained centroids/codebooks."""
+        if not len(self.tombstones):
+            return
+        live = np.ones(self.index.ntotal, dtype=bool)
+        live[self.tombstones] = False
+        ids = self.ids
+        empty = faiss.clone_index(self.inner)
+        empty.reset()
+        compacted = faiss.IndexIDMap2(empty)
+        for start in range(0, self.index.ntotal, chunk_size):
+            n = min(chunk_size, self.index.ntotal - start)
+            keep = live[start:start + n]
+            if keep.any():
+                vectors = self.inner.reconstruct_n(start, n)[keep]
+                compacted.add_with_ids(vectors, ids[start:start + n][keep])
+        self.index = compacted
+        self.tombstones = np.zeros(0, dtype=np.int64)
+        enable_reconstruct(self.inner)
+
+    def save(self, directory, cursor, keep_versions=3, gaps=(), keep_seconds=60):
+        """
+        Write a new version and make it live; returns the version name.
+
+        Replaced versions are removed once they are not among the newest
+        ``keep_versions`` and were replaced over ``keep_seconds`` ago, so a
+        process that read ``CURRENT`` just before has time to load them.
+        """
+        os.makedirs(directory, exist_ok=True)
+        version = f"{time.time_ns():x}"
+        index_name = f"index-{version}.faiss"
+        tombstones_name = f"tombstones-{version}.npy"
+        tmp_index_path = os.path.join(directory, index_name + '.tmp')
+        faiss.write_index(self.index, tmp_index_path)
+        os.replace(tmp_index_path, os.path.join(directory, index_name))
+        atomic_save_npy(os.path.join(directory, tombstones_name), self.tombstones)
+
+        current = {'version': version, 'index': index_name, 'tombstones': tombstones_name,
+                   'cursor': cursor, 'gaps': list(gaps)}
+        tmp_current_path = os.path.join(directory, CURRENT_FILE + '.tmp')
+        with open(tmp_current_path, 'w') as f:
+            json.dump(current, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_current_path, os.path.join(directory, CURRENT_FILE))
+
+        self.cursor = cursor
+        self.gaps = list(gaps)
+        self.version = version
+        self._remove_old_versions(directory, keep_versions, keep_seconds)
+        return version
+
+    def serving_parts(self):
+        """
+        ``(index, book_ids, excluded_rows)`` for ``IndexState``.
+
+        The inner index is searched by row; tombstoned rows get the id -1 so
+        id lookups never land on them.
+        """
+        book_ids = self.ids
+        book_ids[self.tombstones] = -1
+        return self.inner, book_ids, self.tombstones
+
+    def _remove_old_versions(self, directory, keep_versions, keep_seconds):
+        versions = sorted(
+            name[len('index-'):-len('.faiss')]
+            for name in os.listdir(directory)
+            if name.startswith('index-') and name.endswith('.faiss')
+        )
+        # Versions are named after their creation time in ns, which is when the previous one was replaced
+        replaced_before = time.time_ns() - int(keep_seconds * 1e9)
+        for version, successor in zip(versions[:-keep_versions], versions[1:]):
+            if int(successor, 16) > replaced_before:
+                break
+            for name in (f"index-{version}.faiss", f"tombstones-{version}.npy"):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,247 @@
+"""
+On-disk formats for the book index.
+
+Files are written to a temporary name and renamed into place, so a process
+that already has the old file open (or memory-mapped) keeps a consistent copy.
+
+The serving index, its book ids and raw vectors only make sense together,
+so builds publish them as one version: a directory under
+``<INDEX_PATH>.versions`` that ``CURRENT`` points at. Readers resolve
+``CURRENT`` once (``live_index_files``) and open every file from the same
+version. The configured ``INDEX_PATH``, ``BOOK_IDS_PATH`` and
+``VECTORS_PATH`` become symlinks into the live version, for tools that
+open one file at a time.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+_INT64_MIN, _INT64_MAX = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+
+CURRENT_FILE = 'CURRENT'
+INDEX_FILE = 'book_index.faiss'
+BOOK_IDS_FILE = 'book_ids.npy'
+VECTORS_FILE = 'book_vectors.npy'
+
+
+def atomic_save_npy(path, array):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def fsync_file(path):
+    """Flush a file written by a library that does not sync it, e.g. ``faiss.write_index``."""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def versions_dir(index_path):
+    return f"{index_path}.versions"
+
+
+def read_live_version(index_path):
+    """The name of the live version of the serving files, or None before the first versioned build."""
+    try:
+        with open(os.path.join(versions_dir(index_path), CURRENT_FILE)) as f:
+            return json.load(f)['version']
+    except FileNotFoundError:
+        return None
+
+
+def live_index_files(index_path, book_ids_path, vectors_path=None):
+    """
+    ``(version, index_path, book_ids_path, vectors_path)`` of the live version,
+    all from the same build. Before the first versioned build, the version is
+    None and the configured paths are returned as they are.
+    """
+    version = read_live_version(index_path)
+    if version is None:
+        return None, index_path, book_ids_path, vectors_path
+    directory = os.path.join(versions_dir(index_path), version)
+    return (version, os.path.join(directory, INDEX_FILE), os.path.join(directory, BOOK_IDS_FILE),
+            os.path.join(directory, VECTORS_FILE))
+
+
+def start_version(index_path):
+    """A new, unpublished directory to write a version of the serving files into."""
+    directory = os.path.join(versions_dir(index_path), f"{time.time_ns():x}")
+    os.makedirs(directory)
+    return directory
+
+
+def discard_version(directory):
+    """Remove a version that was never published, e.g. after its build failed."""
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def publish_version(directory, index_path, book_ids_path, vectors_path=None):
+    """
+    Make the version in ``directory`` live by atomically replacing ``CURRENT``,
+    then point the configured paths at its files.
+
+    The version that was live until now is kept, so a process that read
+    ``CURRENT`` just before can still load it; older ones are removed.
+    """
+    root = versions_dir(index_path)
+    previous = read_live_version(index_path)
+    version = os.path.basename(directory)
+    tmp_current_path = os.path.join(root, CURRENT_FILE + '.tmp')
+    with open(tmp_current_path, 'w') as f:
+        json.dump({'version': version}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_current_path, os.path.join(root, CURRENT_FILE))
+
+    _link(index_path, os.path.join(directory, INDEX_FILE))
+    _link(book_ids_path, os.path.join(directory, BOOK_IDS_FILE))
+    if vectors_path is not None:
+        if os.path.exists(os.path.join(directory, VECTORS_FILE)):
+            _link(vectors_path, os.path.join(directory, VECTORS_FILE))
+        else:
+            # This build wrote no raw vectors: never leave the mapped mode an older build's
+            try:
+                os.remove(vectors_path)
+            except FileNotFoundError:
+                pass
+
+    for name in os.listdir(root):
+        # Versions newer than this one are builds still being written
+        if name not in (version, previous) and name < version and os.path.isdir(os.path.join(root, name)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _link(path, target):
+    """Atomically point the symlink ``path`` at ``target`` (replacing a plain file left by an older build)."""
+    tmp_path = f"{path}.tmp"
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.relpath(target, os.path.dirname(os.path.abspath(path))), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def numeric_book_id(book_id):
+    """
+    The integer a book id spells, or None unless it is an integer's canonical
+    decimal form: ``'0123'``, ``' 7'`` and ``'1_000'`` stay strings, so they
+    never collide with ``'123'``, ``'7'`` or ``'1000'``.
+    """
+    if isinstance(book_id, bytes):
+        book_id = book_id.decode()
+    try:
+        number = int(book_id)
+    except ValueError:
+        return None
+    if str(number) != book_id or not _INT64_MIN <= number <= _INT64_MAX:
+        return None
+    return number
+
+
+def compact_book_ids(book_ids):
+    """
+    Return book ids in the smallest fixed-width dtype that can be memory-mapped.
+
+    Ids that are all canonical integers (see ``numeric_book_id``) become
+    int64; otherwise every id is stored as UTF-8 fixed-width bytes. Object
+    and variable-length string arrays cannot be memory-mapped.
+    """
+    book_ids = np.asarray(book_ids)
+    if book_ids.dtype.kind in 'iu':
+        return book_ids.astype(np.int64)
+    if book_ids.dtype.kind == 'S':
+        return book_ids
+    book_ids = [str(book_id) for book_id in book_ids]
+    numbers = [numeric_book_id(book_id) for book_id in book_ids]
+    if None not in numbers:
+        return np.array(numbers, dtype=np.int64)
+    return np.array([book_id.encode() for book_id in book_ids], dtype='S')
+
+
+def load_spooled_ids(path, count):
+    """
+    Read back ``count`` book ids written one per line (UTF-8), straight into
+    the array ``compact_book_ids`` would give.
+
+    Only the final array is held in memory, never a list of Python strings.
+    """
+    def numbers(f):
+        for line in f:
+            number = numeric_book_id(line[:-1])
+            if number is None:
+                raise ValueError(line)
+            yield number
+
+    with open(path, 'rb') as f:
+        try:
+            return np.fromiter(numbers(f), dtype=np.int64, count=count)
+        except ValueError:
+            f.seek(0)
+            width = max((len(line) - 1 for line in f), default=1)
+            f.seek(0)
+            return np.fromiter((line[:-1] for line in f), dtype=f'S{max(width, 1)}', count=count)
+
+
+def book_id_str(book_id):
+    """Turn an entry of a book ids array back into a ``Book`` primary key."""
+    if isinstance(book_id, bytes):
+        return book_id.decode()
+    return str(book_id)
+
+
+def write_index_vectors(index, path, chunk_size=100000):
+    """Stream the raw float32 vectors of a flat FAISS index into a ``.npy`` file."""
+    tmp_path = f"{path}.tmp"
+    vectors = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(index.ntotal, index.d))
+    for start in range(0, index.ntotal, chunk_size):
+        n = min(chunk_size, index.ntotal - start)
+        vectors[start:start + n] = index.reconstruct_n(start, n)
+    vectors.flush()
+    del vectors
+    fsync_file(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_mmap_files(index, book_ids, index_path, book_ids_path, vectors_path):
+    """Publish a version of ``index`` with the vectors and compact ids used by the memory-mapped serving mode."""
+    import faiss
+    directory = start_version(index_path)
+    try:
+        faiss.write_index(index, os.path.join(directory, INDEX_FILE))
+        fsync_file(os.path.join(directory, INDEX_FILE))
+        write_index_vectors(index, os.path.join(directory, VECTORS_FILE))
+        atomic_save_npy(os.path.join(directory, BOOK_IDS_FILE), compact_book_ids(book_ids))
+        publish_version(directory, index_path, book_ids_path, vectors_path)
+    except BaseException:
+        discard_version(directory)
+        raise
+
+
+class MmapFlatIndex:
+    """
+    Exact L2 search over a read-only, memory-mapped ``.npy`` matrix.
+
+    Every process that maps the same file shares one page-cache copy of the
+    vectors, instead of each holding a private ``IndexFlatL2``.
+    """
+
+    def __init__(self, vectors_path):
+        self.vectors = np.load(vectors_path, mmap_mode='r')
+        self.ntotal, self.d = self.vectors.shape
+
+    def search(self, queries, k):
+        import faiss
+        return faiss.knn(np.asarray(queries, dtype=np.float32), self.vectors, k)
+
+    def reconstruct(self, i):
+        return np.array(self.vectors[i])
+
+    def reconstruct_batch(self, rows):
+        return np.array(self.vectors[np.asarray(rows)])
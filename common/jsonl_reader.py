@@ -0,0 +1,85 @@
+"""
+Parallel parsing of large JSONL files.
+
+The file is cut into byte ranges that start and end on line boundaries, and
+the ranges are parsed in a pool of processes. Results come back in file
+order, with at most ``max_pending`` ranges parsed ahead of the consumer, so
+memory stays bounded while the database writer catches up.
+
+``orjson`` is used when it is installed; otherwise the standard ``json``.
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    loads = json.loads
+
+DEFAULT_CHUNK_BYTES = 8 * 2 ** 20
+
+
+def byte_ranges(path, chunk_bytes=DEFAULT_CHUNK_BYTES, start=0):
+    """``(start, end)`` offsets of roughly ``chunk_bytes`` each, every one ending after a newline."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()  # move to the end of the line the cut falls in
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def parse_range(path, start, end, parse):
+    """
+    Parse the lines in ``[start, end)`` with ``parse(item)``; blank lines are skipped.
+
+    Returns ``(records, failures)``, where ``failures`` holds ``(line, error)``
+    for every line that could not be decoded or parsed.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    records, failures = [], []
+    for line in data.split(b'\n'):
+        if not line.strip():
+            continue
+        try:
+            records.append(parse(loads(line)))
+        except Exception as e:
+            failures.append((line.decode('utf-8', 'replace'), f"{type(e).__name__}: {e}"))
+    return records, failures
+
+
+def iter_chunks(path, parse, workers=1, chunk_bytes=DEFAULT_CHUNK_BYTES, start=0, max_pending=None):
+    """
+    Yield ``(start, end, records, failures)`` for consecutive byte ranges of ``path``, in file order.
+
+    ``parse`` must be a module-level function so worker processes can load
+    it. With ``workers`` <= 1 everything is parsed in this process.
+    """
+    ranges = byte_ranges(path, chunk_bytes, start)
+    if workers <= 1:
+        for range_start, range_end in ranges:
+            yield (range_start, range_end, *parse_range(path, range_start, range_end, parse))
+        return
+
+    max_pending = max_pending or 2 * workers
+    # Workers only parse; spawning keeps them clear of this process's database connections.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = deque()
+        for range_start, range_end in ranges:
+            pending.append((range_start, range_end, pool.submit(parse_range, path, range_start, range_end, parse)))
+            if len(pending) >= max_pending:
+                range_start, range_end, future = pending.popleft()
+                yield (range_start, range_end, *future.result())
+        while pending:
+            range_start, range_end, future = pending.popleft()
+            yield (range_start, range_end, *future.result())
@@ -0,0 +1,162 @@
+"""
+In-memory prefix index for type-ahead suggestions.
+
+Names are normalised (accents and punctuation dropped, case folded) and kept
+in one sorted list of ``(key, id)`` rows, so the names starting with a prefix
+are a contiguous range found by binary search. A title starting with an
+article is also indexed without it, so "hobb" finds "The Hobbit".
+
+Suggestions are ranked by a popularity score. Prefixes that match more than
+``scan_limit`` rows (the short ones a user types first) have their best ids
+precomputed; any other prefix is ranked by scanning its range, which is at
+most ``scan_limit`` rows. Either way a lookup is a few microseconds and
+never leaves the process.
+
+Precomputed lists hold up to twice ``top_k`` ids, so removing an item (or
+changing its score) rarely needs a prefix to be ranked again.
+"""
+import heapq
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+_END = '\U0010ffff'  # sorts after any character a normalised key can contain
+_NON_WORD = re.compile(r'[\W_]+')
+_ARTICLES = ('the ', 'a ', 'an ')
+
+
+def normalize(text):
+    """Lower-case ``text``, strip accents and reduce punctuation and whitespace runs to single spaces."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _NON_WORD.sub(' ', text.casefold()).strip()
+
+
+def index_keys(label):
+    """The normalised keys ``label`` is found under."""
+    key = normalize(label)
+    if not key:
+        return ()
+    for article in _ARTICLES:
+        if key.startswith(article) and len(key) > len(article):
+            return key, key[len(article):]
+    return (key,)
+
+
+class PrefixIndex:
+    def __init__(self, top_k=10, scan_limit=256):
+        self.top_k = top_k
+        self.scan_limit = scan_limit
+        self._items = {}  # id -> (label, score)
+        self._rows = []  # sorted (key, id)
+        self._top = {}  # prefix -> the best ids (up to 2 * top_k), best first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, items, top_k=10, scan_limit=256):
+        """An index over ``(id, label, score)`` items."""
+        index = cls(top_k, scan_limit)
+        for item_id, label, score in items:
+            keys = index_keys(label)
+            if keys:
+                index._items[item_id] = (label, score)
+                index._rows.extend((key, item_id) for key in keys)
+        index._rows.sort()
+        index._precompute(0, len(index._rows), 1)
+        return index
+
+    def _rank(self, item_id):
+        label, score = self._items[item_id]
+        return -score, label, item_id
+
+    def _range(self, prefix, lo=0, hi=None):
+        hi = len(self._rows) if hi is None else hi
+        return bisect_left(self._rows, (prefix,), lo, hi), bisect_left(self._rows, (prefix + _END,), lo, hi)
+
+    def _best(self, lo, hi, limit):
+        return heapq.nsmallest(limit, {item_id for _, item_id in self._rows[lo:hi]}, key=self._rank)
+
+    def _precompute(self, lo, hi, length):
+        """Store the top ids of every ``length``-character prefix in rows[lo:hi] that has too many rows to scan."""
+        while lo < hi:
+            prefix = self._rows[lo][0][:length]
+            _, end = self._range(prefix, lo, hi)
+            # A key shorter than ``length`` is already covered by its own, shorter prefix
+            if end - lo > self.scan_limit and len(prefix) == length:
+                self._top[prefix] = self._best(lo, end, 2 * self.top_k)
+                self._precompute(lo, end, length + 1)
+            lo = end
+
+    def get(self, item_id):
+        """``(label, score)`` of an indexed item, or None."""
+        return self._items.get(item_id)
+
+    def search(self, text, limit=None):
+        """``(id, label)`` of the best ``limit`` (at most ``top_k``) items with a key starting with ``text``."""
+        limit = min(limit or self.top_k, self.top_k)
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        with self._lock:
+            ids = self._top.get(prefix)
+            if ids is None:
+                ids = self._best(*self._range(prefix), limit)
+            return [(item_id, self._items[item_id][0]) for item_id in ids[:limit]]
+
+    def add(self, item_id, label, score=0):
+        """Insert or replace one item."""
+        keys = index_keys(label)
+        with self._lock:
+            self._remove(item_id)
+            if not keys:
+                return
+            self._items[item_id] = (label, score)
+            rank = self._rank(item_id)
+            for key in keys:
+                insort(self._rows, (key, item_id))
+                for length in range(1, len(key) + 1):
+                    top = self._top.get(key[:length])
+                    if top is None:
+                        break  # longer prefixes are not precomputed either
+                    # The list holds the best ids of its prefix, so anything ranked below its last one stays out
+                    if item_id not in top and rank < self._rank(top[-1]):
+                        top.append(item_id)
+                        top.sort(key=self._rank)
+                        del top[2 * self.top_k:]
+
+    def remove(self, item_id):
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        entry = self._items.pop(item_id, None)
+        if entry is None:
+            return
+        keys = index_keys(entry[0])
+        for key in keys:
+            position = bisect_left(self._rows, (key, item_id))
+            if position < len(self._rows) and self._rows[position] == (key, item_id):
+                del self._rows[position]
+        for key in keys:
+            for length in range(1, len(key) + 1):
+                prefix = key[:length]
+                top = self._top.get(prefix)
+                if top is None:
+                    break
+                if item_id in top:
+                    top.remove(item_id)
+                    if len(top) < self.top_k:
+                        self._top[prefix] = self._best(*self._range(prefix), 2 * self.top_k)
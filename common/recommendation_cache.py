@@ -0,0 +1,131 @@
+"""
+Two-tier cache of recommendation results.
+
+Entries are keyed by (book id, k, index version). The local tier is a
+bounded LRU inside each process; the optional shared tier goes through a
+Django cache alias so all workers can reuse each other's results. A
+per-book generation number in the shared tier lets a write in one process
+invalidate that book's shared entries everywhere; local entries in other
+processes expire after ``local_timeout`` seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    def __init__(self, max_entries=10000, local_timeout=300, shared_alias=None, shared_timeout=3600):
+        self.max_entries = max_entries
+        self.local_timeout = local_timeout
+        self.shared_alias = shared_alias
+        self.shared_timeout = shared_timeout
+        self._entries = OrderedDict()
+        self._keys_by_book = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(('local_hits', 'shared_hits', 'misses', 'invalidations'), 0)
+
+    @classmethod
+    def from_settings(cls):
+        from django.conf import settings
+        config = settings.RECOMMENDER.get('CACHE', {})
+        return cls(
+            max_entries=config.get('MAX_ENTRIES', 10000),
+            local_timeout=config.get('LOCAL_TIMEOUT', 300),
+            shared_alias=config.get('SHARED_ALIAS'),
+            shared_timeout=config.get('SHARED_TIMEOUT', 3600),
+        )
+
+    @property
+    def shared(self):
+        if self.shared_alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[self.shared_alias]
+
+    def get(self, book_id, k, version):
+        key = (str(book_id), k, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, book_ids = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._counters['local_hits'] += 1
+                    return book_ids
+                self._remove(key)
+
+        shared = self.shared
+        if shared is not None:
+            book_ids = shared.get(self._shared_key(shared, key))
+            if book_ids is not None:
+                self._set_local(key, book_ids)
+                self._count('shared_hits')
+                return book_ids
+
+        self._count('misses')
+        return None
+
+    def set(self, book_id, k, version, book_ids):
+        key = (str(book_id), k, version)
+        self._set_local(key, book_ids)
+        shared = self.shared
+        if shared is not None:
+            shared.set(self._shared_key(shared, key), book_ids, self.shared_timeout)
+
+    def invalidate_book(self, book_id):
+        book_id = str(book_id)
+        with self._lock:
+            for key in list(self._keys_by_book.get(book_id, ())):
+                self._remove(key)
+            self._counters['invalidations'] += 1
+        shared = self.shared
+        if shared is not None:
+            generation_key = self._generation_key(book_id)
+            if not shared.add(generation_key, 1, None):
+                shared.incr(generation_key)
+
+    def clear_local(self):
+        """Drop every local entry, e.g. after a new index version is loaded."""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_book.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['local_hits'] + self._counters['shared_hits'] + self._counters['misses']
+            hits = lookups - self._counters['misses']
+            return {
+                **self._counters,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_rate': hits / lookups if lookups else 0.0,
+            }
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _set_local(self, key, book_ids):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (time.monotonic() + self.local_timeout, book_ids)
+            self._keys_by_book.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_book.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_book[key[0]]
+
+    def _generation_key(self, book_id):
+        return f"rec:gen:{book_id}"
+
+    def _shared_key(self, shared, key):
+        book_id, k, version = key
+        generation = shared.get(self._generation_key(book_id), 0)
+        return f"rec:{book_id}:{k}:{version}:{generation}"
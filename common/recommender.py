@@ -0,0 +1,401 @@
+"""
+Book recommender backed by a FAISS index and a sentence encoder.
+
+Nothing heavy is imported or read from disk until the first recommendation
+is requested, so management commands and web workers that never recommend
+do not pay for torch, the model weights or the index.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from common.index_files import MmapFlatIndex, book_id_str, live_index_files, numeric_book_id, read_live_version
+from common.recommendation_cache import RecommendationCache
+
+
+class RecommenderUnavailable(Exception):
+    """Raised when the index, the book ids or the model cannot be loaded."""
+
+
+class BookRecommender:
+    """
+    Loads the index and the encoder on first use, once per process.
+
+    With ``mmap`` set, the vectors and book ids are memory-mapped read-only
+    from ``vectors_path`` and ``book_ids_path``, so all worker processes on a
+    host share a single page-cache copy instead of each reading the index.
+
+    With ``encoder_socket`` set, descriptions are encoded by the local
+    sidecar (see ``run_encoder``) and the model is never loaded in-process.
+
+    With ``versions_dir`` set, the index is the incrementally maintained one
+    written by ``run_indexer``; every ``reload_interval`` seconds the
+    recommender checks for a newer version and swaps to it.
+
+    With ``shards`` set (``host:port`` addresses of ``run_shard_server``
+    processes), no index is loaded locally: every search is fanned out to the
+    shards and their results merged. Shards that miss ``shard_timeout`` are
+    left out, and such partial results are not cached.
+    """
+
+    def __init__(self, index_path, book_ids_path, model_name, mmap=False, vectors_path=None,
+                 nprobe=None, ef_search=None, cache=None, encoder_socket=None,
+                 versions_dir=None, reload_interval=5, shards=None, shard_timeout=0.5):
+        self.index_path = index_path
+        self.book_ids_path = book_ids_path
+        self.model_name = model_name
+        self.mmap = mmap
+        self.vectors_path = vectors_path
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.cache = cache
+        self.encoder_socket = encoder_socket
+        self._encoder_client = None
+        self.versions_dir = versions_dir
+        self.reload_interval = reload_interval
+        self._next_reload_check = 0
+        self.shards = shards
+        self.shard_timeout = shard_timeout
+        self._index_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._state = None
+        self._model = None
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.RECOMMENDER
+        return cls(
+            index_path=config['INDEX_PATH'],
+            book_ids_path=config['BOOK_IDS_PATH'],
+            model_name=config['MODEL_NAME'],
+            mmap=config.get('MMAP', False),
+            vectors_path=config.get('VECTORS_PATH'),
+            nprobe=config.get('NPROBE'),
+            ef_search=config.get('EF_SEARCH'),
+            cache=RecommendationCache.from_settings(),
+            encoder_socket=config.get('ENCODER_SOCKET'),
+            versions_dir=config.get('INDEX_VERSIONS_DIR'),
+            reload_interval=config.get('RELOAD_INTERVAL', 5),
+            shards=config.get('SHARDS'),
+            shard_timeout=config.get('SHARD_TIMEOUT', 0.5),
+        )
+
+    @property
+    def index(self):
+        return self.state.index
+
+    @property
+    def book_ids(self):
+        return self.state.book_ids
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._load_index()
+        elif self.versions_dir is not None and time.monotonic() >= self._next_reload_check:
+            self._reload_if_changed()
+        return self._state
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                        self._model = SentenceTransformer(self.model_name)
+                    except (ImportError, OSError) as e:
+                        raise RecommenderUnavailable(f"Cannot load model {self.model_name}: {e}") from e
+        return self._model
+
+    def _load_index(self):
+        with self._index_lock:
+            if self._state is None:
+                self._swap_state(self._read_state())
+
+    def _reload_if_changed(self):
+        # Only one thread checks; the others keep serving the current version.
+        if not self._index_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_reload_check = time.monotonic() + self.reload_interval
+            from common.incremental_index import read_current
+            current = read_current(self.versions_dir)
+            if current is not None and current['version'] != self._state.version:
+                self._swap_state(self._read_state())
+        except RecommenderUnavailable:
+            pass  # keep serving the version already loaded
+        finally:
+            self._index_lock.release()
+
+    def _swap_state(self, state):
+        if self.cache is not None:
+            self.cache.clear_local()
+        self._state = state
+
+    def _read_state(self):
+        import faiss
+        import numpy as np
+        from common.vector_index import enable_reconstruct, set_search_params
+        if self.shards:
+            from common.shard_search import ShardedSearcher, ShardedState, ShardsUnavailable
+            searcher = ShardedSearcher(self.shards, timeout=self.shard_timeout)
+            try:
+                searcher.connect()
+            except ShardsUnavailable as e:
+                searcher.close()
+                raise RecommenderUnavailable(str(e)) from e
+            return ShardedState(searcher)
+        if self.versions_dir is not None:
+            from common.incremental_index import IncrementalIndex
+            try:
+                incremental = IncrementalIndex.load(self.versions_dir)
+            except (OSError, RuntimeError) as e:
+                raise RecommenderUnavailable(f"Cannot load book index: {e}") from e
+            if incremental is None:
+                raise RecommenderUnavailable(f"No index version in {self.versions_dir} yet")
+            index, book_ids, excluded_rows = incremental.serving_parts()
+            set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+            return IndexState(index, book_ids, version=incremental.version,
+                              excluded_rows=excluded_rows, owner=incremental)
+
+        for attempt in range(3):
+            version, index_path, book_ids_path, vectors_path = live_index_files(
+                self.index_path, self.book_ids_path, self.vectors_path,
+            )
+            try:
+                stat = os.stat(vectors_path if self.mmap else index_path)
+                if self.mmap:
+                    book_ids = np.load(book_ids_path, mmap_mode='r')
+                    index = MmapFlatIndex(vectors_path)
+                else:
+                    book_ids = np.load(book_ids_path)
+                    index = faiss.read_index(index_path)
+                break
+            except (OSError, RuntimeError) as e:
+                # The version was replaced and removed while it was being opened: load the new one
+                if version is None or version == read_live_version(self.index_path) or attempt == 2:
+                    raise RecommenderUnavailable(f"Cannot load book index: {e}") from e
+        if index.ntotal != len(book_ids):
+            raise RecommenderUnavailable(
+                f"Book index holds {index.ntotal} vectors but there are {len(book_ids)} book ids"
+            )
+        if not self.mmap:
+            set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+            enable_reconstruct(index)
+        return IndexState(index, book_ids, version=version or f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    def warm_up(self):
+        """Load everything up front, e.g. when a web worker boots."""
+        self._load_index()
+        self.encode(["warm up"])
+
+    def encode(self, texts):
+        if self.encoder_socket is None:
+            return self.model.encode(texts)
+        from common.encoder_service import EncoderClient, EncoderUnavailable
+        if self._encoder_client is None:
+            self._encoder_client = EncoderClient(self.encoder_socket)
+        try:
+            return self._encoder_client.encode(texts)
+        except EncoderUnavailable as e:
+            raise RecommenderUnavailable(str(e)) from e
+
+    def recommend(self, description, k=5):
+        embedding = self.encode([description])
+        return self.state.search(embedding[0], k)
+
+    def similar_books(self, book_id, k=5):
+        """
+        Books closest to an indexed book, found from its stored vector.
+
+        Never runs the encoder. Returns None if the book is not in the index.
+        """
+        state = self.state
+        cached = self._cached(state, book_id, k)
+        if cached is not None:
+            return cached
+        vector = state.vector_for(book_id)
+        if vector is None:
+            return None
+        return self._cache(state, book_id, k, state.search(vector, k, exclude=book_id))
+
+    def recommend_for_book(self, book_id, description, k=5):
+        """Like ``similar_books``, but encodes ``description`` for books that are not indexed yet."""
+        state = self.state
+        cached = self._cached(state, book_id, k)
+        if cached is not None:
+            return cached
+        vector = state.vector_for(book_id)
+        if vector is None:
+            vector = self.encode([description or ''])[0]
+        return self._cache(state, book_id, k, state.search(vector, k, exclude=book_id))
+
+    def recommend_for_books(self, books, k=10, mode='batch'):
+        """
+        Recommendations for a set of ``(book_id, description)`` pairs, e.g. a user's favourites.
+
+        Stored vectors are fetched in bulk and only unindexed books are
+        encoded. ``batch`` mode searches with every vector at once and keeps
+        each result's best distance; ``centroid`` mode searches once with
+        their mean. Either way the index is searched in a single call, over-
+        fetching so that ``k`` results survive dropping the input books.
+        """
+        import numpy as np
+        if not books:
+            return []
+        state = self.state
+        book_ids = [str(book_id) for book_id, _ in books]
+        vectors = state.vectors_for(book_ids)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self.encode([books[i][1] or '' for i in missing])
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+        queries = np.vstack(vectors).astype(np.float32)
+        if mode == 'centroid':
+            queries = queries.mean(axis=0, keepdims=True)
+        elif mode != 'batch':
+            raise ValueError(f"Unknown recommendation mode {mode!r}")
+        return state.search_many(queries, k, exclude=set(book_ids))
+
+    def _cached(self, state, book_id, k):
+        if self.cache is None:
+            return None
+        return self.cache.get(book_id, k, state.version)
+
+    def _cache(self, state, book_id, k, book_ids):
+        # Results that some shards missed are served but not remembered.
+        if self.cache is not None and not getattr(book_ids, 'missing_shards', None):
+            self.cache.set(book_id, k, state.version, book_ids)
+        return book_ids
+
+
+class IndexState:
+    """
+    An index together with its book ids, an id -> row lookup and a version tag.
+
+    ``excluded_rows`` (tombstones) are skipped by every search. ``owner`` keeps
+    alive the object that owns ``index`` when ``index`` is a sub-index of it.
+    """
+
+    def __init__(self, index, book_ids, version=None, excluded_rows=None, owner=None):
+        import numpy as np
+        self.index = index
+        self.book_ids = book_ids
+        self.version = version
+        self._owner = owner
+        self._search_params = None
+        if excluded_rows is not None and len(excluded_rows):
+            from common.vector_index import search_params_excluding
+            self._search_params = search_params_excluding(index, excluded_rows)
+        # Sorted view of the ids for binary-search lookups; far smaller than a
+        # dict of Python strings and built with one vectorised sort.
+        self._id_order = np.argsort(book_ids, kind='stable')
+        self._sorted_ids = book_ids[self._id_order]
+
+    def _key(self, book_id):
+        kind = self.book_ids.dtype.kind
+        if kind in 'iu':
+            key = numeric_book_id(str(book_id))
+            if key is None:
+                raise ValueError(book_id)
+            return key
+        if kind == 'S':
+            return str(book_id).encode()
+        return str(book_id)
+
+    def row_for(self, book_id):
+        """Row of ``book_id`` in the index, or None if it is not indexed."""
+        import numpy as np
+        try:
+            key = self._key(book_id)
+        except ValueError:
+            return None
+        position = np.searchsorted(self._sorted_ids, key)
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == key:
+            return int(self._id_order[position])
+        return None
+
+    def vector_for(self, book_id):
+        row = self.row_for(book_id)
+        if row is None:
+            return None
+        return self.index.reconstruct(row)
+
+    def vectors_for(self, book_ids):
+        """Stored vectors for ``book_ids``, read in one batch; None for books that are not indexed."""
+        import numpy as np
+        rows = [self.row_for(book_id) for book_id in book_ids]
+        found = [row for row in rows if row is not None]
+        if not found:
+            return [None] * len(rows)
+        stored = iter(self.index.reconstruct_batch(np.array(found, dtype=np.int64)))
+        return [None if row is None else next(stored) for row in rows]
+
+    def _search(self, queries, k):
+        if self._search_params is None:
+            return self.index.search(queries, k)
+        return self.index.search(queries, k, params=self._search_params)
+
+    def search(self, vector, k, exclude=None):
+        """Ids of the ``k`` nearest books to ``vector``, leaving out ``exclude``."""
+        import numpy as np
+        queries = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        D, I = self._search(queries, k + 1 if exclude is not None else k)
+        exclude = None if exclude is None else str(exclude)
+        recommended = [book_id_str(self.book_ids[i]) for i in I[0] if i >= 0]
+        return [book_id for book_id in recommended if book_id != exclude][:k]
+
+    def nearest(self, queries, k):
+        """``(distance, book_id)`` pairs for each query, nearest first."""
+        import numpy as np
+        D, I = self._search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        return [
+            [(float(distance), book_id_str(self.book_ids[row])) for distance, row in zip(distances, rows) if row >= 0]
+            for distances, rows in zip(D, I)
+        ]
+
+    def search_many(self, queries, k, exclude=()):
+        """
+        Merge the results of several queries, searched in one call.
+
+        Each book keeps its smallest distance to any query. Every query over-
+        fetches by ``len(exclude)``, so at least ``k`` books remain after the
+        excluded ones are dropped (if the index holds that many).
+        """
+        D, I = self._search(queries, k + len(exclude))
+        best = {}
+        for distance, row in zip(D.ravel(), I.ravel()):
+            if row < 0:
+                continue
+            book_id = book_id_str(self.book_ids[row])
+            if book_id not in exclude and distance < best.get(book_id, float('inf')):
+                best[book_id] = distance
+        return sorted(best, key=best.get)[:k]
+
+
+_recommender = None
+_recommender_lock = threading.Lock()
+
+
+def get_recommender():
+    """Return the process-wide recommender, creating it on first call."""
+    global _recommender
+    if _recommender is None:
+        with _recommender_lock:
+            if _recommender is None:
+                _recommender = BookRecommender.from_settings()
+    return _recommender
+
+
+def warm_up():
+    get_recommender().warm_up()
+
+
+def warm_up_if_configured():
+    """Warm-up hook for WSGI/ASGI entry points, driven by ``RECOMMENDER['WARM_UP']``."""
+    if settings.RECOMMENDER.get('WARM_UP'):
+        warm_up()
@@ -0,0 +1,240 @@
+"""
+Scatter-gather search over an index partitioned into shards.
+
+Each shard is a slice of the books (see ``partition_index``) loaded by a
+small TCP server (``run_shard_server``). A query is sent to every shard at
+once; each returns its own top-k with distances, and the client merges them
+into the global top-k. A shard that errors or does not answer within the
+timeout is left out, and the results are marked as partial.
+"""
+import heapq
+import logging
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from common.framing import ConnectionClosed, recv_array, recv_message, send_array, send_message
+
+logger = logging.getLogger(__name__)
+
+
+class ShardsUnavailable(Exception):
+    """No shard answered."""
+
+
+class PartialResult(list):
+    """Book ids merged from only some of the shards; ``missing_shards`` lists the others."""
+
+    def __init__(self, book_ids, missing_shards):
+        super().__init__(book_ids)
+        self.missing_shards = missing_shards
+
+
+class _ShardHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        state = self.server.state
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except ConnectionClosed:
+                return
+            try:
+                if header['op'] == 'search':
+                    queries = np.frombuffer(payload, dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+                    exclude = set(header.get('exclude', ()))
+                    results = [
+                        [(distance, book_id) for distance, book_id in found if book_id not in exclude][:header['k']]
+                        for found in state.nearest(queries, header['k'] + len(exclude))
+                    ]
+                    send_message(self.request, {'results': results})
+                elif header['op'] == 'vectors':
+                    vectors = state.vectors_for(header['book_ids'])
+                    found = [vector is not None for vector in vectors]
+                    stored = [vector for vector in vectors if vector is not None]
+                    matrix = np.vstack(stored) if stored else np.zeros((0, state.index.d), dtype=np.float32)
+                    send_array(self.request, {'found': found}, matrix.astype(np.float32))
+                elif header['op'] == 'info':
+                    send_message(self.request, {'version': state.version, 'count': len(state.book_ids)})
+                else:
+                    send_message(self.request, {'error': f"Unknown op {header['op']!r}"})
+            except Exception as e:
+                send_message(self.request, {'error': str(e)})
+
+
+class ShardServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state):
+        self.state = state
+        super().__init__(address, _ShardHandler)
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class _ShardClient:
+    """
+    One shard's connections; each calling thread keeps its own socket.
+
+    Every new connection starts by asking the shard for its version, so a
+    shard that was restarted with other data is noticed on reconnect.
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.timeout = timeout
+        self.version = None
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.create_connection(parse_address(self.address), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.sock = sock
+            self.version = self._request(sock, {'op': 'info'})['version']
+        return sock
+
+    def reset(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def call(self, header, array=None):
+        return self._request(self._connection(), header, array)
+
+    def _request(self, sock, header, array=None):
+        if array is None:
+            send_message(sock, header)
+        else:
+            send_array(sock, header, array)
+        if header['op'] == 'vectors':
+            response, matrix = recv_array(sock)
+            return {**response, 'vectors': matrix}
+        response, _ = recv_message(sock)
+        return response
+
+
+class ShardedSearcher:
+    """Fans requests out to every shard concurrently and merges what comes back in time."""
+
+    def __init__(self, addresses, timeout=0.5):
+        self.timeout = timeout
+        self.shards = [_ShardClient(address, timeout) for address in addresses]
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.shards), thread_name_prefix='shard-search')
+
+    def _call_shard(self, shard, header, array):
+        try:
+            response = shard.call(header, array)
+        except (OSError, ConnectionClosed) as e:
+            shard.reset()  # a late reply must not be read as the answer to the next request
+            raise ShardsUnavailable(f"Shard {shard.address} failed: {e}") from e
+        if 'error' in response:
+            raise ShardsUnavailable(f"Shard {shard.address} failed: {response['error']}")
+        return response
+
+    def _scatter(self, header, array=None):
+        """``(responses, missing)``: the answers that arrived in time and the addresses that did not."""
+        futures = {
+            self._executor.submit(self._call_shard, shard, header, array): shard
+            for shard in self.shards
+        }
+        done, _ = wait(futures, timeout=self.timeout)
+        responses, missing = [], []
+        for future, shard in futures.items():
+            if future in done and future.exception() is None:
+                responses.append(future.result())
+            else:
+                missing.append(shard.address)
+                reason = future.exception() if future in done else 'timed out'
+                logger.warning("Shard %s left out: %s", shard.address, reason)
+        if not responses:
+            raise ShardsUnavailable(f"No shard answered ({', '.join(missing)})")
+        return responses, missing
+
+    def connect(self):
+        """Reach every shard now rather than on the first search; fails if none answers."""
+        self._scatter({'op': 'info'})
+
+    def version(self):
+        """
+        The shards' versions as of their latest connections, without a round trip.
+
+        It changes when a shard comes back with other data, which takes
+        cached results of the old version out of use.
+        """
+        return '+'.join(str(shard.version) for shard in self.shards)
+
+    def search(self, queries, k, exclude=()):
+        """
+        The ``k`` nearest ``(distance, book_id)`` pairs per query, merged over all shards.
+
+        Returns ``(results, missing)``, where ``missing`` lists shards that
+        were left out of the merge.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        header = {'op': 'search', 'k': k, 'exclude': sorted(exclude)}
+        responses, missing = self._scatter(header, queries)
+        results = [
+            heapq.nsmallest(k, (tuple(pair) for response in responses for pair in response['results'][query]))
+            for query in range(len(queries))
+        ]
+        return results, missing
+
+    def vectors_for(self, book_ids):
+        """Stored vectors for ``book_ids`` from whichever shard holds them; None where none does."""
+        book_ids = [str(book_id) for book_id in book_ids]
+        responses, _ = self._scatter({'op': 'vectors', 'book_ids': book_ids})
+        vectors = [None] * len(book_ids)
+        for response in responses:
+            stored = iter(response['vectors'])
+            for i, found in enumerate(response['found']):
+                if found:
+                    vectors[i] = next(stored)
+        return vectors
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.reset()
+
+
+class ShardedState:
+    """Stands in for ``IndexState`` when the recommender serves from shards."""
+
+    def __init__(self, searcher):
+        self.searcher = searcher
+
+    @property
+    def version(self):
+        return self.searcher.version()
+
+    def vector_for(self, book_id):
+        return self.vectors_for([book_id])[0]
+
+    def vectors_for(self, book_ids):
+        return self.searcher.vectors_for(book_ids)
+
+    def search(self, vector, k, exclude=None):
+        exclude = () if exclude is None else (str(exclude),)
+        results, missing = self.searcher.search(np.asarray(vector).reshape(1, -1), k, exclude)
+        return self._result([book_id for _, book_id in results[0]], missing)
+
+    def search_many(self, queries, k, exclude=()):
+        results, missing = self.searcher.search(queries, k, exclude)
+        best = {}
+        for found in results:
+            for distance, book_id in found:
+                if distance < best.get(book_id, float('inf')):
+                    best[book_id] = distance
+        return self._result(sorted(best, key=best.get)[:k], missing)
+
+    def _result(self, book_ids, missing):
+        return PartialResult(book_ids, missing) if missing else book_ids
@@ -1,14 +1,28 @@
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
-
-# Load the index and book IDs
-index = faiss.read_index('book_index.faiss')
-book_ids = np.load('book_ids.npy')
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-#
+from common.recommender import get_recommender
+
+
 def recommend_books(favorite_book_description):
-    favorite_embedding = model.encode([favorite_book_description])
-    D, I = index.search(favorite_embedding, 5)
-    recommended_ids = [book_ids[i] for i in I[0]]
-    return recommended_ids
\ No newline at end of file
+    return get_recommender().recommend(favorite_book_description)
+
+
+def recommend_for_book(book):
+    """Recommend from the book's stored vector, encoding its description only if it is not indexed."""
+    return get_recommender().recommend_for_book(book.pk, book.description)
+
+
+def similar_books(book_id):
+    """Recommend from the stored vector only; None if the book is not indexed."""
+    return get_recommender().similar_books(book_id)
+
+
+def recommend_for_favorites(favorites, mode='batch'):
+    """Recommend from a whole favourites list of ``(book_id, description)`` pairs in one search."""
+    return get_recommender().recommend_for_books(favorites, mode=mode)
+
+
+def invalidate_recommendations(book_ids):
+    """Drop cached recommendations for ``book_ids``, for bulk writes that bypass the model signals."""
+    cache = get_recommender().cache
+    if cache is not None:
+        for book_id in book_ids:
+            cache.invalidate_book(book_id)
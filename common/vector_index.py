@@ -0,0 +1,165 @@
+"""
+Building and tuning FAISS indexes for book vectors.
+
+Index types are described by FAISS index factory strings, for example:
+
+- ``Flat``: exact brute-force search (the default)
+- ``IVF4096,Flat``: inverted file over trained coarse centroids
+- ``HNSW32``: hierarchical navigable small-world graph
+- ``IVF4096,PQ48``: inverted file with product-quantised codes
+
+Any of them can store compressed vectors instead of raw float32 ones and
+can be preceded by a PCA reduction; see ``compressed_spec``.
+"""
+import faiss
+import numpy as np
+
+DEFAULT_INDEX_SPEC = 'Flat'
+
+# Bytes per dimension: fp16 2, int8 1; pq stores ``pq_m`` bytes per vector.
+COMPRESSIONS = {
+    'fp16': 'SQfp16',
+    'int8': 'SQ8',
+    'pq': 'PQ{pq_m}',
+}
+
+
+def compressed_spec(spec, compression=None, pca=None, pq_m=48):
+    """
+    Fold compression options into an index factory string.
+
+    ``compression`` replaces the raw ``Flat`` storage of ``spec`` (or adds
+    codes to an ``HNSW`` graph), e.g. ``IVF4096,Flat`` with ``int8`` becomes
+    ``IVF4096,SQ8``. ``pca`` puts a PCA projection to that many dimensions in
+    front; it is trained with the rest of the index.
+    """
+    parts = spec.split(',')
+    if compression is not None:
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}; choose from {', '.join(COMPRESSIONS)}")
+        codes = COMPRESSIONS[compression].format(pq_m=pq_m)
+        if parts[-1] == 'Flat':
+            parts[-1] = codes
+        elif len(parts) == 1 and parts[0].startswith('HNSW'):
+            parts.append(codes)
+        else:
+            raise ValueError(f"Index spec {spec!r} already compresses its vectors")
+    if pca is not None:
+        parts.insert(0, f"PCA{pca}")
+    return ','.join(parts)
+
+
+def add_index_arguments(parser):
+    """The index type, compression and tuning options shared by every command that builds the serving index."""
+    parser.add_argument('--index-spec', default=DEFAULT_INDEX_SPEC,
+                        help='FAISS index factory string, e.g. Flat, IVF4096,Flat, HNSW32 or IVF4096,PQ48')
+    parser.add_argument('--train-size', type=int, default=100000,
+                        help='Number of randomly sampled books used to train IVF/PQ indexes')
+    parser.add_argument('--compression', choices=sorted(COMPRESSIONS),
+                        help='Store fp16 or int8 scalar-quantised vectors, or PQ codes, instead of float32')
+    parser.add_argument('--pq-m', type=int, default=48,
+                        help='Bytes per book with --compression pq; must divide the (PCA) dimension')
+    parser.add_argument('--pca', type=int, metavar='DIM',
+                        help='Reduce vectors to DIM dimensions with a PCA trained on the training sample')
+    parser.add_argument('--nprobe', type=int, help='Default nprobe stored with IVF indexes')
+    parser.add_argument('--ef-search', type=int, help='Default efSearch stored with HNSW indexes')
+
+
+def spec_from_options(options):
+    """The index factory string for the options added by ``add_index_arguments``."""
+    return compressed_spec(options['index_spec'], options['compression'], options['pca'], options['pq_m'])
+
+
+def create_index(spec, dimension):
+    try:
+        return faiss.index_factory(dimension, spec, faiss.METRIC_L2)
+    except RuntimeError as e:
+        raise ValueError(f"Invalid index spec {spec!r}: {e}") from e
+
+
+def sample_rows(vectors, sample_size, seed=0):
+    """Return a random subset of ``vectors`` (all of them if there are fewer)."""
+    if len(vectors) <= sample_size:
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), sample_size, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype=np.float32)
+
+
+def train_index(index, sample):
+    """Train coarse centroids / codebooks on ``sample``; a no-op for indexes that need none."""
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Apply the query-time knobs that ``index`` supports and ignore the rest."""
+    params = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        if value is None:
+            continue
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # e.g. nprobe on an HNSW index
+
+
+def search_params_excluding(index, rows):
+    """Search parameters that skip ``rows``, keeping the index's current nprobe / efSearch."""
+    batch = faiss.IDSelectorBatch(np.asarray(rows, dtype=np.int64))
+    selector = faiss.IDSelectorNot(batch)
+    ivf = faiss.try_extract_index_ivf(index)
+    hnsw = faiss.downcast_index(index)
+    if ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    elif isinstance(hnsw, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The parameters only hold raw pointers to the selectors.
+    params.referenced_objects = [batch, selector]
+    return params
+
+
+def enable_reconstruct(index):
+    """Let ``index.reconstruct(row)`` work on IVF indexes, which need a row -> list map for it."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+
+
+def empty_copy(index):
+    """
+    An empty index with the trained state of ``index`` (coarse centroids,
+    codebooks, PCA matrix), which may be mapped from disk with
+    ``IO_FLAG_MMAP_IFC``: unlike ``clone_index`` followed by ``reset``, this
+    neither copies the stored vectors nor writes to the mapped ones.
+    """
+    copy = faiss.clone_index(index)
+    _drop_vectors(copy)
+    return copy
+
+
+def _drop_vectors(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        _drop_vectors(index.index)
+    elif isinstance(index, faiss.IndexIVF):
+        invlists = faiss.ArrayInvertedLists(index.nlist, index.code_size)
+        invlists.thisown = False  # owned by the index from here on
+        index.replace_invlists(invlists, True)
+        index.make_direct_map(False)
+    elif isinstance(index, faiss.IndexHNSW):
+        graph = faiss.HNSW(index.hnsw.nb_neighbors(1))
+        graph.efConstruction = index.hnsw.efConstruction
+        graph.efSearch = index.hnsw.efSearch
+        index.hnsw = graph
+        _drop_vectors(index.storage)
+    elif isinstance(index, faiss.IndexFlatCodes):
+        index.codes = faiss.MaybeOwnedVectorUInt8()
+    else:
+        index.reset()
+    index.ntotal = 0
+
+
+def index_memory_bytes(index):
+    return faiss.serialize_index(index).nbytes
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library_system.settings')
 
 application = get_asgi_application()
+
+from apis import autocomplete  # noqa: E402
+from common.recommender import warm_up_if_configured  # noqa: E402
+
+warm_up_if_configured()
+autocomplete.warm_up_if_configured()
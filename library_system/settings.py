@@ -128,6 +128,57 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Book recommender, loaded lazily by common/recommender.py.
+# Set WARM_UP to load it when a web worker boots instead of on the first request.
+# Set MMAP to serve from the memory-mapped VECTORS_PATH (see the export_mmap_index
+# command), which all workers on a host share. NPROBE and EF_SEARCH tune IVF and
+# HNSW indexes built with export_data --index-spec; None keeps the built-in value.
+RECOMMENDER = {
+    'INDEX_PATH': str(BASE_DIR / 'book_index.faiss'),
+    'BOOK_IDS_PATH': str(BASE_DIR / 'book_ids.npy'),
+    'VECTORS_PATH': str(BASE_DIR / 'book_vectors.npy'),
+    'MMAP': False,
+    'NPROBE': None,
+    'EF_SEARCH': None,
+    # Directory of index versions kept up to date by run_indexer. When set, it
+    # replaces INDEX_PATH and is checked for new versions every RELOAD_INTERVAL seconds.
+    'INDEX_VERSIONS_DIR': None,
+    'RELOAD_INTERVAL': 5,
+    # host:port of run_shard_server processes; when set, searches are fanned
+    # out to them and shards slower than SHARD_TIMEOUT seconds are left out.
+    'SHARDS': None,
+    'SHARD_TIMEOUT': 0.5,
+    # Results cache keyed by (book id, k, index version): an in-process LRU,
+    # plus an optional shared tier through the named Django cache alias.
+    'CACHE': {
+        'MAX_ENTRIES': 10000,
+        'LOCAL_TIMEOUT': 300,
+        'SHARED_ALIAS': None,
+        'SHARED_TIMEOUT': 3600,
+    },
+    'MODEL_NAME': 'paraphrase-MiniLM-L6-v2',
+    # Unix socket of the run_encoder sidecar; None loads the model in every worker.
+    'ENCODER_SOCKET': None,
+    'WARM_UP': False,
+}
+
+# Type-ahead suggestions served from memory (see apis.autocomplete). The
+# snapshot is written by build_autocomplete; without one the index is built
+# from the database on first use, or at startup with WARM_UP. With several
+# worker processes, set SHARED_ALIAS to a Django cache alias they all reach
+# (e.g. Redis); writes made by one worker then make the others rebuild.
+AUTOCOMPLETE = {
+    'SNAPSHOT_PATH': str(BASE_DIR / 'autocomplete.pickle'),
+    'TOP_K': 10,
+    'WARM_UP': False,
+    'SHARED_ALIAS': None,
+    # Writes kept in the shared cache; a worker further behind rebuilds from the database
+    'LOG_SIZE': 1000,
+    # Seconds between logging the favourite counts that changed in a worker
+    'FAVORITES_INTERVAL': 5,
+}
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework_simplejwt.authentication.JWTAuthentication",